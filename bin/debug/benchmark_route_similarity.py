@@ -0,0 +1,69 @@
+# Compares the running time of the original LCS and Frechet route similarity
+# implementations with the array based ones, on the real sections of a user.
+# Note that Frechet.Frechet is a thresholded approximation of the continuous
+# Frechet distance, so its values will differ from discreteFrechet. The LCS
+# implementations must return identical values.
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import argparse
+import itertools
+import time
+import uuid
+
+import emission.core.get_database as edb
+import emission.analysis.modelling.tour_model.trajectory_matching.LCS as eatl
+import emission.analysis.modelling.tour_model.trajectory_matching.Frechet as eatf
+
+def get_routes(user_id, n_routes):
+    routes = []
+    query = {'user_id': user_id, 'type': 'move'}
+    for section in edb.get_section_db().find(query, {'track_points': True}).limit(n_routes):
+        route = [point['track_location']['coordinates'] for point in section['track_points']]
+        if len(route) >= 2:
+            routes.append(route)
+    return routes
+
+def time_pairs(pairs, func):
+    results = []
+    start = time.time()
+    for (route1, route2) in pairs:
+        results.append(func(route1, route2))
+    return (time.time() - start, results)
+
+def benchmark(routes, radius):
+    pairs = list(itertools.combinations(routes, 2))
+    n_points = sum([len(r1) * len(r2) for (r1, r2) in pairs])
+    print "Comparing %d pairs from %d routes (%d point pairs)" % (len(pairs), len(routes), n_points)
+
+    comparisons = [
+        ("lcsScore", lambda r1, r2: eatl.lcsScore(r1, r2, radius)),
+        ("bandedLcsScore", lambda r1, r2: eatl.bandedLcsScore(r1, r2, radius)),
+        ("bandedLcsScore, threshold=0.5", lambda r1, r2: eatl.bandedLcsScore(r1, r2, radius, 0.5)),
+        ("Frechet", lambda r1, r2: eatf.Frechet(r1, r2)),
+        ("discreteFrechet", lambda r1, r2: eatf.discreteFrechet(r1, r2)),
+        ("discreteFrechet, threshold=radius", lambda r1, r2: eatf.discreteFrechet(r1, r2, radius))
+    ]
+
+    all_results = {}
+    for (name, func) in comparisons:
+        (elapsed, results) = time_pairs(pairs, func)
+        all_results[name] = results
+        print "%35s: %8.3f secs, %8.3f ms/pair" % (name, elapsed, elapsed * 1000 / max(len(pairs), 1))
+
+    mismatches = [i for i, (old, new) in
+        enumerate(zip(all_results["lcsScore"], all_results["bandedLcsScore"]))
+        if abs(old - new) > 1e-9]
+    print "LCS mismatches = %d" % len(mismatches)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("user_id",
+        help="user whose sections should be compared")
+    parser.add_argument("-n", "--n_routes", type=int, default=20,
+        help="number of sections to read, all pairs are compared")
+    parser.add_argument("-r", "--radius", type=float, default=2000,
+        help="match radius in meters, same as radius1 in route_matching")
+
+    args = parser.parse_args()
+    benchmark(get_routes(uuid.UUID(args.user_id), args.n_routes), args.radius)
@@ -12,6 +12,7 @@ import emission.analysis.intake.cleaning.filter_accuracy as eaicf
 import emission.analysis.intake.segmentation.trip_segmentation as eaist
 import emission.analysis.intake.segmentation.section_segmentation as eaiss
 import emission.analysis.intake.cleaning.location_smoothing as eaicl
+import emission.analysis.classification.inference.section_mode_inference as eacsmi
 
 
 if __name__ == '__main__':
@@ -23,6 +24,9 @@ if __name__ == '__main__':
         uh = euah.UserCacheHandler.getUserCacheHandler(uuid)
         uh.moveToLongTerm()
 
+    # Load the mode inference model once for all the users
+    mode_inference_pipeline = eacsmi.load_pipeline()
+
     long_term_uuid_list = esta.TimeSeries.get_uuid_list()
     logging.info("*" * 10 + "long term UUID list = %s" % long_term_uuid_list)
     for uuid in long_term_uuid_list:
@@ -38,6 +42,9 @@ if __name__ == '__main__':
         logging.info("*" * 10 + "UUID %s: smoothing sections" % uuid + "*" * 10)
         eaicl.filter_current_sections(uuid)
 
+        logging.info("*" * 10 + "UUID %s: inferring section modes" % uuid + "*" * 10)
+        eacsmi.predict_mode_for_current_sections(uuid, mode_inference_pipeline)
+
         logging.info("*" * 10 + "UUID %s: finding common trips" % uuid + "*" * 10)
         esdtmq.make_tour_model_from_raw_user_data(uuid)
 
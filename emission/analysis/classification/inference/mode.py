@@ -12,6 +12,8 @@ from datetime import datetime
 # Our imports
 import emission.analysis.section_features as easf
 import emission.core.get_database as edb
+import emission.analysis.classification.inference.model_store as eaicm
+import emission.analysis.classification.inference.prediction_sink as eaicp
 
 # We are not going to use the feature matrix for analysis unless we have at
 # least 50 points in the training set. 50 is arbitrary. We could also consider
@@ -28,22 +30,38 @@ class ModeInferencePipeline:
                           "start hour", "end hour", "close to bus stop", "close to train stop",
                           "close to airport"]
     self.Sections = edb.get_section_db()
+    self.modelDir = eaicm.MODEL_DIR
 
   def runPipeline(self):
-    allConfirmedTripsQuery = ModeInferencePipeline.getSectionQueryWithGroundTruth({'$ne': ''})
-
+    self.runTrainingPipeline()
+    self.runPredictionPipeline()
 
+  # Trains the model, unless the stored model was trained on the same
+  # training set, in which case it is just loaded. Pass forceRetrain=True to
+  # always retrain, e.g. after changing the model parameters.
+  def runTrainingPipeline(self, forceRetrain = False):
+    allConfirmedTripsQuery = ModeInferencePipeline.getSectionQueryWithGroundTruth({'$ne': ''})
 
+    trainingSectionDb = self.Sections
     (self.modeList, self.confirmedSections) = self.loadTrainingDataStep(allConfirmedTripsQuery)
     logging.debug("confirmedSections.count() = %s" % (self.confirmedSections.count()))
     
     if (self.confirmedSections.count() < minTrainingSetSize):
       logging.info("initial loadTrainingDataStep DONE")
       logging.debug("current training set too small, reloading from backup!")
-      backupSections = MongoClient('localhost').Backup_database.Stage_Sections
-      (self.modeList, self.confirmedSections) = self.loadTrainingDataStep(allConfirmedTripsQuery, backupSections)
+      trainingSectionDb = MongoClient('localhost').Backup_database.Stage_Sections
+      (self.modeList, self.confirmedSections) = self.loadTrainingDataStep(allConfirmedTripsQuery, trainingSectionDb)
     logging.info("loadTrainingDataStep DONE")
-    (self.bus_cluster, self.train_cluster) = self.generateBusAndTrainStopStep() 
+
+    fingerprint = eaicm.get_training_set_fingerprint(trainingSectionDb, allConfirmedTripsQuery)
+    if not forceRetrain and self.loadModelStep(fingerprint):
+      logging.info("training set unchanged, reusing stored model")
+      return
+
+    # The clusters are computed from self.Sections, so the fingerprint only
+    # describes their input if the training set was read from there too
+    clusterFingerprint = fingerprint if trainingSectionDb is self.Sections else None
+    (self.bus_cluster, self.train_cluster) = self.generateBusAndTrainStopStep(clusterFingerprint)
     logging.info("generateBusAndTrainStopStep DONE")
     (self.featureMatrix, self.resultVector) = self.generateFeatureMatrixAndResultVectorStep()
     logging.info("generateFeatureMatrixAndResultVectorStep DONE")
@@ -54,15 +72,54 @@ class ModeInferencePipeline:
     self.selFeatureMatrix = self.cleanedFeatureMatrix[:,self.selFeatureIndices]
     self.model = self.buildModelStep()
     logging.info("buildModelStep DONE")
+    self.saveModelStep(fingerprint)
+    logging.info("saveModelStep DONE")
+
+  # Predicts modes for the sections that don't have one yet, using the model
+  # from runTrainingPipeline if it was run in this process, or the stored
+  # model otherwise.
+  def runPredictionPipeline(self):
+    if not hasattr(self, "model") and not self.loadModelStep():
+      logging.error("No stored model found, run the training pipeline first")
+      return
     toPredictTripsQuery = {"$and": [{'type': 'move'},
                                     ModeInferencePipeline.getModeQuery(''),
                                     {'predicted_mode': None}]}
-    (self.toPredictFeatureMatrix, self.sectionIds, self.sectionUserIds) = self.generateFeatureMatrixAndIDsStep(toPredictTripsQuery)
-    logging.info("generateFeatureMatrixAndIDsStep DONE")
-    self.predictedProb = self.predictModesStep()
-    logging.info("predictModesStep DONE")
-    self.savePredictionsStep()
-    logging.info("savePredictionsStep DONE")
+    self.predictAndSaveInChunksStep(toPredictTripsQuery)
+    logging.info("predictAndSaveInChunksStep DONE")
+
+  # Everything that the prediction steps need from training
+  def saveModelStep(self, fingerprint):
+    modelDict = {'training_set_fingerprint': fingerprint,
+                 'model': self.model,
+                 'selFeatureIndices': self.selFeatureIndices,
+                 'uniqueModes': sorted(set(self.cleanedResultVector)),
+                 'modeList': self.modeList,
+                 'bus_cluster': self.bus_cluster,
+                 'train_cluster': self.train_cluster}
+    eaicm.save_model(modelDict, self.modelDir)
+    self.modelCreatedTs = modelDict['created_ts']
+
+  # Returns True if there is a stored model, and it was trained with the
+  # training set that has this fingerprint (if specified)
+  def loadModelStep(self, fingerprint = None):
+    begin = time.time()
+    modelDict = eaicm.load_model(self.modelDir)
+    if modelDict is None:
+      return False
+    if fingerprint is not None and modelDict['training_set_fingerprint'] != fingerprint:
+      logging.info("training set fingerprint changed from %s to %s, need to retrain" %
+        (modelDict['training_set_fingerprint'], fingerprint))
+      return False
+    self.model = modelDict['model']
+    self.selFeatureIndices = modelDict['selFeatureIndices']
+    self.uniqueModes = modelDict['uniqueModes']
+    self.modeList = modelDict['modeList']
+    self.bus_cluster = modelDict['bus_cluster']
+    self.train_cluster = modelDict['train_cluster']
+    self.modelCreatedTs = modelDict['created_ts']
+    logging.debug("Loading model trained at %s took %s" % (modelDict['created_ts'], time.time() - begin))
+    return True
 
     # Most of the time, this will be an int, but it can also be a subquery, like
     # {'$ne': ''}. This will be used to find the set of entries for the training
@@ -124,10 +181,14 @@ class ModeInferencePipeline:
     return (modeList, confirmedSections)
 
   # TODO: Should mode_cluster be in featurecalc or here?
-  def generateBusAndTrainStopStep(self):
-    bus_cluster=easf.mode_cluster(5,105,1)
-    train_cluster=easf.mode_cluster(6,600,1)
-    air_cluster=easf.mode_cluster(9,600,1)
+  # Returns SpatialGrids over the cluster centers, so that the coverage
+  # features don't scan all the centers for every section. The air cluster
+  # is not used as a feature, so we don't compute it here.
+  # If the fingerprint of the training set is specified, and the clusters were
+  # computed for the same fingerprint, they are loaded instead of recomputed.
+  def generateBusAndTrainStopStep(self, fingerprint = None):
+    bus_cluster=easf.mode_cluster_grid(5,105,1,fingerprint,self.modelDir)
+    train_cluster=easf.mode_cluster_grid(6,600,1,fingerprint,self.modelDir)
     return (bus_cluster, train_cluster)
 
 # Feature matrix construction
@@ -148,16 +209,31 @@ class ModeInferencePipeline:
       # doesn't exist.
 
       # So we limit the records to the size of the matrix that we have created
-      for (i, section) in enumerate(self.confirmedSections.limit(featureMatrix.shape[0]).batch_size(300)):
-        try:
-            self.updateFeatureMatrixRowWithSection(featureMatrix, i, section)
-            resultVector[i] = self.getGroundTruthMode(section)
-            if i % 100 == 0:
-                logging.debug("Processing record %s " % i)
-        except Exception, e:
-            logging.debug("skipping section %s due to error %s " % (section, e))
+      # The track point features are computed for a batch of sections at a time
+      sectionCursor = self.confirmedSections.limit(featureMatrix.shape[0]).batch_size(300)
+      for (startIdx, sections) in self.sectionBatches(sectionCursor, 300):
+        errors = self.updateFeatureMatrixRowsWithSections(featureMatrix, startIdx, sections)
+        for (j, section) in enumerate(sections):
+          if j in errors:
+            logging.debug("skipping section %s due to error %s " % (section, errors[j]))
+            continue
+          resultVector[startIdx + j] = self.getGroundTruthMode(section)
+        logging.debug("Processed records %s to %s" % (startIdx, startIdx + len(sections)))
       return (featureMatrix, resultVector)
 
+  @staticmethod
+  def sectionBatches(sectionCursor, batchSize):
+    batch = []
+    startIdx = 0
+    for section in sectionCursor:
+      batch.append(section)
+      if len(batch) == batchSize:
+        yield (startIdx, batch)
+        startIdx += len(batch)
+        batch = []
+    if len(batch) > 0:
+      yield (startIdx, batch)
+
   def getGroundTruthMode(self, section):
       # logging.debug("getting ground truth for section %s" % section)
       if 'corrected_mode' in section:
@@ -191,6 +267,28 @@ class ModeInferencePipeline:
 # 20. both start and end close to train station
 # 21. both start and end close to airport
   def updateFeatureMatrixRowWithSection(self, featureMatrix, i, section):
+    errors = self.updateFeatureMatrixRowsWithSections(featureMatrix, i, [section])
+    if len(errors) > 0:
+      raise errors[0]
+
+  # Fills in the rows starting at startIdx with the features of the sections.
+  # The track point features (5-8, 10-12) are computed for all the sections
+  # at once. Returns a map from the index in sections to the exception for
+  # the sections that could not be processed.
+  def updateFeatureMatrixRowsWithSections(self, featureMatrix, startIdx, sections):
+    trackPointFeatures = easf.calTrackPointFeatures(sections)
+    errors = dict(trackPointFeatures['errors'])
+    for (j, section) in enumerate(sections):
+      if j in errors:
+        continue
+      try:
+        self.updateFeatureMatrixRowWithFeatures(featureMatrix, startIdx + j, section,
+                                                trackPointFeatures, j)
+      except Exception, e:
+        errors[j] = e
+    return errors
+
+  def updateFeatureMatrixRowWithFeatures(self, featureMatrix, i, section, trackPointFeatures, j):
     featureMatrix[i, 0] = section['distance']
     featureMatrix[i, 1] = (section['section_end_datetime'] - section['section_start_datetime']).total_seconds()
 
@@ -202,24 +300,15 @@ class ModeInferencePipeline:
 
     featureMatrix[i, 3] = section['section_id']
     featureMatrix[i, 4] = easf.calAvgSpeed(section)
-    speeds = easf.calSpeeds(section)
-    if speeds != None and len(speeds) > 0:
-        featureMatrix[i, 5] = np.mean(speeds)
-        featureMatrix[i, 6] = np.std(speeds)
-        featureMatrix[i, 7] = np.max(speeds)
-    else:
-        # They will remain zero
-        pass
-    accels = easf.calAccels(section)
-    if accels != None and len(accels) > 0:
-        featureMatrix[i, 8] = np.max(accels)
-    else:
-        # They will remain zero
-        pass
+    # These are zero if there are no speeds or accels
+    featureMatrix[i, 5] = trackPointFeatures['speedMean'][j]
+    featureMatrix[i, 6] = trackPointFeatures['speedStd'][j]
+    featureMatrix[i, 7] = trackPointFeatures['speedMax'][j]
+    featureMatrix[i, 8] = trackPointFeatures['accelMax'][j]
     featureMatrix[i, 9] = ('commute' in section) and (section['commute'] == 'to' or section['commute'] == 'from')
-    featureMatrix[i, 10] = easf.calHCR(section)
-    featureMatrix[i, 11] = easf.calSR(section)
-    featureMatrix[i, 12] = easf.calVCR(section)
+    featureMatrix[i, 10] = trackPointFeatures['HCR'][j]
+    featureMatrix[i, 11] = trackPointFeatures['SR'][j]
+    featureMatrix[i, 12] = trackPointFeatures['VCR'][j]
     if 'section_start_point' in section and section['section_start_point'] != None:
         startCoords = section['section_start_point']['coordinates']
         featureMatrix[i, 13] = startCoords[0]
@@ -304,12 +393,15 @@ class ModeInferencePipeline:
     featureMatrix = np.zeros([toPredictSections.count(), len(self.featureLabels)])
     sectionIds = []
     sectionUserIds = []
-    for (i, section) in enumerate(toPredictSections.limit(featureMatrix.shape[0]).batch_size(300)):
-      if i % 50 == 0:
-        logging.debug("Processing test record %s " % i)
-      self.updateFeatureMatrixRowWithSection(featureMatrix, i, section)
-      sectionIds.append(section['_id'])
-      sectionUserIds.append(section['user_id'])
+    sectionCursor = toPredictSections.limit(featureMatrix.shape[0]).batch_size(300)
+    for (startIdx, sections) in self.sectionBatches(sectionCursor, 300):
+      logging.debug("Processing test records %s to %s" % (startIdx, startIdx + len(sections)))
+      errors = self.updateFeatureMatrixRowsWithSections(featureMatrix, startIdx, sections)
+      if len(errors) > 0:
+        raise errors[min(errors.keys())]
+      for section in sections:
+        sectionIds.append(section['_id'])
+        sectionUserIds.append(section['user_id'])
     return (featureMatrix[:,self.selFeatureIndices], sectionIds, sectionUserIds)
 
   def predictModesStep(self):
@@ -342,23 +434,47 @@ class ModeInferencePipeline:
           currProbMap[modeName] = predictedProbArr[j]
       return currProbMap
 
-  def savePredictionsStep(self):
-    from emission.core.wrapper.user import User
-    from emission.core.wrapper.client import Client
-
-    uniqueModes = sorted(set(self.cleanedResultVector))
+  def getUniqueModes(self):
+    # The stored model does not have the training set, only its unique modes
+    if hasattr(self, "cleanedResultVector"):
+      return sorted(set(self.cleanedResultVector))
+    else:
+      return self.uniqueModes
 
+  def savePredictionsStep(self):
+    uniqueModes = self.getUniqueModes()
+    sink = eaicp.PredictionSink(self.Sections)
     for i in range(self.predictedProb.shape[0]):
-      currSectionId = self.sectionIds[i]
       currProb = self.convertPredictedProbToMap(self.modeList, uniqueModes, self.predictedProb[i])
-
-      logging.debug("Updating probability for section with id = %s" % currSectionId)
-      self.Sections.update({'_id': currSectionId}, {"$set": {"predicted_mode": currProb}})
-
-      currUser = User.fromUUID(self.sectionUserIds[i])
-      clientSpecificUpdate = Client(currUser.getFirstStudy()).clientSpecificSetters(currUser.uuid, currSectionId, currProb)
-      if clientSpecificUpdate != None:
-        self.Sections.update({'_id': currSectionId}, clientSpecificUpdate)
+      sink.add(self.sectionIds[i], self.sectionUserIds[i], currProb)
+    sink.flush()
+
+  # Same as generateFeatureMatrixAndIDsStep, predictModesStep and
+  # savePredictionsStep, but for chunkSize sections at a time, so that we
+  # don't need to hold the features and predictions for all the sections in
+  # memory.
+  # The sink sets predicted_mode on the sections that the query matches, and
+  # updated documents can move while a cursor scans them, so that the cursor
+  # skips or repeats sections. So we read the ids of the sections first, and
+  # read each chunk of sections by id.
+  def predictAndSaveInChunksStep(self, sectionQuery, chunkSize = 300):
+    uniqueModes = self.getUniqueModes()
+    sink = eaicp.PredictionSink(self.Sections, chunkSize)
+    sectionIds = [section['_id'] for section in self.Sections.find(sectionQuery, {'_id': True})]
+    logging.debug("Predicting values for %d sections" % len(sectionIds))
+    for startIdx in range(0, len(sectionIds), chunkSize):
+      chunkIds = sectionIds[startIdx:startIdx + chunkSize]
+      sections = list(self.Sections.find({'_id': {'$in': chunkIds}}))
+      logging.debug("Predicting values for sections %s to %s" % (startIdx, startIdx + len(sections)))
+      featureMatrix = np.zeros([len(sections), len(self.featureLabels)])
+      errors = self.updateFeatureMatrixRowsWithSections(featureMatrix, 0, sections)
+      if len(errors) > 0:
+        raise errors[min(errors.keys())]
+      predictedProb = self.model.predict_proba(featureMatrix[:,self.selFeatureIndices])
+      for (j, section) in enumerate(sections):
+        currProb = self.convertPredictedProbToMap(self.modeList, uniqueModes, predictedProb[j])
+        sink.add(section['_id'], section['user_id'], currProb)
+    sink.flush()
 
 if __name__ == "__main__":
   import json
@@ -368,4 +484,9 @@ if __name__ == "__main__":
   logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
                       filename="%s/pipeline.log" % log_base_dir, level=logging.DEBUG)
   modeInferPipeline = ModeInferencePipeline()
-  modeInferPipeline.runPipeline()
+  if len(sys.argv) > 1 and sys.argv[1] == "train":
+    modeInferPipeline.runTrainingPipeline(forceRetrain = True)
+  elif len(sys.argv) > 1 and sys.argv[1] == "predict":
+    modeInferPipeline.runPredictionPipeline()
+  else:
+    modeInferPipeline.runPipeline()
@@ -0,0 +1,96 @@
+# Standard imports
+import logging
+import os
+import time
+import hashlib
+import cPickle as pickle
+
+# Stores the result of training the mode inference pipeline, so that runs
+# that only need to predict modes for new sections can load it instead of
+# retraining. The stored model is a dict with:
+# - version: MODEL_VERSION at the time of training. If the features or the
+#   model change, MODEL_VERSION needs to be bumped so that we don't use a
+#   model that was trained on different features.
+# - training_set_fingerprint: a hash of the ids and ground truth modes of the
+#   training set, so that we can tell whether the model needs to be retrained
+# - created_ts: when the model was trained
+# - the fitted model and everything else that is needed for prediction, see
+#   ModeInferencePipeline.saveModelStep
+#
+# The inputs and results of section_features.mode_cluster are stored in the
+# same directory, so that retraining only projects the new sections.
+
+MODEL_VERSION = 2
+MODEL_DIR = 'modeInferenceModels'
+
+def get_model_file(model_dir=MODEL_DIR):
+    return os.path.join(model_dir, 'mode_inference_model_v%d.pkl' % MODEL_VERSION)
+
+def get_training_set_fingerprint(sectionDb, sectionQuery):
+    """
+    Returns a hash of the ids and ground truth modes of the sections in the
+    training set. Only reads the fields that are needed, so this is much
+    cheaper than loading the training set.
+    """
+    projection = {'_id': True, 'confirmed_mode': True, 'corrected_mode': True}
+    entries = []
+    for section in sectionDb.find(sectionQuery, projection):
+        entries.append("%s:%s:%s" % (section['_id'], section.get('confirmed_mode'),
+                                     section.get('corrected_mode')))
+    fingerprint = hashlib.sha1()
+    for entry in sorted(entries):
+        fingerprint.update(entry)
+    return fingerprint.hexdigest()
+
+def get_mode_cluster_file(mode, eps, sam, model_dir=MODEL_DIR):
+    return os.path.join(model_dir, 'mode_cluster_%s_%s_%s_v%d.pkl' % (mode, eps, sam, MODEL_VERSION))
+
+def save_model(model_dict, model_dir=MODEL_DIR):
+    model_dict['version'] = MODEL_VERSION
+    model_dict['created_ts'] = time.time()
+    model_file = get_model_file(model_dir)
+    _save(model_dict, model_dir, model_file)
+    logging.info("Saved mode inference model with fingerprint %s to %s" %
+                 (model_dict.get('training_set_fingerprint'), model_file))
+
+def load_model(model_dir=MODEL_DIR):
+    """
+    Returns the stored model dict, or None if there is no model for the
+    current MODEL_VERSION
+    """
+    model_file = get_model_file(model_dir)
+    if not os.path.exists(model_file):
+        logging.info("No stored mode inference model found at %s" % model_file)
+        return None
+    model_dict = _load(model_file)
+    if model_dict.get('version') != MODEL_VERSION:
+        logging.info("Stored model has version %s, expected %s, ignoring" %
+                     (model_dict.get('version'), MODEL_VERSION))
+        return None
+    return model_dict
+
+def save_mode_clusters(cluster_dict, mode, eps, sam, model_dir=MODEL_DIR):
+    _save(cluster_dict, model_dir, get_mode_cluster_file(mode, eps, sam, model_dir))
+
+def load_mode_clusters(mode, eps, sam, model_dir=MODEL_DIR):
+    """
+    Returns the stored mode_cluster dict, or None if there is none
+    """
+    cluster_file = get_mode_cluster_file(mode, eps, sam, model_dir)
+    if not os.path.exists(cluster_file):
+        return None
+    return _load(cluster_file)
+
+def _save(obj, model_dir, model_file):
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    # write to a temporary file first so that a concurrent prediction run
+    # never sees a partially written model
+    tmp_file = model_file + '.tmp'
+    with open(tmp_file, 'wb') as fp:
+        pickle.dump(obj, fp, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, model_file)
+
+def _load(model_file):
+    with open(model_file, 'rb') as fp:
+        return pickle.load(fp)
@@ -0,0 +1,64 @@
+# Standard imports
+import logging
+
+# Our imports
+from emission.core.wrapper.user import User
+from emission.core.wrapper.client import Client
+
+# Writes the predicted modes back to the sections collection. Instead of
+# issuing one update per section, the updates are accumulated and written
+# with unordered bulk operations once chunkSize predictions have been added,
+# and on flush.
+#
+# Clients can also add their own fields for each prediction (see
+# Client.clientSpecificSetters). To find the client, we need the study of the
+# user, which used to be read from the profile twice per section. Since the
+# sections are for a small number of users, we cache the study for each user
+# and the client for each study.
+#
+# The client specific updates are written in a separate bulk operation after
+# the predictions, so that they are applied in the same order as before even
+# though the operations within a bulk are unordered.
+
+class PredictionSink:
+  def __init__(self, sectionDb, chunkSize = 500):
+    self.sectionDb = sectionDb
+    self.chunkSize = chunkSize
+    self.userStudyCache = {}
+    self.studyClientCache = {}
+    self.pendingPredictions = []
+    self.nWritten = 0
+
+  def getClient(self, userId):
+    if userId not in self.userStudyCache:
+      self.userStudyCache[userId] = User.fromUUID(userId).getFirstStudy()
+    study = self.userStudyCache[userId]
+    if study not in self.studyClientCache:
+      self.studyClientCache[study] = Client(study)
+    return self.studyClientCache[study]
+
+  def add(self, sectionId, userId, predictedModeMap):
+    self.pendingPredictions.append((sectionId, userId, predictedModeMap))
+    if len(self.pendingPredictions) >= self.chunkSize:
+      self.flush()
+
+  def flush(self):
+    if len(self.pendingPredictions) == 0:
+      return
+    predictionBulk = self.sectionDb.initialize_unordered_bulk_op()
+    clientBulk = self.sectionDb.initialize_unordered_bulk_op()
+    nClientUpdates = 0
+    for (sectionId, userId, predictedModeMap) in self.pendingPredictions:
+      predictionBulk.find({'_id': sectionId}).update_one({"$set": {"predicted_mode": predictedModeMap}})
+      clientSpecificUpdate = self.getClient(userId).clientSpecificSetters(userId, sectionId, predictedModeMap)
+      if clientSpecificUpdate != None:
+        clientBulk.find({'_id': sectionId}).update_one(clientSpecificUpdate)
+        nClientUpdates += 1
+
+    predictionBulk.execute()
+    if nClientUpdates > 0:
+      clientBulk.execute()
+    self.nWritten += len(self.pendingPredictions)
+    logging.debug("Wrote %s predictions and %s client specific updates, %s predictions so far" %
+      (len(self.pendingPredictions), nClientUpdates, self.nWritten))
+    self.pendingPredictions = []
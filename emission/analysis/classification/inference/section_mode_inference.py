@@ -0,0 +1,131 @@
+# Standard imports
+import logging
+import numpy as np
+import dateutil.parser as dup
+
+# Our imports
+import emission.core.wrapper.entry as ecwe
+import emission.core.wrapper.motionactivity as ecwm
+import emission.core.wrapper.modeprediction as ecwmp
+import emission.storage.pipeline_queries as epq
+import emission.storage.decorations.section_queries as esds
+import emission.storage.timeseries.abstract_timeseries as esta
+import emission.analysis.section_features as easf
+import emission.analysis.classification.inference.mode as eacim
+
+# Mode inference stage for the sections created by section_segmentation.
+# Like the other intake stages, it only processes the sections that ended
+# after the last section that it processed (the end_ts watermark in the
+# pipeline state), so the cost scales with the new data.
+#
+# The model is the one trained by ModeInferencePipeline on the ground truth
+# in the legacy sections, so we compute the same features, from the
+# smoothed locations in the timeseries instead of the track points. The
+# predictions are stored in the timeseries as "inference/prediction" entries.
+
+# The sensed modes, mapped to the moves modes that were used as the "first
+# filter mode" of the legacy sections
+FIRST_FILTER_MODES = {ecwm.MotionTypes.ON_FOOT: 1,
+                      ecwm.MotionTypes.WALKING: 1,
+                      ecwm.MotionTypes.RUNNING: 2,
+                      ecwm.MotionTypes.BICYCLING: 3,
+                      ecwm.MotionTypes.IN_VEHICLE: 4}
+
+# pipeline is a ModeInferencePipeline with a trained model. Pass it in when
+# running the stage for multiple users, so that the model is only loaded once.
+def predict_mode_for_current_sections(user_id, pipeline = None):
+    if pipeline is None:
+        pipeline = load_pipeline()
+    if pipeline is None:
+        logging.warning("No stored mode inference model, skipping mode inference for %s" % user_id)
+        return
+
+    time_query = epq.get_time_range_for_mode_inference(user_id)
+    try:
+        sections_to_process = esds.get_sections(user_id, time_query)
+        if len(sections_to_process) == 0:
+            # Didn't process anything new so start at the same point next time
+            last_section_processed = None
+        else:
+            predict_mode_for_sections(user_id, sections_to_process, pipeline)
+            last_section_processed = sections_to_process[-1]
+        epq.mark_mode_inference_done(user_id, last_section_processed)
+    except:
+        logging.exception("Marking mode inference as failed")
+        epq.mark_mode_inference_failed(user_id)
+
+# Returns a ModeInferencePipeline with the stored model, or None if the model
+# has not been trained yet
+def load_pipeline():
+    pipeline = eacim.ModeInferencePipeline()
+    if not pipeline.loadModelStep():
+        return None
+    return pipeline
+
+def predict_mode_for_sections(user_id, sections, pipeline):
+    featureMatrix = get_feature_matrix(user_id, sections, pipeline)
+    predictedProb = pipeline.model.predict_proba(featureMatrix[:,pipeline.selFeatureIndices])
+    uniqueModes = pipeline.getUniqueModes()
+
+    ts = esta.TimeSeries.get_time_series(user_id)
+    for (section, currProb) in zip(sections, predictedProb):
+        prediction = ecwmp.Modeprediction()
+        prediction.section = section.get_id()
+        prediction.predicted_mode_map = pipeline.convertPredictedProbToMap(pipeline.modeList,
+                                                                           uniqueModes, currProb)
+        prediction.model_created_ts = pipeline.modelCreatedTs
+        ts.insert(ecwe.Entry.create_entry(user_id, "inference/prediction", prediction))
+    logging.debug("Stored predictions for %s sections" % len(sections))
+
+def get_section_ordinals(user_id, sections):
+    """
+    Returns the index of each section in its trip, which is what the legacy
+    sections stored as the section_id
+    """
+    trip_ids = list(set([section.trip_id for section in sections]))
+    trip_section_ids = {}
+    for trip_section in esds.get_sections_for_trip_list(user_id, trip_ids):
+        trip_section_ids.setdefault(trip_section.trip_id, []).append(trip_section.get_id())
+    return [trip_section_ids[section.trip_id].index(section.get_id()) for section in sections]
+
+def get_feature_matrix(user_id, sections, pipeline):
+    """
+    Returns the same features as ModeInferencePipeline.updateFeatureMatrixRowWithFeatures.
+    The new sections are not labeled as commutes, so that feature is zero.
+    The segmentation does not store the distance of the new sections, so we
+    compute it from the smoothed points.
+    """
+    (coords, times, counts) = esds.get_smoothed_points(user_id, sections)
+    distances = easf.calSectionDistancesForPoints(coords, counts)
+    trackPointFeatures = easf.calTrackPointFeaturesForPoints(coords, times, counts, distances)
+    ordinals = get_section_ordinals(user_id, sections)
+
+    featureMatrix = np.zeros([len(sections), len(pipeline.featureLabels)])
+    for (i, section) in enumerate(sections):
+        featureMatrix[i, 0] = distances[i]
+        featureMatrix[i, 1] = section.duration
+        featureMatrix[i, 2] = FIRST_FILTER_MODES.get(section.sensed_mode, 0)
+        featureMatrix[i, 3] = ordinals[i]
+        if section.duration != 0:
+            featureMatrix[i, 4] = distances[i] / section.duration
+        featureMatrix[i, 5] = trackPointFeatures['speedMean'][i]
+        featureMatrix[i, 6] = trackPointFeatures['speedStd'][i]
+        featureMatrix[i, 7] = trackPointFeatures['speedMax'][i]
+        featureMatrix[i, 8] = trackPointFeatures['accelMax'][i]
+        featureMatrix[i, 10] = trackPointFeatures['HCR'][i]
+        featureMatrix[i, 11] = trackPointFeatures['SR'][i]
+        featureMatrix[i, 12] = trackPointFeatures['VCR'][i]
+        featureMatrix[i, 13:15] = section.start_loc.coordinates
+        featureMatrix[i, 15:17] = section.end_loc.coordinates
+        # The local_dt are stored as UTC datetimes, so we read the local hour
+        # from the formatted times, which have the offset of the timezone
+        featureMatrix[i, 17] = dup.parse(section.start_fmt_time).hour
+        featureMatrix[i, 18] = dup.parse(section.end_fmt_time).hour
+
+    startPoints = featureMatrix[:, 13:15]
+    endPoints = featureMatrix[:, 15:17]
+    if hasattr(pipeline, "bus_cluster"):
+        featureMatrix[:, 19] = easf.mode_start_end_coverages(startPoints, endPoints, pipeline.bus_cluster, 105)
+    if hasattr(pipeline, "train_cluster"):
+        featureMatrix[:, 20] = easf.mode_start_end_coverages(startPoints, endPoints, pipeline.train_cluster, 600)
+    return np.nan_to_num(featureMatrix)
@@ -7,12 +7,12 @@ import random
 import time
 
 # Our imports
-from emission.core.get_database import get_routeDistanceMatrix_db,get_routeCluster_db,get_section_db
+from emission.core.get_database import get_routeCluster_db,get_section_db
 from emission.core.common import calDistance, getDisplayModes
 from emission.analysis.modelling.tour_model.trajectory_matching.route_matching import fullMatchDistance,getRoute
 from emission.analysis.modelling.tour_model.trajectory_matching.LCS import lcsScore
-
-Sections=get_section_db()
+from emission.analysis.modelling.tour_model.trajectory_matching.route_distance_matrix import RouteDistanceMatrix
+from emission.analysis.modelling.tour_model.trajectory_matching.pairwise_distance import pairwise_distances, PairwiseDistances
 
 def user_route_data(user_id, database):
     data_feature = {}
@@ -62,7 +62,7 @@ def totalCost(data_feature,disMat2,medoids_idx):
     return(total_cost, medoids)
 
 
-def kmedoids(data_feature, k, user_id,method='lcs'):
+def kmedoids(data_feature, k, user_id,method='lcs',n_workers=None):
     '''
     kMedoids - PAM implemenation
     See more : http://en.wikipedia.org/wiki/K-medoids
@@ -74,13 +74,22 @@ def kmedoids(data_feature, k, user_id,method='lcs'):
             Swap m and o and compute the total cost of the configuration
     4. Select the configuration with the lowest cost.
     5. repeat steps 2 to 4 until there is no change in the medoid.
+
+    If n_workers is specified, the distances between the routes in
+    data_feature are computed in parallel using n_workers processes instead
+    of being read from the stored distance matrix of the user.
     '''
     
     if k >= len(data_feature):
         return (0, [], {})
 
     #disMat_user=get_routeDistanceMatrix_db().find_one({'$and':[{'user':user_id},{'method':method}]})['disMat']
-    disMat_user = get_routeDistanceMatrix_db(user_id, method)
+    if n_workers is None:
+        disMat_user = RouteDistanceMatrix(user_id, method)
+    else:
+        # same parameters as update_user_routeDistanceMatrix
+        disMat_user = PairwiseDistances(*pairwise_distances(data_feature,
+            fullMatchDistance, (100000, 100000, method, 1000), n_workers))
     #print(len(disMat_user))
     medoids_idx = random.sample([i for i in data_feature.keys()], k)
 
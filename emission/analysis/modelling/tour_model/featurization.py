@@ -1,8 +1,5 @@
 # Standard imports
 import logging
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import math
 import numpy
 from sklearn.cluster import KMeans
@@ -143,6 +140,10 @@ class featurization:
     #TODO - move this to a file in emission.analysis.plotting to map clusters from the database
     def map_clusters(self):
         import pygmaps
+        # matplotlib is slow to import, and only needed for plotting
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
         from matplotlib import colors as matcol
         colormap = plt.cm.get_cmap()
 
@@ -1,9 +1,6 @@
 # Standard imports
 import logging
 import math
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy
 from sklearn import metrics
 import sys
@@ -149,6 +146,10 @@ class similarity:
 
     #create the histogram
     def graph(self):
+        # matplotlib is slow to import, and only needed for plotting
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
         bars = [0] * len(self.bins)
         for i in range(len(self.bins)):
             bars[i] = len(self.bins[i])
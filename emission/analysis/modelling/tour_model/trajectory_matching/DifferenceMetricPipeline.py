@@ -6,10 +6,11 @@ import time
 
 # Our imports
 import emission.analysis.modelling.tour_model as eamt
+import emission.analysis.modelling.tour_model.trajectory_matching.pairwise_distance as eatp
 
-def pipeline(groundTruth, cluster_func, diff_metric, K_option = 'manual'):
+def pipeline(groundTruth, cluster_func, diff_metric, K_option = 'manual', n_workers = None):
     routeDict = getRouteDict(groundTruth)
-    differenceDict = getDifferenceDict(routeDict, diff_metric)
+    differenceDict = getDifferenceDict(routeDict, diff_metric, n_workers)
     if K_option == 'manual':
         K = len(groundTruth)
         medoids, clusters = cluster_func(routeDict, K, differenceDict)
@@ -23,8 +24,12 @@ def getRouteDict(routeDB):
             routeDict[_id] = eamt.route_matching.getRoute(_id)
     return routeDict
 
-def getDifferenceDict(routeDict, diff_metric = 'DTW'):
+def getDifferenceDict(routeDict, diff_metric = 'DTW', n_workers = None):
     #print 'calculating difference matrix ... '
+    if n_workers is not None:
+        # compute the distances in parallel, see pairwise_distance.py
+        return eatp.PairwiseDistances(*eatp.pairwise_distances(routeDict,
+                    diff_metric, n_workers=n_workers)).to_dict()
     ids = routeDict.keys()
     differences = {}
     for _id in ids:
@@ -116,6 +116,58 @@ def Frechet(R1,R2,varargin=None):
             f=q3
             break
     return f
+
+def _reachable(free):
+    '''
+    Returns True if there is a monotone path of free cells from the top left
+    to the bottom right of the boolean matrix "free", moving right, down or
+    diagonally. The matrix is processed one row at a time with numpy.
+    '''
+    # the first row can only be reached by moving right from (0,0)
+    row = np.logical_and.accumulate(free[0])
+    for i in range(1, free.shape[0]):
+        if not row.any():
+            return False
+        # reachable from above or from the upper left diagonal
+        fromAbove = row.copy()
+        fromAbove[1:] |= row[:-1]
+        seeds = np.cumsum(fromAbove & free[i])
+        # a cell is reachable if there is a seed between the last blocked
+        # cell on this row and itself, since we can then move right to it
+        lastBlocked = np.maximum.accumulate(np.where(free[i], 0, seeds))
+        row = free[i] & (seeds > lastBlocked)
+    return bool(row[-1])
+
+def discreteFrechet(R1, R2, threshold=None):
+    '''
+    Discrete Frechet distance between two lists of (lng,lat) points, in meters.
+
+    Instead of the per cell recursion, we binary search over the distinct
+    point distances for the smallest one that still allows a path through
+    the cells within that distance. Only the cells within the threshold (if
+    specified) are considered, and if the routes cannot be matched within
+    it, we return float('inf') without computing the exact distance.
+    '''
+    if len(R1) == 0 or len(R2) == 0:
+        return float('inf')
+    distances = ec.calDistanceMatrix(R1, R2)
+    # every path includes both endpoints
+    lowerBound = max(distances[0,0], distances[-1,-1])
+    candidates = np.unique(distances)
+    candidates = candidates[candidates >= lowerBound]
+    if threshold is not None:
+        if lowerBound > threshold or not _reachable(distances <= threshold):
+            return float('inf')
+        candidates = candidates[candidates <= threshold]
+
+    lo, hi = 0, len(candidates) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _reachable(distances <= candidates[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return candidates[lo]
 # R1=[]
 # R2=[]
 # for aa in range(0,51):
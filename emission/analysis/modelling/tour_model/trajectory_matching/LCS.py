@@ -1,3 +1,7 @@
+# Standard imports
+from __future__ import division
+import numpy as np
+
 # Our imports
 import emission.core.common as ec
 
@@ -6,7 +10,7 @@ def lcs(a, b,radiusBound):
     # row 0 and column 0 are initialized to 0 already
     for i, x in enumerate(a):
         for j, y in enumerate(b):
-            if calDistance(x,y)<=radiusBound:
+            if ec.calDistance(x,y)<=radiusBound:
                 lengths[i+1][j+1] = lengths[i][j] + 1
             else:
                 lengths[i+1][j+1] = \
@@ -30,3 +34,49 @@ def lcs(a, b,radiusBound):
 
 def lcsScore(route1, route2,radiusBound):
     return 1-lcs(route1, route2,radiusBound)/min(len(route1),len(route2))
+
+def bandedLcs(a, b, radiusBound, minLength=None):
+    '''
+    Same result as lcs(), but computed one row at a time with numpy.
+
+    Only the cells where the two points are within radiusBound can extend
+    the subsequence, so we compute all the distances at once and then, for
+    each point in a, only update the part of the row starting at its first
+    matching point in b. Rows with no matching point are skipped entirely.
+
+    If minLength is specified, we stop as soon as the remaining rows cannot
+    get the subsequence to minLength and return an upper bound on the length
+    (which is < minLength) instead of the exact value.
+    '''
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    matches = ec.calDistanceMatrix(a, b) <= radiusBound
+    # lengths[j] is lengths[i][j+1] in lcs(), lengths[i][0] is always 0
+    lengths = np.zeros(len(b), dtype=int)
+    nRows = len(a)
+    for i in range(nRows):
+        if minLength is not None and lengths[-1] + (nRows - i) < minLength:
+            return lengths[-1] + (nRows - i)
+        matchIdx = np.flatnonzero(matches[i])
+        if len(matchIdx) == 0:
+            continue
+        band = matchIdx[0]
+        # candidate from the diagonal for matching cells, from above otherwise
+        diag = np.concatenate(([0], lengths[:-1]))[band:] + 1
+        cand = np.where(matches[i, band:], diag, lengths[band:])
+        # the cell to the left is the running max along the row
+        lengths[band:] = np.maximum.accumulate(cand)
+    return lengths[-1]
+
+def bandedLcsScore(route1, route2, radiusBound, threshold=None):
+    '''
+    Same result as lcsScore(), using bandedLcs(). If threshold is specified,
+    the computation terminates early once the score is guaranteed to be
+    above the threshold, and returns a lower bound on the score (which is
+    > threshold) instead of the exact value.
+    '''
+    minLen = min(len(route1), len(route2))
+    minLength = None
+    if threshold is not None:
+        minLength = (1 - threshold) * minLen
+    return 1-bandedLcs(route1, route2, radiusBound, minLength)/minLen
@@ -0,0 +1,185 @@
+# Standard imports
+from __future__ import division
+import logging
+import multiprocessing
+import time
+import numpy as np
+
+# Our imports
+import emission.core.common as ec
+import emission.analysis.modelling.tour_model.trajectory_matching.DTW as eatd
+import emission.analysis.modelling.tour_model.trajectory_matching.LCS as eatl
+import emission.analysis.modelling.tour_model.trajectory_matching.Frechet as eatf
+
+# Computes the pairwise distances between all the routes in a route dict, in
+# the same order as scipy.spatial.distance.pdist, i.e. the "condensed" upper
+# triangle, row by row. The pairs are split into chunks that are processed by
+# a pool of worker processes.
+#
+# All the route coordinates are concatenated into a single numpy array with
+# an array of offsets into it. The workers get these arrays once, through the
+# pool initializer (which on unix just means that they are inherited by the
+# forked process) so the tasks only need to contain the chunk boundaries.
+
+def _dtw(route1, route2):
+    return eatd.Dtw(route1, route2, ec.calDistance).calculate_distance()
+
+def _new_dtw(route1, route2):
+    return eatd.dynamicTimeWarp(route1, route2)
+
+def _dtw_sym(route1, route2):
+    return eatd.DtwSym(route1, route2, ec.calDistance).calculate_distance()
+
+def _dtw_asym(route1, route2):
+    return eatd.DtwAsym(route1, route2, ec.calDistance).calculate_distance()
+
+def _lcs(route1, route2):
+    return eatl.bandedLcsScore(route1, route2, 2000)
+
+# Same names as DifferenceMetricPipeline.getDifferenceDict
+METRICS = {
+    'DTW': _dtw,
+    'newDTW': _new_dtw,
+    'DtwSym': _dtw_sym,
+    'DtwAsym': _dtw_asym,
+    'LCS': _lcs,
+    'Frechet': eatf.Frechet,
+    'discreteFrechet': eatf.discreteFrechet
+}
+
+_worker_coords = None
+_worker_offsets = None
+_worker_metric = None
+_worker_metric_args = None
+
+def _init_worker(coords, offsets, metric, metric_args):
+    global _worker_coords, _worker_offsets, _worker_metric, _worker_metric_args
+    _worker_coords = coords
+    _worker_offsets = offsets
+    _worker_metric = metric
+    _worker_metric_args = metric_args
+
+def _get_route(coords, offsets, i):
+    return coords[offsets[i]:offsets[i+1]].tolist()
+
+def _condensed_to_pair(n, k):
+    """
+    Returns the (i, j) row and column for the index k in the condensed
+    matrix for n routes. Works on numpy arrays of indices as well.
+    """
+    # row i starts at i * (2n - i - 1) / 2, so we invert that quadratic
+    i = np.floor((2 * n - 1 - np.sqrt((2 * n - 1) ** 2 - 8 * k)) / 2).astype(int)
+    # floating point can put us one row off near the row boundaries
+    row_start = i * (2 * n - i - 1) // 2
+    i = np.where(row_start > k, i - 1, i)
+    i = np.where((i + 1) * (2 * n - i - 2) // 2 <= k, i + 1, i)
+    j = k - i * (2 * n - i - 1) // 2 + i + 1
+    return (i, j)
+
+def _compute_chunk(bounds):
+    return _compute_chunk_for(_worker_coords, _worker_offsets,
+                              _worker_metric, _worker_metric_args, bounds)
+
+def _compute_chunk_for(coords, offsets, metric, metric_args, bounds):
+    (start, end) = bounds
+    n = len(offsets) - 1
+    (rows, cols) = _condensed_to_pair(n, np.arange(start, end))
+    metric_func = METRICS[metric] if metric in METRICS else metric
+    result = np.empty(end - start)
+    cache = {}
+    for (idx, (i, j)) in enumerate(zip(rows, cols)):
+        # consecutive pairs mostly share the first route, so we keep it around
+        if i not in cache:
+            cache = {i: _get_route(coords, offsets, i)}
+        result[idx] = metric_func(cache[i], _get_route(coords, offsets, j),
+                                  *metric_args)
+    return (start, result)
+
+def pairwise_distances(routeDict, metric, metric_args=(), n_workers=None, chunk_size=500):
+    """
+    Returns (ids, distances) where ids is the list of route ids and distances
+    is the condensed distance matrix between them.
+
+    metric is either one of the names in METRICS, or a module level function
+    that is called as metric(route1, route2, *metric_args).
+    If n_workers is None, we use one worker per CPU. If it is 1, we compute
+    everything in this process.
+    """
+    ids = list(routeDict.keys())
+    routes = [np.asarray(routeDict[_id], dtype=float).reshape(-1, 2) for _id in ids]
+    offsets = np.cumsum([0] + [len(route) for route in routes])
+    coords = np.concatenate(routes) if len(routes) > 0 else np.empty((0, 2))
+
+    n_pairs = len(ids) * (len(ids) - 1) // 2
+    distances = np.empty(n_pairs)
+    chunks = [(start, min(start + chunk_size, n_pairs))
+              for start in range(0, n_pairs, chunk_size)]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    start_time = time.time()
+    done = 0
+    def report_progress(result):
+        (start, chunk_result) = result
+        distances[start:start + len(chunk_result)] = chunk_result
+        elapsed = time.time() - start_time
+        logging.debug("Computed %d/%d %s distances, %.1f pairs/sec" %
+                      (done, n_pairs, metric, done / elapsed if elapsed > 0 else 0))
+
+    if n_workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(n_workers, _init_worker,
+                                    (coords, offsets, metric, metric_args))
+        try:
+            for result in pool.imap_unordered(_compute_chunk, chunks):
+                done += len(result[1])
+                report_progress(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            result = _compute_chunk_for(coords, offsets, metric, metric_args, chunk)
+            done += len(result[1])
+            report_progress(result)
+
+    elapsed = time.time() - start_time
+    logging.info("Computed %d %s distances between %d routes in %.2f secs (%.1f pairs/sec) with %d workers" %
+                 (n_pairs, metric, len(ids), elapsed, n_pairs / elapsed if elapsed > 0 else 0, n_workers))
+    return (ids, distances)
+
+class PairwiseDistances(object):
+    """
+    Wraps the result of pairwise_distances so that it can be indexed like the
+    dict of dicts returned by getDifferenceDict, e.g. distances[id1][id2]
+    """
+    def __init__(self, ids, distances):
+        self.ids = ids
+        self.distances = distances
+        self.id_map = dict((_id, idx) for (idx, _id) in enumerate(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, route_id):
+        return _DistanceRow(self, self.id_map[route_id])
+
+    def get_distance_by_index(self, i, j):
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        n = len(self.ids)
+        return float(self.distances[i * (2 * n - i - 1) // 2 + j - i - 1])
+
+    def to_dict(self):
+        return dict((id1, dict((id2, self.get_distance_by_index(i, j))
+                               for (j, id2) in enumerate(self.ids)))
+                    for (i, id1) in enumerate(self.ids))
+
+class _DistanceRow(object):
+    def __init__(self, matrix, idx):
+        self.matrix = matrix
+        self.idx = idx
+
+    def __getitem__(self, route_id):
+        return self.matrix.get_distance_by_index(self.idx, self.matrix.id_map[route_id])
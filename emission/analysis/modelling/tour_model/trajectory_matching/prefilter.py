@@ -0,0 +1,100 @@
+# Standard imports
+from __future__ import division
+import logging
+import math
+import numpy as np
+
+# Our imports
+import emission.core.common as ec
+
+# Cheap checks that reject pairs of routes that are obviously dissimilar
+# before we run the expensive point by point comparison. The checks are run
+# in order of increasing cost:
+# - bbox: the bounding boxes of the two routes, expanded by the match radius,
+#   do not overlap. No point of one route can then be within the radius of
+#   the other, so this never rejects a pair that would have matched.
+# - endpoints: neither route has both its start and end point within the
+#   radius of the other route. This is exactly the precondition of
+#   route_matching.route_matching, so it is also safe there.
+# - sample: we downsample both routes and compute the fraction of sampled
+#   points that are within the radius of the other route. This is only an
+#   estimate of the coverage of the full comparison, so the threshold passed
+#   in by the callers is lower than the one they use for the full match.
+#
+# Routes are lists of [lng, lat]. Since the callers compare points with the
+# interpolated routes (see refineRoute), a point is considered to be close to
+# a route if it is within the radius plus half the longest segment of one of
+# its points, which is true for any point that is close to a segment.
+# The number of pairs rejected by each check is kept in counts, so that the
+# thresholds can be tuned.
+
+METERS_PER_DEGREE = 111320
+
+class RoutePrefilter(object):
+    TIERS = ['bbox', 'endpoints', 'sample']
+
+    def __init__(self, sample_size=20):
+        self.sample_size = sample_size
+        self.reset()
+
+    def reset(self):
+        self.counts = dict((tier, 0) for tier in self.TIERS + ['passed'])
+
+    def reject(self, route1, route2, radius, endpoints=False, min_coverage=None):
+        """
+        Returns the name of the check that rejected the pair, or None if the
+        pair needs to be compared in full. The endpoints check is only run if
+        endpoints is True, and the sample check only if min_coverage is set.
+        """
+        route1 = np.asarray(route1, dtype=float).reshape(-1, 2)
+        route2 = np.asarray(route2, dtype=float).reshape(-1, 2)
+        if len(route1) == 0 or len(route2) == 0:
+            return None
+
+        tier = None
+        if not _bbox_overlap(route1, route2, radius):
+            tier = 'bbox'
+        elif endpoints and not (_near_route(route1[[0, -1]], route2, radius).all() or
+                                _near_route(route2[[0, -1]], route1, radius).all()):
+            tier = 'endpoints'
+        elif min_coverage is not None and \
+                max(_near_route(_sample(route1, self.sample_size), route2, radius).mean(),
+                    _near_route(_sample(route2, self.sample_size), route1, radius).mean()) < min_coverage:
+            tier = 'sample'
+
+        if tier is None:
+            self.counts['passed'] += 1
+        else:
+            self.counts[tier] += 1
+        return tier
+
+    def log_counts(self):
+        logging.info("Route prefilter counts: %s" % self.counts)
+
+def _bbox_overlap(route1, route2, radius):
+    max_lat = max(np.abs(route1[:,1]).max(), np.abs(route2[:,1]).max())
+    dlat = radius / METERS_PER_DEGREE
+    # a degree of longitude is shortest at the highest latitude
+    dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(max_lat)), 1e-6))
+    min1, max1 = route1.min(axis=0), route1.max(axis=0)
+    min2, max2 = route2.min(axis=0), route2.max(axis=0)
+    return (min1[0] - dlng <= max2[0] and min2[0] - dlng <= max1[0] and
+            min1[1] - dlat <= max2[1] and min2[1] - dlat <= max1[1])
+
+def _near_route(points, route, radius):
+    """
+    Returns a boolean array, True for the points that are within the radius
+    of a point or a segment of the route
+    """
+    if len(route) > 1:
+        slack = np.sqrt(((route[1:] - route[:-1]) ** 2).sum(axis=1)).max()
+        # convert the slack in degrees to meters, the longitude is an overestimate
+        slack = slack * METERS_PER_DEGREE / 2
+    else:
+        slack = 0
+    return ec.calDistanceMatrix(points, route).min(axis=1) <= radius + slack
+
+def _sample(route, sample_size):
+    if len(route) <= sample_size:
+        return route
+    return route[np.linspace(0, len(route) - 1, sample_size).astype(int)]
@@ -0,0 +1,183 @@
+# Standard imports
+import logging
+import os
+import json
+import multiprocessing
+import numpy as np
+
+# Compact on-disk storage for the pairwise route distance matrix of a user.
+#
+# The distances are stored as float32 in a flat binary file, which contains
+# the strict upper triangle of the matrix column by column, i.e. the distance
+# between the routes with indices i < j is at position j * (j - 1) / 2 + i.
+# Adding a new route only appends a new column at the end of the file, so we
+# never rewrite existing distances. The ids of the routes, in index order, are
+# stored in a separate json file, whose length defines the number of valid
+# columns. Since the ids are written after the distances, a crash in the
+# middle of an append just leaves some unused bytes at the end of the file.
+#
+# The matrix is assumed to be symmetric, i.e. the distance between i and j is
+# the distance_func(route_i, route_j) with i < j, and the distance from a
+# route to itself is 0.
+
+MATRIX_DIR = 'routeDistanceMatrices'
+
+# Used by the worker processes to compute new columns. Since we pass the
+# routes in the initializer, they are pickled once per worker instead of
+# once per task.
+_worker_routes = None
+_worker_distance_func = None
+_worker_func_args = None
+
+def _init_worker(routes, distance_func, func_args):
+    global _worker_routes, _worker_distance_func, _worker_func_args
+    _worker_routes = routes
+    _worker_distance_func = distance_func
+    _worker_func_args = func_args
+
+def _compute_column(j):
+    return _compute_column_for(_worker_routes, _worker_distance_func,
+                               _worker_func_args, j)
+
+def _compute_column_for(routes, distance_func, func_args, j):
+    column = np.empty(j, dtype=np.float32)
+    for i in range(j):
+        column[i] = distance_func(routes[i], routes[j], *func_args)
+    return column
+
+class RouteDistanceMatrix(object):
+    def __init__(self, user_id, method, dirname=MATRIX_DIR):
+        self.user_id = user_id
+        self.method = method
+        prefix = os.path.join(dirname, '%s_%s_routeDistanceMatrix' % (user_id, method))
+        self.values_file = prefix + '.bin'
+        self.ids_file = prefix + '_ids.json'
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        if os.path.exists(self.ids_file):
+            with open(self.ids_file) as fp:
+                self.ids = json.load(fp)
+        else:
+            self.ids = []
+        self.id_map = dict((_id, idx) for (idx, _id) in enumerate(self.ids))
+        self._load_values()
+
+    def _load_values(self):
+        n_values = self._n_values(len(self.ids))
+        if n_values == 0:
+            self.values = np.empty(0, dtype=np.float32)
+        else:
+            self.values = np.memmap(self.values_file, dtype=np.float32,
+                                    mode='r', shape=(n_values,))
+
+    @staticmethod
+    def _n_values(n_routes):
+        return n_routes * (n_routes - 1) // 2
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, route_id):
+        return str(route_id) in self.id_map
+
+    def __getitem__(self, route_id):
+        """
+        Allows the matrix to be used like the old dict of dicts,
+        e.g. matrix[id1][id2]
+        """
+        return _MatrixRow(self, self.index(route_id))
+
+    def index(self, route_id):
+        return self.id_map[str(route_id)]
+
+    def get_distance(self, id1, id2):
+        return self.get_distance_by_index(self.index(id1), self.index(id2))
+
+    def get_distance_by_index(self, i, j):
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        return float(self.values[self._n_values(j) + i])
+
+    def to_square(self, route_ids=None):
+        """
+        Returns a square numpy array with the distances between route_ids (all
+        the routes in the matrix by default), in the specified order.
+        """
+        if route_ids is None:
+            idx = np.arange(len(self.ids))
+        else:
+            idx = np.array([self.index(_id) for _id in route_ids], dtype=int)
+        lo = np.minimum(idx[:, np.newaxis], idx[np.newaxis, :])
+        hi = np.maximum(idx[:, np.newaxis], idx[np.newaxis, :])
+        square = np.zeros((len(idx), len(idx)), dtype=np.float32)
+        offdiag = lo != hi
+        square[offdiag] = self.values[hi[offdiag] * (hi[offdiag] - 1) // 2 + lo[offdiag]]
+        return square
+
+    def append_routes(self, route_dict, distance_func, func_args=(), n_workers=None):
+        """
+        Adds the routes in route_dict that are not already in the matrix.
+        Only the distances involving the new routes are computed, using
+        distance_func(route1, route2, *func_args), in a pool of n_workers
+        processes if n_workers > 1. The distance_func must be picklable,
+        i.e. a module level function.
+        The routes that are already in the matrix are needed to compute
+        their distances to the new routes, and the distances are never
+        recomputed, so route_dict must have all of them. Otherwise, raises
+        a ValueError without changing the matrix.
+        Returns the number of routes that were added.
+        """
+        new_ids = [_id for _id in route_dict.keys() if str(_id) not in self.id_map]
+        if len(new_ids) == 0:
+            return 0
+
+        str_to_key = dict((str(_id), _id) for _id in route_dict.keys())
+        missing_ids = [_id for _id in self.ids if _id not in str_to_key]
+        if len(missing_ids) > 0:
+            raise ValueError("%d routes in the matrix for %s are not in route_dict, e.g. %s" %
+                             (len(missing_ids), self.user_id, missing_ids[0]))
+        all_routes = [route_dict[str_to_key[_id]] for _id in self.ids]
+        all_routes.extend([route_dict[_id] for _id in new_ids])
+
+        n_old = len(self.ids)
+        new_columns = range(n_old, len(all_routes))
+        logging.debug("Adding %d routes to the %d existing routes for %s" %
+                      (len(new_ids), n_old, self.user_id))
+
+        # The values file may have unused bytes at the end if we crashed
+        # while appending before, so we truncate it before adding new columns
+        with open(self.values_file, 'ab') as fp:
+            fp.truncate(self._n_values(n_old) * np.dtype(np.float32).itemsize)
+            if n_workers is not None and n_workers > 1:
+                pool = multiprocessing.Pool(n_workers, _init_worker,
+                                            (all_routes, distance_func, func_args))
+                try:
+                    for column in pool.imap(_compute_column, new_columns):
+                        fp.write(column.tobytes())
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for j in new_columns:
+                    column = _compute_column_for(all_routes, distance_func, func_args, j)
+                    fp.write(column.tobytes())
+
+        self.ids.extend([str(_id) for _id in new_ids])
+        tmp_ids_file = self.ids_file + '.tmp'
+        with open(tmp_ids_file, 'w') as fp:
+            json.dump(self.ids, fp)
+        os.rename(tmp_ids_file, self.ids_file)
+        self.id_map = dict((_id, idx) for (idx, _id) in enumerate(self.ids))
+        self._load_values()
+        return len(new_ids)
+
+class _MatrixRow(object):
+    def __init__(self, matrix, idx):
+        self.matrix = matrix
+        self.idx = idx
+
+    def __getitem__(self, route_id):
+        return self.matrix.get_distance_by_index(self.idx, self.matrix.index(route_id))
@@ -4,31 +4,36 @@ import urllib,json,csv
 import xml.etree.cElementTree as ET
 import urllib2
 import time
+import logging
 
 # Our imports
 import emission.core.common as ec
 import emission.core.get_database as edb
+import emission.core.spatial_grid as esg
 import emission.analysis.modelling.tour_model.trajectory_matching as eatm
+import emission.analysis.modelling.tour_model.trajectory_matching.LCS
+import emission.analysis.modelling.tour_model.trajectory_matching.Frechet
+import emission.analysis.modelling.tour_model.trajectory_matching.route_distance_matrix as eatr
+import emission.analysis.modelling.tour_model.trajectory_matching.prefilter as eatpf
+
+# Shared by all the matching functions below, so that the rejection counts
+# can be checked with route_prefilter.counts when tuning
+route_prefilter = eatpf.RoutePrefilter()
+# The sample check only looks at a few points, so we only reject pairs whose
+# estimated coverage is well below what the full match needs
+SAMPLE_COVERAGE_RATIO = 0.5
 
 def find_near(lst,pnt,radius):
-    near=[]
-    for i in range(len(lst)):
-        # print(ec.calDistance(lst[i],pnt))
-        if ec.calDistance(lst[i],pnt)<radius:
-            near.append(i)
-    return near
+    if len(lst) == 0:
+        return []
+    distances=ec.calDistanceMatrix(lst,[pnt])[:,0]
+    return np.flatnonzero(distances<radius).tolist()
 
 def find_nearest(lst,pnt):
-    nearest=lst[0]
-    dis=99999999
-    for i in range(len(lst)):
-        # print(ec.calDistance(lst[i],pnt))
-        new_dis=ec.calDistance(lst[i],pnt)
-        if new_dis<dis:
-            dis=new_dis
-            nearest=lst[i]
-    print(dis)
-    return nearest
+    distances=ec.calDistanceMatrix(lst,[pnt])[:,0]
+    idx=distances.argmin()
+    print(distances[idx])
+    return lst[idx]
 
 def cal_matching_score(lst1,lst2,radius):
     len1=len(lst1)
@@ -49,11 +54,16 @@ def cal_matching_score(lst1,lst2,radius):
     score=count/max_len
     return score
 
-def route_matching(lst1,lst2,step,radius,len_match,min_score):
+def route_matching(lst1,lst2,step,radius,len_match,min_score,prefilter=True):
     # input 2 lists of tracking points, each tracking points is geojson format
     # the two lists must have at least two tracking points
     if len(lst1)<2 or len(lst2)<2:
         return False
+    if prefilter and route_prefilter.reject(
+            [pnt['track_location']['coordinates'] for pnt in lst1],
+            [pnt['track_location']['coordinates'] for pnt in lst2],
+            radius, endpoints=True, min_coverage=SAMPLE_COVERAGE_RATIO*min_score) is not None:
+        return False
     start_pnt1=lst1[0]
     end_pnt1=lst1[-1]
     start_pnt2=lst2[0]
@@ -145,53 +155,24 @@ def route_matching(lst1,lst2,step,radius,len_match,min_score):
     else:
         return False
 
-def route_matching_2(lst1,lst2,step,radius,min_score):
+def route_matching_2(lst1,lst2,step,radius,min_score,prefilter=True):
     # input 2 lists of tracking points, each tracking points is geojson format
     # the two lists must have at least two tracking points
     if len(lst1)<2 or len(lst2)<2:
         return False
-    start_pnt1=lst1[0]
-    end_pnt1=lst1[-1]
-    start_pnt2=lst2[0]
-    end_pnt2=lst2[-1]
-    # Case 1, lst2 is part of lst1:
-    lst1_extended=[]
-    for i in range(len(lst1)-1):
-        dis=ec.calDistance(lst1[i]['track_location']['coordinates'],lst1[i+1]['track_location']['coordinates'])
-        num_inter=int(round(dis/step))
-        if num_inter==0:
-            lst1_extended.append(lst1[i]['track_location']['coordinates'])
-        else:
-            lon_list=np.linspace(lst1[i]['track_location']['coordinates'][0],lst1[i+1]['track_location']['coordinates'][0],num_inter,False)
-            lat_list=np.linspace(lst1[i]['track_location']['coordinates'][1],lst1[i+1]['track_location']['coordinates'][1],num_inter,False)
-            for j in range(len(lon_list)):
-                lst1_extended.append([lon_list[j],lat_list[j]])
-    lst1_extended.append(end_pnt1['track_location']['coordinates'])
-    lst2_extended=[]
-    for i in range(len(lst2)-1):
-        dis=ec.calDistance(lst2[i]['track_location']['coordinates'],lst2[i+1]['track_location']['coordinates'])
-        num_inter=int(round(dis/step))
-        if num_inter==0:
-            lst2_extended.append(lst2[i]['track_location']['coordinates'])
-        else:
-            lon_list=np.linspace(lst2[i]['track_location']['coordinates'][0],lst2[i+1]['track_location']['coordinates'][0],num_inter,False)
-            lat_list=np.linspace(lst2[i]['track_location']['coordinates'][1],lst2[i+1]['track_location']['coordinates'][1],num_inter,False)
-            for j in range(len(lon_list)):
-                lst2_extended.append([lon_list[j],lat_list[j]])
-    lst2_extended.append(end_pnt2['track_location']['coordinates'])
+    route1=[pnt['track_location']['coordinates'] for pnt in lst1]
+    route2=[pnt['track_location']['coordinates'] for pnt in lst2]
+    if prefilter and route_prefilter.reject(route1, route2,
+            radius, min_coverage=SAMPLE_COVERAGE_RATIO*min_score) is not None:
+        return False
 
-    # print(len(lst1_extended))
-    # print(len(lst2_extended))
     best_score=[]
-    score_2_in_1=0
-    for point2 in lst2:
-        if ec.Include_place_2(lst1_extended,point2['track_location']['coordinates'],radius):
-            score_2_in_1+=1
+    # The grids are over the routes with extra points every step meters
+    (nearest, distances)=get_route_grid(route1,radius,step).nearest_within(route2,radius)
+    score_2_in_1=np.count_nonzero(nearest>=0)
     best_score.append(score_2_in_1/len(lst2))
-    score_1_in_2=0
-    for point1 in lst1:
-        if ec.Include_place_2(lst2_extended,point1['track_location']['coordinates'],radius):
-            score_1_in_2+=1
+    (nearest, distances)=get_route_grid(route2,radius,step).nearest_within(route1,radius)
+    score_1_in_2=np.count_nonzero(nearest>=0)
     best_score.append(score_1_in_2/len(lst1))
     print(best_score)
     if max(best_score)>min_score:
@@ -228,6 +209,27 @@ def refineRoute(lst1,step):
     # print(len(lst1_extended))
     return lst1_extended
 
+# The grids over the routes, so that matching a route against many sections
+# builds its grid only once. They are keyed on the points of the route, since
+# the callers read the routes from the database again for every match.
+MAX_ROUTE_GRIDS = 1000
+_route_grids = {}
+
+def get_route_grid(route,radius,step=None):
+    """
+    Returns a SpatialGrid over the (lng, lat) points of the route, or over
+    refineRoute(route,step) if step is not None
+    """
+    key=(tuple(tuple(point) for point in route),radius,step)
+    grid=_route_grids.get(key)
+    if grid is None:
+        points=route if step is None else refineRoute(route,step)
+        grid=esg.SpatialGrid(points,radius)
+        if len(_route_grids)>=MAX_ROUTE_GRIDS:
+            _route_grids.clear()
+        _route_grids[key]=grid
+    return grid
+
 def storeTransitStop(type,route):
     Transit=edb.get_transit_db()
     todo={}
@@ -339,15 +341,21 @@ def existingMatchDistance(route1,route2,step1=100000,step2=100000,method='lcs',r
                     new_dis=eatm.Frechet.Frechet(refineRoute(route1[start_route1:end_route1+1],step1),refineRoute(route2[start_route2:end_route2+1],step2))
                 elif end_route1<start_route1:
                     new_dis=eatm.Frechet.Frechet(refineRoute(route1[end_route1:start_route1+1][::-1],step1),refineRoute(route2[start_route2:end_route2+1],step2))
+        ## using discrete Frechet
+            if method=='discreteFrechet':
+                if start_route1<end_route1:
+                    new_dis=eatm.Frechet.discreteFrechet(refineRoute(route1[start_route1:end_route1+1],step1),refineRoute(route2[start_route2:end_route2+1],step2))
+                elif end_route1<start_route1:
+                    new_dis=eatm.Frechet.discreteFrechet(refineRoute(route1[end_route1:start_route1+1][::-1],step1),refineRoute(route2[start_route2:end_route2+1],step2))
         ## using lcs
             if method=='lcs':
                 if start_route1<end_route1:
-                    new_dis=eatm.LCS.lcsScore(refineRoute(route1[start_route1:end_route1+1],step1),refineRoute(route2[start_route2:end_route2+1],step2),radius1)
+                    new_dis=eatm.LCS.bandedLcsScore(refineRoute(route1[start_route1:end_route1+1],step1),refineRoute(route2[start_route2:end_route2+1],step2),radius1)
                 elif end_route1<start_route1:
                     # print(route1[start_route1:end_route1-1])
                     # print(start_route1,end_route1)
                     # print(len(route1[start_route1:end_route1-1:-1]))
-                    new_dis=eatm.LCS.lcsScore(refineRoute(route1[end_route1:start_route1+1][::-1],step1),refineRoute(route2[start_route2:end_route2+1],step2),radius1)
+                    new_dis=eatm.LCS.bandedLcsScore(refineRoute(route1[end_route1:start_route1+1][::-1],step1),refineRoute(route2[start_route2:end_route2+1],step2),radius1)
             if new_dis<dis:
                 dis=new_dis
 
@@ -381,9 +389,12 @@ def fullMatchDistance(route1,route2,step1=100000,step2=100000,method='lcs',radiu
 ## using Frechet
     if method=='Frechet':
         new_dis=eatm.Frechet.Frechet(refineRoute(route1,step1),refineRoute(route2,step2))
+## using discrete Frechet
+    if method=='discreteFrechet':
+        new_dis=eatm.Frechet.discreteFrechet(refineRoute(route1,step1),refineRoute(route2,step2))
 ## using lcs
     if method=='lcs':
-        new_dis=eatm.LCS.lcsScore(refineRoute(route1,step1),refineRoute(route2,step2),radius1)
+        new_dis=eatm.LCS.bandedLcsScore(refineRoute(route1,step1),refineRoute(route2,step2),radius1)
     if new_dis<dis:
         dis=new_dis
 
@@ -398,61 +409,44 @@ def matchTransitRoutes(lst,route,step1=100000,step2=100000,method='lcs',radius1=
         return 0
 
 def matchTransitStops(lst,route,radius1=2000):
-    if ec.Include_place_2(route,lst[0],radius1) and ec.Include_place_2(route,lst[-1],radius1):
+    # route can also be a SpatialGrid over the stops
+    if not isinstance(route, esg.SpatialGrid):
+        route=get_route_grid(route,radius1)
+    (nearest, distances)=route.nearest_within([lst[0],lst[-1]],radius1)
+    if (nearest>=0).all():
         return 1
     else:
         return 0
 
-def matchTwoRoutes(route1,route2,step1=100000,step2=100000,method='lcs',radius1=2000,threshold=0.6):
-    [final_start,final_end,dis]=fullMatchDistance(route1,route2,step1,step2,method,radius1)
+def matchTwoRoutes(route1,route2,step1=100000,step2=100000,method='lcs',radius1=2000,threshold=0.6,prefilter=True):
+    # The lcs score can only be <= threshold if at least (1 - threshold) of
+    # the points of the shorter route are within radius1 of the other route.
+    # The other methods don't use radius1, so we can't prefilter them.
+    if prefilter and method=='lcs' and len(route1)>=2 and len(route2)>=2 and \
+            route_prefilter.reject(route1, route2, radius1,
+                min_coverage=SAMPLE_COVERAGE_RATIO*(1-threshold)) is not None:
+        return 0
+    dis=fullMatchDistance(route1,route2,step1,step2,method,radius1)
     if dis<=threshold:
         return 1
     else:
         return 0
 
-def update_user_routeDistanceMatrix(user_id,data_feature,step1=100000,step2=100000,method='lcs',radius1=1000):
-    ids = data_feature.keys()
+def update_user_routeDistanceMatrix(user_id,data_feature,step1=100000,step2=100000,method='lcs',radius1=1000,n_workers=None):
     """
-    user_query=edb.get_routeDistanceMatrix_db().find_one({'$and':[{'user':user_id},{'method':method}]})
-    if user_query==None:
-        user_disMat={}
-        for _id in ids:
-            user_disMat[_id] = {}
-        edb.get_routeDistanceMatrix_db().insert({'user':user_id,'method':method,'disMat':user_disMat})
-    else:
-        user_disMat=user_query['disMat']
+    Adds the routes in data_feature that are not already in the stored
+    distance matrix for this user and method. Only the distances to the new
+    routes are computed, optionally in a pool of n_workers processes.
+    Returns the RouteDistanceMatrix, which can be indexed like the old
+    dict of dicts, e.g. user_disMat[id1][id2]
     """
-    user_disMat = edb.get_routeDistanceMatrix_db(user_id, method)
-
-    a=0
-
-    # print(len(ids))
-    for _id in ids:
-        if a % 100 == 0:
-            print "In update_user_routeDistanceMatrix, a = %d" % a
-        a+=1
-        for key in ids:
-            try:
-                user_disMat[_id][key]
-                #print("found it")
-            except KeyError:
-                #print('Updating matrix for the trip ' + _id + '. Doing calculations.')
-                dis=fullMatchDistance(data_feature[_id], data_feature[key],step1,step2,method,radius1)
-                #user_disMat[_id] = {}
-                if _id not in user_disMat:
-                    user_disMat[_id] = {}
-                user_disMat[_id][key] = dis
-                #print('Update successful.')
-                #print(user_disMat[_id])
-
-    #edb.get_routeDistanceMatrix_db().update({'$and':[{'user':user_id},{'method':method}]},{'user':user_id,'method':method,'disMat':user_disMat})
-    print(type(user_disMat))
-    user_disMat = edb.update_routeDistanceMatrix_db(user_id, method, user_disMat)
+    user_disMat = eatr.RouteDistanceMatrix(user_id, method)
+    n_added = user_disMat.append_routes(data_feature, fullMatchDistance,
+                                        (step1, step2, method, radius1), n_workers)
+    logging.debug("In update_user_routeDistanceMatrix, added %d routes, matrix size = %d" %
+                  (n_added, len(user_disMat)))
     return user_disMat
 
-    # for entry in edb.get_routeDistanceMatrix_db().find():
-    #     print(entry)
-
 def update_user_routeClusters(user_id,clusters,method='lcs'):
     user_query=edb.get_routeCluster_db().find_one({'$and':[{'user':user_id},{'method':method}]})
     if user_query==None:
@@ -0,0 +1,105 @@
+# Standard imports
+from __future__ import division
+import logging
+import numpy as np
+from sklearn.neighbors import BallTree
+
+# Our imports
+import emission.core.get_database as edb
+import emission.analysis.modelling.tour_model.trajectory_matching.route_matching as eatrm
+
+# Spatial index over the stops of all the transit routes in the transit
+# database, so that we can find the routes near a section with a few batched
+# nearest neighbor queries instead of looping over every route and every
+# point. The index is built the first time it is needed and then shared by
+# all the callers in the process, use get_transit_index(reload=True) after
+# the transit database changes.
+
+EARTH_RADIUS = 6371000
+
+_transit_index = None
+
+def get_transit_index(reload=False):
+    global _transit_index
+    if _transit_index is None or reload:
+        _transit_index = TransitIndex(list(edb.get_transit_db().find()))
+    return _transit_index
+
+class TransitIndex(object):
+    def __init__(self, entries):
+        """
+        entries is a list of transit routes, in the format stored by
+        route_matching.storeTransitStop, i.e. {'type', 'route', 'stops'}
+        """
+        self.entries = entries
+        self.types = sorted(set([entry['type'] for entry in entries]))
+        stops = []
+        stop_entries = []
+        stop_idx = []
+        for (i, entry) in enumerate(entries):
+            stops.extend(entry['stops'])
+            stop_entries.extend([i] * len(entry['stops']))
+            stop_idx.extend(range(len(entry['stops'])))
+        # the stop in the tree with index k is entries[stop_entries[k]]['stops'][stop_idx[k]]
+        self.stop_entries = np.array(stop_entries, dtype=int)
+        self.stop_idx = np.array(stop_idx, dtype=int)
+        if len(stops) > 0:
+            self.tree = BallTree(_to_radians(stops), metric='haversine')
+        else:
+            self.tree = None
+        logging.debug("Built transit index with %d stops for %d routes" %
+                      (len(stops), len(entries)))
+
+    def _stops_near(self, points, radius):
+        """
+        Returns a list with, for each point, the indices of the stops that
+        are within radius meters of it
+        """
+        if self.tree is None or len(points) == 0:
+            return [np.zeros(0, dtype=int) for point in points]
+        return self.tree.query_radius(_to_radians(points), radius / EARTH_RADIUS)
+
+    def _empty_match(self):
+        return dict((type, 0) for type in self.types)
+
+    def stop_match(self, route_seg, radius):
+        """
+        Same result as transit_stop_match_score, i.e. for each transit type,
+        1 if the start and the end of the route are both close to the stops
+        of the same transit route, 0 otherwise
+        """
+        transitMatch = self._empty_match()
+        if len(route_seg) == 0:
+            return transitMatch
+        (near_start, near_end) = self._stops_near([route_seg[0], route_seg[-1]], radius)
+        matched_entries = set(self.stop_entries[near_start]) & set(self.stop_entries[near_end])
+        for i in matched_entries:
+            transitMatch[self.entries[i]['type']] = 1
+        return transitMatch
+
+    def route_match(self, route_seg, step1, step2, method, radius1, threshold):
+        """
+        Same result as transit_route_match_score. existingMatchDistance only
+        compares the part of the transit route between the first and the last
+        stops that are within radius1 of the section, and returns no match if
+        they are not more than one stop apart. So we use the index to find
+        the candidate routes and only run the full match on them.
+        """
+        transitMatch = self._empty_match()
+        if len(route_seg) < 2:
+            return transitMatch
+        near_stops = np.unique(np.concatenate(self._stops_near(route_seg, radius1)).astype(int))
+        candidates = {}
+        for k in near_stops:
+            candidates.setdefault(self.stop_entries[k], []).append(self.stop_idx[k])
+        for i in sorted(candidates.keys()):
+            entry = self.entries[i]
+            if transitMatch[entry['type']] == 1 or max(candidates[i]) - min(candidates[i]) <= 1:
+                continue
+            transitMatch[entry['type']] = eatrm.matchTransitRoutes(route_seg,
+                entry['stops'], step1, step2, method, radius1, threshold)
+        return transitMatch
+
+def _to_radians(points):
+    # BallTree expects (lat, lng)
+    return np.radians(np.asarray(points, dtype=float).reshape(-1, 2)[:, ::-1])
@@ -0,0 +1,129 @@
+# Standard imports
+import logging
+
+# Our imports
+
+# A compact version of the trip geojsons from geojson_feature_converter, for
+# the clients that ask for it (the compact_geojson flag in the request). The
+# full version has a point feature with all the location fields for every
+# point of every section, which makes the diary very large to send and to
+# serialize.
+#
+# In the compact version, each section (a feature collection of the point
+# features and the line feature) is replaced by a single feature with no
+# geometry, whose properties are the properties of the line feature, except
+# that:
+# - the coordinates of the line are in "encoded_polyline", in the google
+#   polyline format with POLYLINE_PRECISION digits. Like the line, it starts
+#   with the start place of the trip for the first section, so it may have one
+#   more point than the lists below.
+# - "ts" has the (integer) timestamps of the points, as the first timestamp
+#   followed by the differences from the previous point
+# - "speeds" and "distances" are multiplied by VALUE_SCALE and rounded
+# The places and stops are unchanged.
+#
+# The conversion works on the stored geojson too, so the full version is the
+# only one that is stored, and the compact version is generated when it is
+# sent.
+
+POLYLINE_PRECISION = 5
+VALUE_SCALE = 10
+COMPACT_FORMAT = "compact_v1"
+
+def compact_trip_list(trip_gj_list):
+    return [compact_trip(trip_gj) for trip_gj in trip_gj_list]
+
+def compact_trip(trip_gj):
+    """
+    Returns the compact version of the trip geojson, without changing it
+    """
+    ret_trip = dict(trip_gj)
+    ret_trip["properties"] = dict(trip_gj["properties"])
+    ret_trip["properties"]["format"] = COMPACT_FORMAT
+    ret_trip["features"] = [compact_section(feature) if _is_section(feature) else feature
+                            for feature in trip_gj["features"]]
+    return ret_trip
+
+def compact_section(section_gj):
+    points = []
+    line_feature = None
+    for feature in section_gj["features"]:
+        if feature["type"] == "FeatureCollection":
+            points = feature["features"]
+        elif feature["properties"].get("feature_type") == "section":
+            line_feature = feature
+    if line_feature is None:
+        logging.warning("section %s does not have a line, not compacting it" % section_gj)
+        return section_gj
+
+    ret_feature = {"type": "Feature", "geometry": None}
+    if "id" in line_feature:
+        ret_feature["id"] = line_feature["id"]
+    properties = dict(line_feature["properties"])
+    properties["encoded_polyline"] = encode_polyline(line_feature["geometry"]["coordinates"])
+    properties["ts"] = _delta_encode([int(round(point["properties"]["ts"])) for point in points])
+    properties["speeds"] = [_scale(speed) for speed in line_feature["properties"]["speeds"]]
+    properties["distances"] = [_scale(distance) for distance in line_feature["properties"]["distances"]]
+    ret_feature["properties"] = properties
+    return ret_feature
+
+def encode_polyline(coordinates, precision = POLYLINE_PRECISION):
+    """
+    Encodes the geojson [lng, lat] coordinates with the google polyline
+    algorithm, which stores the differences in (lat, lng) from the previous
+    point in 5 bit chunks
+    """
+    factor = 10 ** precision
+    encoded = []
+    (prev_lat, prev_lng) = (0, 0)
+    for coordinate in coordinates:
+        lat = int(round(coordinate[1] * factor))
+        lng = int(round(coordinate[0] * factor))
+        encoded.append(_encode_value(lat - prev_lat))
+        encoded.append(_encode_value(lng - prev_lng))
+        (prev_lat, prev_lng) = (lat, lng)
+    return "".join(encoded)
+
+def decode_polyline(encoded, precision = POLYLINE_PRECISION):
+    """
+    Returns the [lng, lat] coordinates of the encoded polyline
+    """
+    factor = float(10 ** precision)
+    values = []
+    (curr_value, shift) = (0, 0)
+    for c in encoded:
+        chunk = ord(c) - 63
+        curr_value = curr_value | ((chunk & 0x1f) << shift)
+        shift = shift + 5
+        if chunk < 0x20:
+            values.append(~(curr_value >> 1) if curr_value & 1 else curr_value >> 1)
+            (curr_value, shift) = (0, 0)
+
+    coordinates = []
+    (lat, lng) = (0, 0)
+    for i in range(0, len(values) - 1, 2):
+        lat = lat + values[i]
+        lng = lng + values[i + 1]
+        coordinates.append([lng / factor, lat / factor])
+    return coordinates
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value = value >> 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+def _delta_encode(values):
+    return values[:1] + [curr - prev for (prev, curr) in zip(values, values[1:])]
+
+def _scale(value):
+    # nan != nan
+    if value != value:
+        return 0
+    return int(round(value * VALUE_SCALE))
+
+def _is_section(feature):
+    return feature["type"] == "FeatureCollection"
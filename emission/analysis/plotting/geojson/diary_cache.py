@@ -0,0 +1,107 @@
+# Standard imports
+import logging
+import calendar
+import time
+import datetime as pydt
+import dateutil.parser as dup
+
+# Our imports
+import emission.core.get_database as edb
+import emission.core.wrapper.pipelinestate as ps
+import emission.storage.pipeline_queries as esp
+import emission.analysis.plotting.geojson.geojson_feature_converter as gfc
+
+# Materialized views of the diary (the list of trip geojsons) for each user
+# and local day, so that the timeline endpoint and the usercache push do not
+# regenerate the geojson for the same day again and again.
+#
+# The geojson for a day only changes when the pipeline creates or smooths the
+# sections for that day. So each entry stores the watermarks
+# (last_processed_ts) of the stages in WATERMARK_STAGES when it was computed,
+# and it is recomputed only if a watermark has since moved across the day.
+# The days are local days and the watermarks are timestamps, so the range of
+# timestamps for a day is extended by DAY_SLACK on each side, which covers
+# any timezone and the trips that cross midnight.
+#
+# Each entry is {user_id, day ("2016-01-01"), geojson, watermarks: {stage
+# name: ts}, computed_ts}.
+
+WATERMARK_STAGES = [ps.PipelineStages.SECTION_SEGMENTATION, ps.PipelineStages.JUMP_SMOOTHING]
+DAY_SLACK = 24 * 60 * 60
+
+def get_diary_for_day(user_id, day, force_refresh = False):
+    """
+    Returns the list of trip geojsons for the local day, which is a string
+    such as "2016-01-01". With force_refresh, the geojson is recomputed even
+    if the stored one is still valid.
+    """
+    return get_diary_for_days(user_id, [day], force_refresh)[day]
+
+def get_diary_for_days(user_id, days, force_refresh = False):
+    """
+    Returns a map from each of the days to its list of trip geojsons, reading
+    all the stored entries at once
+    """
+    watermarks = get_curr_watermarks(user_id)
+    if force_refresh:
+        entries = {}
+    else:
+        entries = dict((entry["day"], entry) for entry in edb.get_diary_cache_db().find(
+            {"user_id": user_id, "day": {"$in": list(days)}}))
+
+    ret_val = {}
+    for day in days:
+        entry = entries.get(day)
+        if entry is not None and not is_stale(entry, watermarks):
+            ret_val[day] = entry["geojson"]
+        else:
+            ret_val[day] = _compute_and_store(user_id, day, watermarks)
+    return ret_val
+
+def invalidate(user_id, day = None):
+    # Removes all the entries of the user, or the entry for the day
+    query = {"user_id": user_id}
+    if day is not None:
+        query["day"] = day
+    edb.get_diary_cache_db().remove(query)
+
+def get_curr_watermarks(user_id):
+    return dict((stage.name, esp.get_last_processed_ts(user_id, stage))
+                for stage in WATERMARK_STAGES)
+
+def is_stale(entry, curr_watermarks):
+    """
+    An entry is stale if any of the watermarks has moved (in either direction,
+    since a reset of the pipeline moves them back) across its day
+    """
+    (day_start_ts, day_end_ts) = get_day_ts_range(entry["day"])
+    for (stage_name, curr_ts) in curr_watermarks.items():
+        stored_ts = entry["watermarks"].get(stage_name)
+        if curr_ts == stored_ts:
+            continue
+        # None means that the stage has not processed anything yet
+        moved_from = min(stored_ts or 0, curr_ts or 0)
+        moved_to = max(stored_ts or 0, curr_ts or 0)
+        if moved_from < day_end_ts and moved_to > day_start_ts:
+            return True
+    return False
+
+def get_day_ts_range(day):
+    day_start = dup.parse(day)
+    day_start_ts = calendar.timegm(day_start.timetuple())
+    return (day_start_ts - DAY_SLACK, day_start_ts + 24 * 60 * 60 + DAY_SLACK)
+
+def _compute_and_store(user_id, day, watermarks):
+    # The watermarks were read before the computation, so if the pipeline
+    # runs while we compute, the entry is recomputed on the next read
+    start_dt = dup.parse(day)
+    end_dt = start_dt + pydt.timedelta(days=1)
+    begin = time.time()
+    geojson = gfc.get_geojson_for_dt(user_id, start_dt, end_dt)
+    edb.get_diary_cache_db().update({"user_id": user_id, "day": day},
+                                    {"user_id": user_id, "day": day, "geojson": geojson,
+                                     "watermarks": watermarks, "computed_ts": time.time()},
+                                    upsert = True)
+    logging.debug("Computed the diary for %s on %s with %d trips in %s secs" %
+                  (user_id, day, len(geojson), time.time() - begin))
+    return geojson
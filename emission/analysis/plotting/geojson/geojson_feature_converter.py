@@ -1,8 +1,10 @@
 import logging
 import geojson as gj
 import copy
+import bisect
 import attrdict as ad
 import pandas as pd
+import pymongo
 
 import emission.storage.timeseries.abstract_timeseries as esta
 
@@ -10,8 +12,11 @@ import emission.storage.decorations.trip_queries as esdt
 import emission.storage.decorations.section_queries as esds
 import emission.storage.decorations.timeline as esdtl
 
+import emission.core.get_database as edb
 import emission.core.wrapper.location as ecwl
 import emission.core.wrapper.entry as ecwe
+import emission.core.wrapper.section as ecws
+import emission.core.wrapper.stop as ecwst
 
 # TODO: Move this to the section_features class instead
 import emission.analysis.intake.cleaning.location_smoothing as eaicl
@@ -92,17 +97,138 @@ def stop_to_geojson(stop):
     _del_non_derializable(ret_feature.properties, ["location"])
     return ret_feature
 
-def section_to_geojson(section, tl):
+class TimelineMaterializer(object):
+    """
+    Reads everything that we need to convert a list of trips to geojson - the
+    sections and stops of the trips, the smoothing results of the sections
+    and their filtered locations - with a few queries for all the trips,
+    instead of several queries for each trip and section. The trips can be
+    from different users (e.g. for the aggregate timeline).
+    The queries return the same entries as the per trip and per section
+    queries (get_timeline_for_trip, find_entries with
+    get_time_query_for_section and get_entry_at_ts), so the geojson is the same.
+    """
+    def __init__(self, trips):
+        trip_ids = [trip.get_id() for trip in trips]
+        user_ids = list(set([trip.user_id for trip in trips]))
+        self.trip_sections = dict((trip_id, []) for trip_id in trip_ids)
+        self.trip_stops = dict((trip_id, []) for trip_id in trip_ids)
+        self.smoothing_entries = {}
+        self.smoothing_section_ids = set()
+        self.location_ranges = {}
+        self.location_entries = {}
+        self.location_write_ts = {}
+        self.end_location_entries = {}
+        if len(trips) == 0:
+            return
+
+        for section_doc in edb.get_section_new_db().find({"user_id": {"$in": user_ids},
+                "trip_id": {"$in": trip_ids}}).sort("start_ts", pymongo.ASCENDING):
+            self.trip_sections[section_doc["trip_id"]].append(ecws.Section(section_doc))
+        for stop_doc in edb.get_stop_db().find({"user_id": {"$in": user_ids},
+                "trip_id": {"$in": trip_ids}}).sort("enter_ts", pymongo.ASCENDING):
+            self.trip_stops[stop_doc["trip_id"]].append(ecwst.Stop(stop_doc))
+        sections = [section for trip_id in trip_ids for section in self.trip_sections[trip_id]]
+
+        # The first entry for each section, like get_entry_at_ts
+        self.smoothing_section_ids = set([section.get_id() for section in sections])
+        if len(sections) > 0:
+            for smoothing_doc in edb.get_timeseries_db().find({"user_id": {"$in": user_ids},
+                    "metadata.key": "analysis/smoothing",
+                    "data.section": {"$in": [section.get_id() for section in sections]}}):
+                self.smoothing_entries.setdefault(smoothing_doc["data"]["section"], smoothing_doc)
+
+        # The filtered locations of each user in the time range of all its
+        # sections, sorted by write_ts like find_entries, so that we can find
+        # the locations of each section by bisecting
+        for user_id in user_ids:
+            user_sections = [section for section in sections if section.user_id == user_id]
+            if len(user_sections) == 0:
+                continue
+            time_queries = [esds.get_time_query_for_section_object(section) for section in user_sections]
+            location_range = (min([tq.startTs for tq in time_queries]), max([tq.endTs for tq in time_queries]))
+            self.location_ranges[user_id] = location_range
+            self.location_entries[user_id] = list(self._find_locations(user_id, location_range))
+            self.location_write_ts[user_id] = [doc["metadata"]["write_ts"]
+                                               for doc in self.location_entries[user_id]]
+
+            # The sections whose last location is not the end point, for
+            # which section_to_geojson also needs the location at the end
+            end_ts_list = []
+            for section in user_sections:
+                section_locations = self._get_preloaded_locations(section)
+                if len(section_locations) != 0 and section_locations[-1]["data"]["loc"] != section["end_loc"]:
+                    end_ts_list.append(section.end_ts)
+            if len(end_ts_list) > 0:
+                for end_loc_doc in edb.get_timeseries_db().find({"user_id": user_id,
+                        "metadata.key": "background/filtered_location",
+                        "data.ts": {"$in": end_ts_list}}):
+                    self.end_location_entries.setdefault((user_id, end_loc_doc["data"]["ts"]), end_loc_doc)
+
+    @staticmethod
+    def _find_locations(user_id, location_range):
+        return edb.get_timeseries_db().find({"user_id": user_id,
+            "metadata.key": "background/filtered_location",
+            "metadata.write_ts": {"$gte": location_range[0], "$lt": location_range[1]}}
+            ).sort("metadata.write_ts", pymongo.ASCENDING)
+
+    def get_timeline_for_trip(self, trip_id):
+        return esdtl.Timeline(self.trip_stops[trip_id], self.trip_sections[trip_id])
+
+    def get_location_entries(self, section):
+        """
+        The filtered locations with write_ts in the time query of
+        get_time_query_for_section, as new documents for each call, since the
+        conversion modifies them
+        """
+        time_query = esds.get_time_query_for_section_object(section)
+        location_range = self.location_ranges.get(section.user_id)
+        if location_range is None or time_query.startTs < location_range[0] or \
+                time_query.endTs > location_range[1]:
+            # Not one of the sections of the trips
+            return list(self._find_locations(section.user_id, (time_query.startTs, time_query.endTs)))
+        return [copy.deepcopy(doc) for doc in self._get_preloaded_locations(section)]
+
+    def _get_preloaded_locations(self, section):
+        time_query = esds.get_time_query_for_section_object(section)
+        write_ts = self.location_write_ts[section.user_id]
+        start = bisect.bisect_left(write_ts, time_query.startTs)
+        end = bisect.bisect_left(write_ts, time_query.endTs)
+        return self.location_entries[section.user_id][start:end]
+
+    def get_smoothing_entry(self, section):
+        if section.get_id() not in self.smoothing_section_ids:
+            # Not one of the sections of the trips
+            return edb.get_timeseries_db().find_one({"user_id": section.user_id,
+                "metadata.key": "analysis/smoothing", "data.section": section.get_id()})
+        return copy.deepcopy(self.smoothing_entries.get(section.get_id()))
+
+    def get_end_location_entry(self, section):
+        """
+        Same as get_entry_at_ts for the location at the end of the section.
+        It is only needed for the sections where the last location is not the
+        end point, which we read in advance.
+        """
+        key = (section.user_id, section.end_ts)
+        if key not in self.end_location_entries:
+            self.end_location_entries[key] = edb.get_timeseries_db().find_one({"user_id": section.user_id,
+                "metadata.key": "background/filtered_location", "data.ts": section.end_ts})
+        return copy.deepcopy(self.end_location_entries[key])
+
+def section_to_geojson(section, tl, materializer=None):
     """
     This is the trickiest part of the visualization.
     The section is basically a collection of points with a line through them.
     So the representation is a feature in which one feature which is the line, and one feature collection which is the set of point features.
     :param section: the section to be converted
+    :param materializer: the TimelineMaterializer for the trip of the section, if we have one
     :return: a feature collection which is the geojson version of the section
     """
 
+    if materializer is None:
+        materializer = TimelineMaterializer([])
     ts = esta.TimeSeries.get_time_series(section.user_id)
-    entry_it = ts.find_entries(["background/filtered_location"], esds.get_time_query_for_section(section.get_id()))
+    entry_it = materializer.get_location_entries(section)
     # points_df = ts.get_data_df("background/filtered_location", esds.get_time_query_for_section(section.get_id()))
     # points_df = points_df.drop("elapsedRealTimeNanos", axis=1)
     # logging.debug("points_df.columns = %s" % points_df.columns)
@@ -118,7 +244,7 @@ def section_to_geojson(section, tl):
         # Fudge the end point so that we don't have a gap because of the ts != write_ts mismatch
         # TODO: Fix this once we are able to query by the data timestamp instead of the metadata ts
         if section_location_array[-1].loc != section.end_loc:
-            last_loc_doc = ts.get_entry_at_ts("background/filtered_location", "data.ts", section.end_ts)
+            last_loc_doc = materializer.get_end_location_entry(section)
             last_loc_data = ecwe.Entry(last_loc_doc).data
             last_loc_data["_id"] = last_loc_doc["_id"]
             section_location_array.append(last_loc_data)
@@ -126,8 +252,7 @@ def section_to_geojson(section, tl):
                 % (last_loc_data.loc, section_location_array[-2].loc, section.end_loc))
 
     # Find the list of points to filter
-    filtered_points_entry_doc = ts.get_entry_at_ts("analysis/smoothing", "data.section",
-                                                               section.get_id())
+    filtered_points_entry_doc = materializer.get_smoothing_entry(section)
     if filtered_points_entry_doc is None:
         logging.debug("No filtered_points_entry, returning unchanged array")
         filtered_section_location_array = section_location_array
@@ -191,7 +316,7 @@ def point_array_to_line(point_array):
     points_line_feature.geometry = points_line_string
     return points_line_feature    
 
-def trip_to_geojson(trip, tl):
+def trip_to_geojson(trip, tl, materializer=None):
     """
     Trips are the main focus of our current visualization, so they are most complex.
     Each trip is represented as a feature collection with the following features:
@@ -201,8 +326,11 @@ def trip_to_geojson(trip, tl):
 
     :param trip: the trip object to be converted
     :param tl: the timeline used to retrieve related objects
+    :param materializer: the TimelineMaterializer for the trips in the timeline, if we have one
     :return: the geojson version of the trip
     """
+    if materializer is None:
+        materializer = TimelineMaterializer([trip])
 
     feature_array = []
     curr_start_place = tl.get_object(trip.start_place)
@@ -215,7 +343,7 @@ def trip_to_geojson(trip, tl):
     end_place_geojson["properties"]["feature_type"] = "end_place"
     feature_array.append(end_place_geojson)
 
-    trip_tl = esdt.get_timeline_for_trip(trip.user_id, trip.get_id())
+    trip_tl = materializer.get_timeline_for_trip(trip.get_id())
     stops = trip_tl.places
     for stop in stops:
         feature_array.append(stop_to_geojson(stop))
@@ -227,7 +355,7 @@ def trip_to_geojson(trip, tl):
         # point where we exit the geofence, not at the start place. That is because we don't really know when
         # we left the start place. We can fix this in the model through interpolation. For now, we assume that the
         # gap between the real departure time and the time that the trip starts is small, and just combine it here.
-        section_gj = section_to_geojson(section, tl)
+        section_gj = section_to_geojson(section, tl, materializer)
         feature_array.append(section_gj)
         # import bson.json_util as bju
         # for f in section_gj.features:
@@ -262,10 +390,12 @@ def get_geojson_for_timeline(user_id, tl, viz=False):
     from bson import json_util
     import json
     geojson_list = []
+    # Read the data for all the trips at once
+    materializer = TimelineMaterializer(tl.trips)
 
     for trip in tl.trips:
         try:
-            trip_geojson = trip_to_geojson(trip, tl)
+            trip_geojson = trip_to_geojson(trip, tl, materializer)
             # If the trip has no sections, it will have exactly two points - one for the start place and
             # one for the stop place. If a trip has no sections, let us filter it out here because it is
             # annoying to the user. But in that case, we need to merge the places.
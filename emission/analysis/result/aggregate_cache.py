@@ -0,0 +1,157 @@
+# Standard imports
+import logging
+import time
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+
+# Our imports
+import emission.core.get_database as edb
+
+# Cache for the results that are the same for every user who asks for them,
+# such as the population averages that the carbon footprint comparison
+# shows. Without it, every user's request recomputes them over all the
+# sections. The entries are stored in the database, so that they are shared
+# by the webapp processes and can be precomputed by the background jobs.
+#
+# There are two kinds of entries:
+# - fixed windows, keyed on (metric, start, end). The window is widened to
+#   WINDOW_GRANULARITY (the start is floored and the end is rounded up)
+#   before it is used as the key and passed to the computation, so the cached
+#   value is exactly the value for its key, and it covers the whole window
+#   that was asked for. The ranges are [start, end), so an end of
+#   23:59:59.999999 is widened to the next midnight without adding any data.
+# - rolling windows, keyed on (metric, duration), which are for the last
+#   duration before the value is computed. A window that ends "now" changes
+#   with every request, so it is computed at most once per ttl, and it is
+#   returned with the window that it was computed for, so that the callers
+#   can compute the values that they compare with it over the same window.
+#
+# To avoid a stampede of identical computations when an entry is missing or
+# has expired, the caller that computes it first takes a lease on it, for up
+# to LEASE_SECS. The other callers return the expired value if there is one.
+# Otherwise they wait for the value, up to MAX_WAIT_SECS since they are
+# usually web requests, and then compute it themselves.
+#
+# Each entry is {_id: key, value, start, end, computed_ts, expires_ts,
+# lease_until}.
+
+DEFAULT_TTL = 60 * 60
+WINDOW_GRANULARITY = timedelta(minutes = 10)
+LEASE_SECS = 120
+MAX_WAIT_SECS = 5
+POLL_SECS = 0.5
+
+def get_or_compute(metric, start, end, compute_fn, ttl = DEFAULT_TTL, force_refresh = False):
+    """
+    Returns compute_fn(start, end) for the window widened to
+    WINDOW_GRANULARITY (see get_cache_window), from the cache if it has not
+    expired. With force_refresh, always recomputes the value and stores it,
+    e.g. when precomputing.
+    """
+    (start, end) = get_cache_window(start, end)
+    key = get_cache_key(metric, start, end)
+    window_fn = lambda: (start, end)
+    return _get_or_compute(key, window_fn, compute_fn, ttl, force_refresh)[0]
+
+def get_or_compute_rolling(metric, duration, compute_fn, ttl = DEFAULT_TTL, force_refresh = False):
+    """
+    Returns (compute_fn(start, end), start, end) for the window of the
+    duration (a timedelta) that ended when the value was computed, from the
+    cache if it has not expired. So the window ended at most ttl ago.
+    """
+    key = get_rolling_cache_key(metric, duration)
+    def window_fn():
+        end = datetime.now()
+        return (end - duration, end)
+    return _get_or_compute(key, window_fn, compute_fn, ttl, force_refresh)
+
+def get_cache_window(start, end):
+    return (floor_window_time(start), ceil_window_time(end))
+
+def floor_window_time(dt):
+    day_start = datetime(dt.year, dt.month, dt.day, tzinfo=dt.tzinfo)
+    since_day_start = dt - day_start
+    granularity_secs = WINDOW_GRANULARITY.total_seconds()
+    return day_start + timedelta(seconds = since_day_start.total_seconds() // granularity_secs * granularity_secs)
+
+def ceil_window_time(dt):
+    floored = floor_window_time(dt)
+    if floored == dt:
+        return dt
+    return floored + WINDOW_GRANULARITY
+
+def get_cache_key(metric, start, end):
+    return "%s:%s:%s" % (metric, start.isoformat(), end.isoformat())
+
+def get_rolling_cache_key(metric, duration):
+    return "%s:last:%d" % (metric, duration.total_seconds())
+
+def invalidate(metric = None):
+    # Removes all the entries, or the entries for the metric
+    if metric is None:
+        edb.get_aggregate_cache_db().remove()
+    else:
+        edb.get_aggregate_cache_db().remove({'_id': {'$regex': '^%s:' % metric}})
+
+def _get_or_compute(key, window_fn, compute_fn, ttl, force_refresh):
+    cache_db = edb.get_aggregate_cache_db()
+
+    entry = cache_db.find_one({'_id': key})
+    if not force_refresh and _is_valid(entry):
+        return _to_result(entry)
+
+    if _acquire_lease(cache_db, key):
+        return _compute_and_store(cache_db, key, window_fn, compute_fn, ttl)
+
+    if not force_refresh and entry is not None and 'value' in entry:
+        logging.debug("%s is being recomputed, returning the expired value" % key)
+        return _to_result(entry)
+
+    wait_until = time.time() + MAX_WAIT_SECS
+    while time.time() < wait_until:
+        time.sleep(POLL_SECS)
+        entry = cache_db.find_one({'_id': key})
+        if _is_valid(entry):
+            return _to_result(entry)
+    logging.warning("Timed out waiting for %s to be computed, computing it here" % key)
+    return _compute(key, window_fn, compute_fn)
+
+def _is_valid(entry):
+    return entry is not None and 'value' in entry and entry['expires_ts'] > time.time()
+
+def _to_result(entry):
+    return (entry['value'], entry.get('start'), entry.get('end'))
+
+def _acquire_lease(cache_db, key):
+    now = time.time()
+    try:
+        # If somebody else holds the lease, the query does not match, and the
+        # upsert fails because the _id already exists
+        cache_db.find_and_modify(
+            query = {'_id': key, '$or': [{'lease_until': {'$exists': False}},
+                                         {'lease_until': {'$lt': now}}]},
+            update = {'$set': {'lease_until': now + LEASE_SECS}},
+            upsert = True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+def _compute(key, window_fn, compute_fn):
+    begin = time.time()
+    (start, end) = window_fn()
+    value = compute_fn(start, end)
+    logging.debug("Computed %s in %s secs" % (key, time.time() - begin))
+    return (value, start, end)
+
+def _compute_and_store(cache_db, key, window_fn, compute_fn, ttl):
+    # The lease is released even if the computation fails, so that the
+    # other callers do not wait for it until it runs out
+    update = {'lease_until': 0}
+    try:
+        (value, start, end) = _compute(key, window_fn, compute_fn)
+        now = time.time()
+        update.update({'value': value, 'start': start, 'end': end,
+                       'computed_ts': now, 'expires_ts': now + ttl})
+        return (value, start, end)
+    finally:
+        cache_db.update({'_id': key}, {'$set': update}, upsert = True)
@@ -1,14 +1,17 @@
 # Standard imports
 import logging
 from datetime import datetime, timedelta
+from datetime import time as dttime
 from uuid import UUID
 
 # Our imports
 import emission.net.api.distance as distance
+import emission.analysis.result.daily_rollup as eard
+import emission.analysis.result.aggregate_cache as eaac
 # from get_database import get_user_db
 from emission.core.wrapper.user import User
 from emission.core.common import getDistinctUserCount, getAllModes, getDisplayModes, getQuerySpec, addFilterToSpec, getTripCountForMode, getModeShare, getDistanceForMode,\
-    getModeShareDistance, convertToAvg
+    getModeShareDistance, convertToAvg, getModeAggregates, getModeAggregate, getModeAggregatesByUser
 
 # Although air is a motorized mode, we don't include it here because there is
 # not much point in finding < 5 km air trips to convert to non motorized trips
@@ -16,6 +19,13 @@ from emission.core.common import getDistinctUserCount, getAllModes, getDisplayMo
 motorizedModeList = ["bus", "train", "car"]
 longMotorizedModeList = ["air"]
 
+# The distance (in meters) that separates short and long trips
+shortLongThreshold = 5000
+longMotorizedShortLongThreshold = 600 * 1000 # 600km
+
+# The window of the footprint comparison that the users see
+FOOTPRINT_COMPARE_DURATION = timedelta(days = 7)
+
 carbonFootprintForMode = {'walking' : 0,
                           'running' : 0,
                           'cycling' : 0,
@@ -68,29 +78,100 @@ def getCarbonFootprintsForMap(modeDistanceMap, carbonFootprintMap):
   return modeFootprintMap
 
 def getShortLongModeShareDistance(user,start,end):
+  return getModeShareMaps(user, start, end)[2]
+
+def getModeShareMaps(user, start, end):
+  """
+    Returns (modeShareCount, modeShareDistance, shortLongModeShareDistance,
+    nUsers) from a single aggregation over the sections, instead of one or
+    two queries per mode and map. The complete days that have been rolled up
+    are read from the daily rollups instead of the sections. nUsers is the
+    number of distinct users with sections in the range.
+  """
+  displayModes = getDisplayModes()
+  (modeAggregates, userIds) = eard.get_mode_aggregates(user, start, end,
+      [shortLongThreshold, longMotorizedShortLongThreshold])
+  return getModeShareMapsFromAggregates(displayModes, modeAggregates) + (len(userIds),)
+
+def getModeCarbonFootprintByUser(userIds, carbonFootprintMap, start, end):
+  """
+    Same as getModeCarbonFootprint for each of the users, with one
+    aggregation for all of them. Returns a map from the user id to the mode
+    footprint map.
+  """
   displayModes = getDisplayModes()
+  userModeAggregates = getModeAggregatesByUser(userIds, start, end,
+      [shortLongThreshold, longMotorizedShortLongThreshold])
+  userFootprintMap = {}
+  for userId in userIds:
+    (modeCountMap, modeDistanceMap, shortLongModeDistanceMap) = \
+        getModeShareMapsFromAggregates(displayModes, userModeAggregates.get(userId, {}))
+    userFootprintMap[userId] = getCarbonFootprintsForMap(shortLongModeDistanceMap, carbonFootprintMap)
+  return userFootprintMap
+
+def getModeShareMapsFromAggregates(displayModes, modeAggregates):
+  modeCountMap = {}
   modeDistanceMap = {}
+  shortLongModeDistanceMap = {}
   for mode in displayModes:
-    modeId = mode['mode_id']
-    if mode['mode_name'] in (motorizedModeList + longMotorizedModeList):
+    modeName = mode['mode_name']
+    modeAggregate = getModeAggregate(modeAggregates, mode['mode_id'])
+    modeCountMap[modeName] = modeAggregate['count']
+    modeDistanceMap[modeName] = modeAggregate['distance']
+    if modeName in (motorizedModeList + longMotorizedModeList):
       # We need to split it into short and long
-      if mode['mode_name'] in motorizedModeList:
-        specShort = appendDistanceFilter(getQuerySpec(user, modeId,start,end), {"$lte": 5000})
-        specLong = appendDistanceFilter(getQuerySpec(user, modeId,start,end), {"$gte": 5000})
+      if modeName in motorizedModeList:
+        threshold = shortLongThreshold
       else:
-        assert(mode['mode_name'] in longMotorizedModeList)
-        threshold = 600 * 1000 # 600km in meters
-        specShort = appendDistanceFilter(getQuerySpec(user, modeId,start,end), {"$lte": threshold})
-        specLong = appendDistanceFilter(getQuerySpec(user, modeId,start,end), {"$gte": threshold})
-      shortDistanceForMode = getDistanceForMode(specShort)
-      modeDistanceMap[mode['mode_name']+"_short"] = shortDistanceForMode
-      longDistanceForMode = getDistanceForMode(specLong)
-      modeDistanceMap[mode['mode_name']+"_long"] = longDistanceForMode
+        assert(modeName in longMotorizedModeList)
+        threshold = longMotorizedShortLongThreshold
+      # Trips of exactly the threshold count as both, like they used to
+      shortLongModeDistanceMap[modeName+"_short"] = modeAggregate['lte'][threshold]
+      shortLongModeDistanceMap[modeName+"_long"] = modeAggregate['gte'][threshold]
     else:
-      spec = getQuerySpec(user, mode['mode_id'],start,end)
-      distanceForMode = getDistanceForMode(spec)
-      modeDistanceMap[mode['mode_name']] = distanceForMode
-  return modeDistanceMap
+      shortLongModeDistanceMap[modeName] = modeAggregate['distance']
+  return (modeCountMap, modeDistanceMap, shortLongModeDistanceMap)
+
+def getPopulationModeShareMaps(start, end, forceRefresh = False):
+  """
+    getModeShareMaps for all users. This is the same for every user who
+    compares their footprint over the same window, so it is shared through
+    the aggregate cache. Note that the maps are for the window widened to
+    aggregate_cache.WINDOW_GRANULARITY, see aggregate_cache.get_cache_window.
+  """
+  return tuple(eaac.get_or_compute("population_mode_share_maps", start, end,
+      computePopulationModeShareMaps, force_refresh = forceRefresh))
+
+def getRecentPopulationModeShareMaps(duration, forceRefresh = False):
+  """
+    Returns (maps, start, end), where maps are the getModeShareMaps for all
+    users over the duration that ended at end. The maps are shared through
+    the aggregate cache, so end is at most the cache ttl ago.
+  """
+  (maps, start, end) = eaac.get_or_compute_rolling("population_mode_share_maps", duration,
+      computePopulationModeShareMaps, force_refresh = forceRefresh)
+  return (tuple(maps), start, end)
+
+def computePopulationModeShareMaps(start, end):
+  return list(getModeShareMaps(None, start, end))
+
+def precomputePopulationAggregates(now = None):
+  """
+    Precomputes the population aggregates for the windows that the clients
+    use: the last week (getFootprintCompare), the week that ends today (the
+    data client) and the day that the leaderboard and gamified scores are
+    computed for.
+  """
+  if now is None:
+    now = datetime.now()
+  today = now.date()
+  todayEnd = datetime.combine(today, dttime.max)
+  yesterdayStart = datetime.combine(today - timedelta(days = 1), dttime.min)
+  dayBeforeYesterdayStart = datetime.combine(today - timedelta(days = 2), dttime.min)
+  getRecentPopulationModeShareMaps(FOOTPRINT_COMPARE_DURATION, forceRefresh = True)
+  for (start, end) in [(todayEnd - timedelta(days = 7), todayEnd),
+                       (dayBeforeYesterdayStart, yesterdayStart)]:
+    getPopulationModeShareMaps(start, end, forceRefresh = True)
 
 def appendDistanceFilter(spec, distFilter):
   distanceFilter = {'distance': distFilter}
@@ -117,29 +198,38 @@ def getFootprintCompare(user_uuid):
     The user is assumed to be a UUID, not a User object
   """
   assert(not isinstance(user_uuid, User))
-  now = datetime.now()
-  weekago = now - timedelta(days=7)
-  return getFootprintCompareForRange(user_uuid, weekago, now)
+  # The population maps for the last week are shared by all the users, so
+  # the user's maps are computed over the same window
+  (totalModeShareMaps, start, end) = getRecentPopulationModeShareMaps(FOOTPRINT_COMPARE_DURATION)
+  return getFootprintCompareWithTotals(user_uuid, start, end, totalModeShareMaps)
 
 def getFootprintCompareForRange(user_uuid, start, end):
   """
     The input userObj is assumed to be a UUID, not a User object
   """
   assert(not isinstance(user_uuid, User))
+  # The population maps are for the window widened to the cache granularity,
+  # so the user's maps are computed over the same window
+  (start, end) = eaac.get_cache_window(start, end)
+  return getFootprintCompareWithTotals(user_uuid, start, end,
+      getPopulationModeShareMaps(start, end))
+
+def getFootprintCompareWithTotals(user_uuid, start, end, totalModeShareMaps):
+  """
+    totalModeShareMaps are the getModeShareMaps for all users over the same
+    window
+  """
   userObj = User.fromUUID(user_uuid)
   myCarbonFootprintForMode = userObj.getCarbonFootprintForMode()
 
-  myModeShareCount = getModeShare(user_uuid, start,end)
-  totalModeShareCount = getModeShare(None, start,end)
+  (myModeShareCount, myModeShareDistance, myShortLongModeShareDistance, myNUsers) = \
+      getModeShareMaps(user_uuid, start, end)
+  (totalModeShareCount, totalModeShareDistance, totalShortLongModeShareDistance, nUsers) = \
+      totalModeShareMaps
   logging.debug("myModeShareCount = %s totalModeShareCount = %s" %
       (myModeShareCount, totalModeShareCount))
-
-  myModeShareDistance = getModeShareDistance(user_uuid,start,end)
-  totalModeShareDistance = getModeShareDistance(None, start,end)
   logging.debug("myModeShareDistance = %s totalModeShareDistance = %s" %
       (myModeShareDistance, totalModeShareDistance))
-  myShortLongModeShareDistance = getShortLongModeShareDistance(user_uuid, start, end)
-  totalShortLongModeShareDistance = getShortLongModeShareDistance(None, start, end)
 
   myModeCarbonFootprint = getCarbonFootprintsForMap(myShortLongModeShareDistance, myCarbonFootprintForMode)
   totalModeCarbonFootprint = getCarbonFootprintsForMap(totalShortLongModeShareDistance, myCarbonFootprintForMode)
@@ -160,7 +250,6 @@ def getFootprintCompareForRange(user_uuid, start, end):
   myOptimalCarbonFootprintNoLongMotorized = getCarbonFootprintsForMap(myShortLongModeShareDistance, optimalCarbonFootprintForMode)
   totalOptimalCarbonFootprintNoLongMotorized = getCarbonFootprintsForMap(totalShortLongModeShareDistance, optimalCarbonFootprintForMode)
 
-  nUsers = getDistinctUserCount(getQuerySpec(None, None, start, end))
   # Hack to prevent divide by zero on an empty DB.
   # We will never really have an empty DB in the real production world,
   # but shouldn't crash in that case.
@@ -192,7 +281,8 @@ def getFootprintCompareForRange(user_uuid, start, end):
 
 def getSummaryAllTrips(start,end):
   # totalModeShareDistance = getModeShareDistance(None, start, end)
-  totalShortLongModeShareDistance = getShortLongModeShareDistance(None, start, end)
+  (totalModeShareCount, totalModeShareDistance, totalShortLongModeShareDistance, nUsers) = \
+      getPopulationModeShareMaps(start, end)
 
   totalModeCarbonFootprint = getCarbonFootprintsForMap(totalShortLongModeShareDistance,
       carbonFootprintForMode)
@@ -203,7 +293,6 @@ def getSummaryAllTrips(start,end):
   # We will never really have an empty DB in the real production world,
   # but shouldn't crash in that case.
   # This is pretty safe because if we have no users, we won't have any modeCarbonFootprint either
-  nUsers = getDistinctUserCount(getQuerySpec(None, None, start, end))
   if nUsers == 0:
     nUsers = 1
   sumModeCarbonFootprint = sum(totalModeCarbonFootprint.values())
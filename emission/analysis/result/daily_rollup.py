@@ -0,0 +1,248 @@
+# Standard imports
+import logging
+import calendar
+import time
+from datetime import datetime, timedelta
+from datetime import time as dttime
+import pymongo
+
+# Our imports
+import emission.core.get_database as edb
+import emission.core.common as ec
+import emission.storage.pipeline_queries as epq
+
+# Per-user, per-day aggregates of the sections, so that the results over a
+# range of days (the carbon footprint compare, the leaderboard and gamified
+# scores, the commute distances) can sum one document per user and day
+# instead of scanning all the raw sections in the range.
+#
+# Each rollup is a document with:
+# - user_id and date, the start of the (local) day of section_start_datetime
+# - modes: a list with, for each mode (see common.getConfirmationModeExpr),
+#   the count, distance and duration of the sections that
+#   common.getQuerySpec matches, and the distances <= and >= each of
+#   DISTANCE_THRESHOLDS, in the same order
+# - commute_to_distance and commute_from_distance: the distance of the
+#   sections that are marked as commutes
+# - rollup_ts: the time of the run that computed it
+#
+# The rollups are computed by a pipeline stage (rollup_current_days) that
+# runs for all the users at once. Its watermark is the first day that has
+# not been rolled up, and only complete days are rolled up. Since users
+# confirm their trips a few days after taking them, each run recomputes the
+# last REROLL_DAYS days before the watermark as well.
+#
+# The first run rolls up all the sections, one month at a time, since a
+# single aggregation over all of them could return more than the 16MB that
+# an aggregation returns inline.
+#
+# Queries for a range use the rollups for the complete days in the range
+# that are before the watermark, and the raw sections for the rest (partial
+# days at the ends of the range, and days after the watermark). So they
+# return the same results as the raw queries, except when sections change
+# more than REROLL_DAYS days after their day, e.g. when a user confirms or
+# corrects the mode of an old trip. The rollups do not see those changes
+# until the days are rolled up again with rollup_days.
+
+# The short/long thresholds that carbon uses
+DISTANCE_THRESHOLDS = [5000, 600 * 1000]
+REROLL_DAYS = 7
+
+def rollup_current_days():
+    time_query = epq.get_time_range_for_daily_rollup()
+    try:
+        today = datetime.combine(datetime.now().date(), dttime.min)
+        if time_query.startTs is None:
+            # The first range starts at None, so that it also removes the
+            # rollups for the days before the first section
+            first_day = get_first_section_day()
+            range_start = None
+        else:
+            first_day = datetime.utcfromtimestamp(time_query.startTs) - timedelta(days = REROLL_DAYS)
+            range_start = first_day
+        for range_end in get_month_ends(first_day, today):
+            rollup_days(range_start, range_end)
+            range_start = range_end
+        epq.mark_daily_rollup_done(calendar.timegm(today.timetuple()))
+    except:
+        logging.exception("Marking daily rollup as failed")
+        epq.mark_daily_rollup_failed()
+
+def get_first_section_day():
+    """
+    Returns the start of the day of the first section, or None if there are
+    no sections
+    """
+    # $type 9 is a date, so that the sections without a start time are not
+    # sorted first
+    first_sections = list(edb.get_section_db().find(
+        {"section_start_datetime": {"$type": 9}}, {"section_start_datetime": True}).sort(
+        "section_start_datetime", pymongo.ASCENDING).limit(1))
+    if len(first_sections) == 0:
+        return None
+    return datetime.combine(first_sections[0]["section_start_datetime"].date(), dttime.min)
+
+def get_month_ends(start, end):
+    """
+    Returns the starts of the months between start and end, followed by end,
+    i.e. the ends of the ranges that split [start, end) by month. If start
+    is None, returns [end].
+    """
+    month_ends = []
+    if start is not None:
+        month_start = datetime(start.year, start.month, 1)
+        while True:
+            month_start = datetime(month_start.year + month_start.month // 12,
+                                   month_start.month % 12 + 1, 1)
+            if month_start >= end:
+                break
+            month_ends.append(month_start)
+    return month_ends + [end]
+
+def rollup_days(start, end):
+    """
+    Recomputes the rollups for the days in [start, end), which are the
+    starts of days. If start is None, recomputes everything before end.
+    """
+    date_query = {"$lt": end}
+    if start is not None:
+        date_query["$gte"] = start
+
+    projection = ec.getModeAggregateProjection()
+    projection.update({"section_start_datetime": True, "type": True, "commute": True,
+                       # the sections that getQuerySpec(user, None, ...) matches
+                       "counted": {"$ne": ["$corrected_mode", ""]}})
+    group_id = {"user_id": "$user_id",
+                "year": {"$year": "$section_start_datetime"},
+                "month": {"$month": "$section_start_datetime"},
+                "day": {"$dayOfMonth": "$section_start_datetime"},
+                "type": "$type", "counted": "$counted",
+                "mode": "$mode", "commute": "$commute"}
+    pipeline = [{"$match": {"section_start_datetime": date_query}},
+                {"$project": projection},
+                {"$group": ec.getModeAggregateGroupSpec(group_id, DISTANCE_THRESHOLDS)}]
+
+    rollups = {}
+    for result in ec.aggregateResults(edb.get_section_db(), pipeline):
+        group = result['_id']
+        date = datetime(group['year'], group['month'], group['day'])
+        rollup = rollups.setdefault((group.get('user_id'), date),
+            {'user_id': group.get('user_id'), 'date': date, 'modes': {},
+             'commute_to_distance': 0, 'commute_from_distance': 0})
+        if group.get('type') == 'move' and group.get('counted'):
+            ec.mergeModeAggregates(rollup['modes'],
+                {group.get('mode'): ec.parseModeAggregate(result, DISTANCE_THRESHOLDS)})
+        if group.get('commute') in ['to', 'from']:
+            rollup['commute_%s_distance' % group['commute']] += result['distance']
+
+    rollup_db = edb.get_daily_rollup_db()
+    rollup_ts = time.time()
+    if len(rollups) > 0:
+        bulk = rollup_db.initialize_unordered_bulk_op()
+        for rollup in rollups.values():
+            bulk.find({'user_id': rollup['user_id'], 'date': rollup['date']}).upsert().replace_one(
+                _to_rollup_doc(rollup, rollup_ts))
+        bulk.execute()
+    # days that no longer have any sections
+    rollup_db.remove({'date': date_query, 'rollup_ts': {'$ne': rollup_ts}})
+    logging.debug("Rolled up %s user days between %s and %s" % (len(rollups), start, end))
+
+def get_mode_aggregates(user, start, end, distanceThresholds = []):
+    """
+    Same result as common.getModeAggregates, using the rollups for the
+    complete days in the range
+    """
+    if not set(distanceThresholds).issubset(DISTANCE_THRESHOLDS):
+        return ec.getModeAggregates(user, start, end, distanceThresholds)
+    (rolled_up_start, rolled_up_end) = get_rolled_up_range(start, end)
+    if rolled_up_start is None:
+        return ec.getModeAggregates(user, start, end, distanceThresholds)
+
+    mode_aggregates = {}
+    user_ids = set()
+    for rollup_doc in _find_rollups(user, rolled_up_start, rolled_up_end):
+        if len(rollup_doc['modes']) > 0:
+            user_ids.add(rollup_doc['user_id'])
+        ec.mergeModeAggregates(mode_aggregates, _to_mode_aggregates(rollup_doc, distanceThresholds))
+    for (raw_start, raw_end) in [(start, rolled_up_start), (rolled_up_end, end)]:
+        if raw_start < raw_end:
+            (raw_aggregates, raw_user_ids) = ec.getModeAggregates(user, raw_start, raw_end, distanceThresholds)
+            ec.mergeModeAggregates(mode_aggregates, raw_aggregates)
+            user_ids.update(raw_user_ids)
+    return (mode_aggregates, user_ids)
+
+def get_commute_distances(user, start, end):
+    """
+    Returns {'to': distance, 'from': distance}, the distance of the user's
+    sections in the range that are marked as commutes to and from work
+    """
+    commute_distances = {'to': 0, 'from': 0}
+    (rolled_up_start, rolled_up_end) = get_rolled_up_range(start, end)
+    if rolled_up_start is None:
+        raw_ranges = [(start, end)]
+    else:
+        for rollup_doc in _find_rollups(user, rolled_up_start, rolled_up_end):
+            commute_distances['to'] += rollup_doc['commute_to_distance']
+            commute_distances['from'] += rollup_doc['commute_from_distance']
+        raw_ranges = [(start, rolled_up_start), (rolled_up_end, end)]
+
+    for (raw_start, raw_end) in raw_ranges:
+        if raw_start < raw_end:
+            pipeline = [{"$match": {"user_id": user, "commute": {"$in": ["to", "from"]},
+                                    "section_start_datetime": {"$gte": raw_start, "$lt": raw_end}}},
+                        {"$group": {"_id": "$commute", "distance": {"$sum": "$distance"}}}]
+            for result in ec.aggregateResults(edb.get_section_db(), pipeline):
+                commute_distances[result['_id']] += result['distance']
+    return commute_distances
+
+def get_rolled_up_range(start, end):
+    """
+    Returns the range of complete days in [start, end) that have been rolled
+    up, or (None, None) if there are none
+    """
+    watermark_ts = epq.get_daily_rollup_watermark()
+    if watermark_ts is None:
+        return (None, None)
+    first_day = datetime.combine(start.date(), dttime.min)
+    if first_day < start:
+        first_day = first_day + timedelta(days = 1)
+    last_day = min(datetime.combine(end.date(), dttime.min),
+                   datetime.utcfromtimestamp(watermark_ts))
+    if first_day >= last_day:
+        return (None, None)
+    return (first_day, last_day)
+
+def _find_rollups(user, start, end):
+    query = {'date': {'$gte': start, '$lt': end}}
+    if user is not None:
+        query['user_id'] = user
+    return edb.get_daily_rollup_db().find(query)
+
+def _to_rollup_doc(rollup, rollup_ts):
+    modes = []
+    for (mode_id, mode_aggregate) in rollup['modes'].items():
+        modes.append({'mode': mode_id,
+                      'count': mode_aggregate['count'],
+                      'distance': mode_aggregate['distance'],
+                      'duration': mode_aggregate['duration'],
+                      'lte': [mode_aggregate['lte'][threshold] for threshold in DISTANCE_THRESHOLDS],
+                      'gte': [mode_aggregate['gte'][threshold] for threshold in DISTANCE_THRESHOLDS]})
+    return {'user_id': rollup['user_id'],
+            'date': rollup['date'],
+            'modes': modes,
+            'commute_to_distance': rollup['commute_to_distance'],
+            'commute_from_distance': rollup['commute_from_distance'],
+            'rollup_ts': rollup_ts}
+
+def _to_mode_aggregates(rollup_doc, distanceThresholds):
+    mode_aggregates = {}
+    for mode in rollup_doc['modes']:
+        mode_aggregates[mode['mode']] = {
+            'count': mode['count'],
+            'distance': mode['distance'],
+            'duration': mode['duration'],
+            'lte': dict((threshold, mode['lte'][DISTANCE_THRESHOLDS.index(threshold)])
+                        for threshold in distanceThresholds),
+            'gte': dict((threshold, mode['gte'][DISTANCE_THRESHOLDS.index(threshold)])
+                        for threshold in distanceThresholds)}
+    return mode_aggregates
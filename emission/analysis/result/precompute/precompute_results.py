@@ -1,27 +1,133 @@
 # Standard imports
 import logging
+import time
+from multiprocessing.pool import ThreadPool
 
 # Our imports
 
-from emission.core.get_database import get_uuid_db
-import emission.analysis.result.userclient as userclient
+from emission.core.get_database import get_uuid_db, get_profile_db
+from emission.core.wrapper.client import Client
+import emission.analysis.result.daily_rollup as eard
+import emission.analysis.result.route_density as earrd
+import emission.analysis.result.carbon as carbon
+
+# The background tasks of the users are independent of each other, and spend
+# most of their time waiting for the database, so we run them in a pool of
+# threads. The number of threads is the number of users whose tasks query the
+# database at the same time, so it should be small enough that the database
+# can keep up.
+#
+# The users are grouped by their client (study), and each client is loaded
+# once for all its users, instead of loading the user's profile and the
+# client for every user. A failure for one user is logged and reported at
+# the end, and does not stop the tasks for the other users.
+
+DEFAULT_WORKERS = 4
 
 class PrecomputeResults:
-    def __init__(self):
-        pass
+    def __init__(self, nWorkers = DEFAULT_WORKERS):
+        self.nWorkers = nWorkers
 
     def precomputeResults(self):
+        # The client scores are computed from the rollups, so update them first
+        logging.info("Rolling up the sections for the days since the last run")
+        eard.rollup_current_days()
+        logging.info("Computing the route density grids for the days since the last run")
+        earrd.compute_current_days()
+        # So that the users' requests and scores don't each recompute them
+        logging.info("Precomputing the population aggregates")
+        carbon.precomputePopulationAggregates()
+        return self.runBackgroundTasksForAllUsers()
+
+    def getUsersByClient(self):
+        """
+        Returns a map from the client name (None for the users who are not in
+        a study) to the list of the uuids of its users, with one scan of the
+        profiles
+        """
+        userClientMap = {}
+        for profile in get_profile_db().find({}, {'user_id': 1, 'study_list': 1, '_id': 0}):
+            if profile.get('user_id') in userClientMap:
+                # Same as User.getProfile, which returns the first profile
+                continue
+            studyList = profile.get('study_list')
+            userClientMap[profile.get('user_id')] = studyList[0] if studyList else None
+
+        clientUsers = {}
         for user_uuid_dict in get_uuid_db().find({}, {'uuid': 1, '_id': 0}):
-            logging.info("Computing precomputed results for %s" % user_uuid_dict['uuid'])
-            userclient.runClientSpecificBackgroundTasks(user_uuid_dict['uuid'])
+            user_uuid = user_uuid_dict['uuid']
+            clientUsers.setdefault(userClientMap.get(user_uuid), []).append(user_uuid)
+        return clientUsers
+
+    def getBackgroundTasksFn(self, clientName):
+        # Same as userclient.runClientSpecificBackgroundTasks
+        if clientName is None:
+            # default is choice
+            from emission.clients.choice import choice
+            return choice.runBackgroundTasks
+        else:
+            return Client(clientName).runBackgroundTasks
+
+    def runBackgroundTasksForAllUsers(self):
+        """
+        Runs the background tasks of all the users, and returns
+        {'users': number of users, 'failed': list of the uuids whose tasks
+        failed, 'elapsed': secs}
+        """
+        startTime = time.time()
+        tasks = []
+        for (clientName, uuids) in self.getUsersByClient().items():
+            logging.info("Computing precomputed results for %d users of client %s" %
+                         (len(uuids), clientName))
+            runTasks = self.getBackgroundTasksFn(clientName)
+            tasks.extend([(clientName, runTasks, user_uuid) for user_uuid in uuids])
+
+        failed = []
+        done = 0
+        pool = ThreadPool(self.nWorkers)
+        try:
+            for (clientName, user_uuid, succeeded, taskSecs) in \
+                    pool.imap_unordered(_runBackgroundTasksForUser, tasks):
+                done += 1
+                if not succeeded:
+                    failed.append(user_uuid)
+                logging.debug("Computed precomputed results for %s (client %s) in %.2f secs, %d/%d done" %
+                              (user_uuid, clientName, taskSecs, done, len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - startTime
+        logging.info("Computed precomputed results for %d users in %.2f secs (%.2f users/sec) with %d workers, %d failed" %
+                     (len(tasks), elapsed, len(tasks) / elapsed if elapsed > 0 else 0, self.nWorkers, len(failed)))
+        if len(failed) > 0:
+            logging.warning("Precomputing results failed for %s" % failed)
+        return {'users': len(tasks), 'failed': failed, 'elapsed': elapsed}
+
+def _runBackgroundTasksForUser(task):
+    (clientName, runTasks, user_uuid) = task
+    startTime = time.time()
+    try:
+        runTasks(user_uuid)
+        succeeded = True
+    except:
+        logging.exception("Precomputing results for %s (client %s) failed" % (user_uuid, clientName))
+        succeeded = False
+    return (clientName, user_uuid, succeeded, time.time() - startTime)
 
 if __name__ == '__main__':
     import json
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="the number of users whose results are computed at the same time")
+    args = parser.parse_args()
 
     config_data = json.load(open('config.json'))
     log_base_dir = config_data['paths']['log_base_dir']
-    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+    logging.basicConfig(format='%(asctime)s:%(threadName)s:%(levelname)s:%(message)s',
                         filename="%s/precompute_results.log" % log_base_dir, level=logging.DEBUG)
 
-    pr = PrecomputeResults()
+    pr = PrecomputeResults(args.workers)
     pr.precomputeResults()
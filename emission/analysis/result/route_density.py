@@ -0,0 +1,191 @@
+# Standard imports
+import logging
+import calendar
+from datetime import datetime, timedelta
+from datetime import time as dttime
+import numpy as np
+import pymongo
+
+# Our imports
+import emission.core.get_database as edb
+import emission.core.wrapper.section as ecws
+import emission.storage.pipeline_queries as epq
+import emission.storage.decorations.section_queries as esds
+import emission.analysis.result.daily_rollup as eardr
+
+# Density grids of the smoothed points of all the sections, for the popular
+# route heatmaps. Instead of returning every point of every section in the
+# range to the browser, we count the points in fixed size cells and return
+# the centers of the cells with the counts as the weights.
+#
+# The cells are the same as the map tiles (web mercator) at each zoom level
+# in ZOOMS, split into CELLS_PER_TILE x CELLS_PER_TILE cells, so that the
+# grid for a zoom level has about the resolution of the map at that zoom.
+#
+# The grids are computed by a stage that runs for all the users at once, one
+# document per (day, zoom, sensed mode) with:
+# - date: the start of the (local) day of the start of the sections
+# - zoom and sensed_mode
+# - x, y and count: the cells that have points, and the number of points in each
+# Like the daily rollups, the watermark of the stage is the first day that
+# has not been computed, and each run recomputes the last RECOMPUTE_DAYS
+# days before it, since the sections are created after the phones upload
+# their data. RECOMPUTE_DAYS is the REROLL_DAYS of the rollups, so that the
+# two stages cover the same days. The queries compute the days after the watermark from the
+# sections, so they do not need to wait for the stage.
+
+ZOOMS = [13, 15, 17]
+DEFAULT_ZOOM = 15
+CELLS_PER_TILE = 32
+RECOMPUTE_DAYS = eardr.REROLL_DAYS
+
+def compute_current_days():
+    time_query = epq.get_time_range_for_route_density()
+    try:
+        today = datetime.combine(datetime.now().date(), dttime.min)
+        if time_query.startTs is None:
+            start = _get_first_section_day()
+        else:
+            start = datetime.utcfromtimestamp(time_query.startTs) - timedelta(days = RECOMPUTE_DAYS)
+        if start is not None:
+            compute_days(start, today)
+        epq.mark_route_density_done(calendar.timegm(today.timetuple()))
+    except:
+        logging.exception("Marking route density as failed")
+        epq.mark_route_density_failed()
+
+def compute_days(start, end):
+    """
+    Recomputes the grids for the days in [start, end), which are the starts
+    of days, one day at a time
+    """
+    density_db = edb.get_route_density_db()
+    day = start
+    while day < end:
+        day_grids = compute_day_grids(day)
+        density_db.remove({'date': day})
+        if len(day_grids) > 0:
+            density_db.insert(day_grids)
+        day = day + timedelta(days = 1)
+
+def compute_day_grids(day):
+    """
+    Returns the grid documents for the sections that start on the day
+    """
+    sections_by_user = {}
+    for section_doc in edb.get_section_new_db().find(
+            {"start_local_dt": {"$gte": day, "$lt": day + timedelta(days = 1)}},
+            {"user_id": True, "start_ts": True, "end_ts": True, "sensed_mode": True}).sort(
+            "start_ts", pymongo.ASCENDING):
+        sections_by_user.setdefault(section_doc["user_id"], []).append(ecws.Section(section_doc))
+
+    mode_coords = {}
+    for (user_id, sections) in sections_by_user.items():
+        (coords, times, counts) = esds.get_smoothed_points(user_id, sections)
+        modes = np.repeat([section.sensed_mode.value for section in sections], counts)
+        for mode in np.unique(modes):
+            mode_coords.setdefault(int(mode), []).append(coords[modes == mode])
+
+    day_grids = []
+    for (mode, coords_list) in mode_coords.items():
+        coords = np.concatenate(coords_list)
+        for zoom in ZOOMS:
+            (x, y, count) = bin_points(coords, zoom)
+            day_grids.append({'date': day, 'zoom': zoom, 'sensed_mode': mode,
+                              'x': x.tolist(), 'y': y.tolist(), 'count': count.tolist()})
+    logging.debug("Computed %s grids from the sections of %s users on %s" %
+                  (len(day_grids), len(sections_by_user), day))
+    return day_grids
+
+def get_density(start_dt, end_dt, sensed_mode = None, box = None, zoom = DEFAULT_ZOOM):
+    """
+    Returns a list of [lng, lat, count] for the cells that have points of
+    the sections that start on the days from start_dt to end_dt (the days
+    that contain them, since the grids are per day), with the
+    sensed_mode (a MotionTypes, or None for all of them), and in the
+    box [[lng, lat], [lng, lat]] if it is specified.
+    """
+    if zoom not in ZOOMS:
+        raise ValueError("zoom %s is not one of %s" % (zoom, ZOOMS))
+    first_day = datetime.combine(start_dt.date(), dttime.min)
+    end_day = datetime.combine(end_dt.date(), dttime.min)
+    if end_day < end_dt:
+        end_day = end_day + timedelta(days = 1)
+    watermark_ts = epq.get_route_density_watermark()
+    if watermark_ts is None:
+        computed_end = first_day
+    else:
+        computed_end = max(first_day, min(end_day, datetime.utcfromtimestamp(watermark_ts)))
+
+    grids = []
+    if first_day < computed_end:
+        query = {'date': {'$gte': first_day, '$lt': computed_end}, 'zoom': zoom}
+        if sensed_mode is not None:
+            query['sensed_mode'] = sensed_mode.value
+        grids.extend(edb.get_route_density_db().find(query, {'x': True, 'y': True, 'count': True}))
+
+    # The days that the stage has not computed yet
+    day = computed_end
+    while day < end_day:
+        grids.extend([grid for grid in compute_day_grids(day) if grid['zoom'] == zoom and
+                      (sensed_mode is None or grid['sensed_mode'] == sensed_mode.value)])
+        day = day + timedelta(days = 1)
+
+    (x, y, count) = merge_grids(grids, zoom)
+    if box is not None:
+        # The y cells increase from north to south
+        (min_x, max_y) = lnglat_to_cell(np.array([box[0]]), zoom)[0]
+        (max_x, min_y) = lnglat_to_cell(np.array([box[1]]), zoom)[0]
+        in_box = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        (x, y, count) = (x[in_box], y[in_box], count[in_box])
+    centers = cell_to_lnglat(x + 0.5, y + 0.5, zoom)
+    return [[lng, lat, int(c)] for ((lng, lat), c) in zip(centers.tolist(), count)]
+
+def lnglat_to_cell(coords, zoom):
+    """
+    Returns the (x, y) web mercator cells of the (lng, lat) coords at the zoom
+    """
+    n = (2 ** zoom) * CELLS_PER_TILE
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    lat = np.radians(np.clip(coords[:,1], -85.0511, 85.0511))
+    x = (coords[:,0] + 180.0) / 360.0 * n
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * n
+    return np.clip(np.column_stack([x, y]).astype(np.int64), 0, n - 1)
+
+def cell_to_lnglat(x, y, zoom):
+    n = (2 ** zoom) * CELLS_PER_TILE
+    lng = np.asarray(x, dtype=float) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float) / n))))
+    return np.column_stack([lng, lat])
+
+def bin_points(coords, zoom):
+    """
+    Returns (x, y, count) for the cells that have any of the coords
+    """
+    cells = lnglat_to_cell(coords, zoom)
+    return _count_cells(cells[:,0], cells[:,1], np.ones(len(cells), dtype=np.int64), zoom)
+
+def merge_grids(grids, zoom):
+    """
+    Returns (x, y, count) for the sum of the grids at the zoom
+    """
+    if len(grids) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    x = np.concatenate([np.asarray(grid['x'], dtype=np.int64) for grid in grids])
+    y = np.concatenate([np.asarray(grid['y'], dtype=np.int64) for grid in grids])
+    count = np.concatenate([np.asarray(grid['count'], dtype=np.int64) for grid in grids])
+    return _count_cells(x, y, count, zoom)
+
+def _count_cells(x, y, weights, zoom):
+    # one int64 key per cell, the cells are < 2 ** 22 at the zoom levels we use
+    n = (2 ** zoom) * CELLS_PER_TILE
+    (keys, inverse) = np.unique(x * n + y, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights).astype(np.int64)
+    return (keys // n, keys % n, counts)
+
+def _get_first_section_day():
+    first_section = list(edb.get_section_new_db().find({"start_local_dt": {"$exists": True}},
+        {"start_local_dt": True}).sort("start_local_dt", pymongo.ASCENDING).limit(1))
+    if len(first_section) == 0:
+        return None
+    return datetime.combine(first_section[0]["start_local_dt"].date(), dttime.min)
@@ -1,18 +1,20 @@
 # Standard imports
 from __future__ import division
 import math
+import re
+import calendar
 import logging
 import numpy as np
 import utm
 from sklearn.cluster import DBSCAN
 
 # Our imports
-from emission.core.get_database import get_section_db, get_mode_db, get_routeCluster_db,get_transit_db
-from emission.core.common import calDistance, Include_place_2
-from emission.analysis.modelling.tour_model.trajectory_matching.route_matching import getRoute,fullMatchDistance,matchTransitRoutes,matchTransitStops
-
-Sections = get_section_db()
-Modes = get_mode_db()
+from emission.core.get_database import get_section_db, get_routeCluster_db
+from emission.core.common import calDistance
+from emission.core.spatial_grid import SpatialGrid
+import emission.analysis.classification.inference.model_store as eaicm
+from emission.analysis.modelling.tour_model.trajectory_matching.route_matching import getRoute,fullMatchDistance,matchTransitRoutes,matchTransitStops,route_prefilter
+from emission.analysis.modelling.tour_model.trajectory_matching.transit_index import get_transit_index
 
 
 # The speed is in m/s
@@ -200,6 +202,194 @@ def getIthMaxAccel(segment, i):
 def calSpeedDistParams(speeds):
   return (np.mean(speeds), np.std(speeds))
 
+# Batched versions of the track point features above, for the mode inference
+# pipeline. Calling calSpeeds, calAccels, calHCR, calSR and calVCR for each
+# section parses every timestamp several times with dateutil and computes the
+# distances one pair at a time. Instead, we flatten the track points of a
+# batch of sections into contiguous arrays, parse each timestamp once, and
+# compute the per section statistics with segmented numpy reductions.
+# The results are the same as the per section functions.
+
+MOVES_TIME_RE = re.compile(r'^(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})(\d{2})([+-])(\d{2})(\d{2})$')
+
+# Returns the track point time as seconds since the epoch
+def parseTrackPointTime(timeStr):
+  # Fast path for the moves format, e.g. 20150127T203305-0800
+  match = MOVES_TIME_RE.match(timeStr)
+  if match is not None:
+    (year, month, day, hour, minute, second, sign, tzHour, tzMinute) = match.groups()
+    offset = (int(tzHour) * 60 + int(tzMinute)) * 60
+    if sign == '-':
+      offset = -offset
+    return calendar.timegm((int(year), int(month), int(day),
+                            int(hour), int(minute), int(second))) - offset
+  from dateutil import parser
+  dt = parser.parse(timeStr)
+  if dt.tzinfo is not None and dt.utcoffset() is not None:
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+  return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+def flattenTrackPoints(sections):
+  """
+  Returns (coords, times, counts, errors) where coords is an N x 2 array of
+  the (lng, lat) of all the track points, times are their parsed times,
+  counts is the number of track points in each section, and errors maps the
+  index of each section whose track points could not be read to the
+  exception. Those sections are treated as having no track points.
+  """
+  coords = []
+  times = []
+  counts = np.zeros(len(sections), dtype=int)
+  errors = {}
+  for (i, section) in enumerate(sections):
+    try:
+      trackpoints = section['track_points']
+      sectionCoords = [point['track_location']['coordinates'] for point in trackpoints]
+      sectionTimes = [parseTrackPointTime(point['time']) for point in trackpoints]
+    except Exception, e:
+      errors[i] = e
+      continue
+    coords.extend(sectionCoords)
+    times.extend(sectionTimes)
+    counts[i] = len(trackpoints)
+  return (np.asarray(coords, dtype=float).reshape(-1, 2), np.asarray(times, dtype=float),
+          counts, errors)
+
+# Same formula as common.calDistance, for arrays of points
+def calDistances(points1, points2):
+  earthRadius = 6371000
+  lng1, lat1 = np.radians(points1[:,0]), np.radians(points1[:,1])
+  lng2, lat2 = np.radians(points2[:,0]), np.radians(points2[:,1])
+  a = (np.sin((lat1 - lat2)/2) ** 2) + \
+      ((np.sin((lng1 - lng2)/2) ** 2) * np.cos(lat1) * np.cos(lat2))
+  return earthRadius * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+# Same formula as calHeading, for arrays of points
+def calHeadings(points1, points2):
+  phi1, phi2 = np.radians(points1[:,1]), np.radians(points2[:,1])
+  deltaLambda = np.radians(points2[:,0] - points1[:,0])
+  y = np.sin(deltaLambda) * np.cos(phi2)
+  x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(deltaLambda)
+  return np.degrees(np.arctan2(y, x))
+
+def _segmentReduce(ufunc, values, segmentIds, nSegments):
+  """
+  Reduces values, which are sorted by segmentIds, for each segment. Empty
+  segments are set to zero.
+  """
+  result = np.zeros(nSegments)
+  counts = np.bincount(segmentIds, minlength=nSegments)
+  nonEmpty = counts > 0
+  if nonEmpty.any():
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    result[nonEmpty] = ufunc.reduceat(values, starts[nonEmpty])
+  return result
+
+def calTrackPointFeatures(sections):
+  """
+  Returns a dict with the speed mean, std and max, the max accel, and the
+  HCR, SR and VCR for each of the sections, as numpy arrays. Features that
+  calSpeeds etc. do not return for a section (e.g. when it only has one
+  point) are zero. The 'errors' entry is the errors from flattenTrackPoints.
+  """
+  (coords, times, counts, errors) = flattenTrackPoints(sections)
+  segmentDists = np.zeros(len(sections))
+  for (i, section) in enumerate(sections):
+    if i not in errors and section.get('distance') is not None:
+      segmentDists[i] = section['distance']
+  features = calTrackPointFeaturesForPoints(coords, times, counts, segmentDists)
+  features['errors'] = errors
+  return features
+
+def calTrackPointFeaturesForPoints(coords, times, counts, segmentDists):
+  """
+  Same as calTrackPointFeatures, for the points of the sections that have
+  already been flattened, e.g. when they are read from the timeseries.
+  coords are the (lng, lat) of the points, times are in seconds, counts is
+  the number of points in each section and segmentDists is the distance of
+  each section, which is used for the HCR, SR and VCR.
+  """
+  nSections = len(counts)
+  segmentDists = np.asarray(segmentDists, dtype=float)
+  pointSection = np.repeat(np.arange(nSections), counts)
+
+  # pair k is the pair of points (k, k+1), which is only part of a section
+  # if both points belong to it
+  inSection = pointSection[:-1] == pointSection[1:]
+  pairSection = pointSection[:-1]
+  distances = calDistances(coords[:-1], coords[1:])
+  timeDeltas = times[1:] - times[:-1]
+  validSpeeds = inSection & (timeDeltas != 0)
+  speeds = np.zeros(len(distances))
+  speeds[validSpeeds] = distances[validSpeeds] / timeDeltas[validSpeeds]
+
+  # triplet k is the pair of pairs (k, k+1)
+  inSectionTriplet = inSection[:-1] & inSection[1:]
+  tripletSection = pairSection[:-1][inSectionTriplet]
+
+  sectionSpeeds = speeds[inSection]
+  sectionPairs = pairSection[inSection]
+  nSpeeds = np.bincount(sectionPairs, minlength=nSections)
+  speedMean = np.bincount(sectionPairs, weights=sectionSpeeds, minlength=nSections) / np.maximum(nSpeeds, 1)
+  speedDeviations = sectionSpeeds - speedMean[sectionPairs]
+  speedStd = np.sqrt(np.bincount(sectionPairs, weights=speedDeviations ** 2,
+                                 minlength=nSections) / np.maximum(nSpeeds, 1))
+  speedMax = _segmentReduce(np.maximum, sectionSpeeds, sectionPairs, nSections)
+
+  # calAccels uses the speed of the previous pair, or zero for the first
+  # pair, and skips the last pair of each section
+  prevSpeeds = np.zeros(len(speeds))
+  prevSpeeds[1:] = np.where(inSection[:-1], speeds[:-1], 0)
+  accelPairs = np.flatnonzero(np.append(inSectionTriplet, False))
+  accels = np.zeros(len(accelPairs))
+  accelTimeDeltas = timeDeltas[accelPairs]
+  nonZeroTime = accelTimeDeltas != 0
+  accels[nonZeroTime] = (speeds[accelPairs] - prevSpeeds[accelPairs])[nonZeroTime] / accelTimeDeltas[nonZeroTime]
+  accelMax = _segmentReduce(np.maximum, accels, tripletSection, nSections)
+
+  headings = calHeadings(coords[:-1], coords[1:])
+  headingChanges = (headings[1:] - headings[:-1])[inSectionTriplet]
+  HCNum = np.bincount(tripletSection, weights=headingChanges >= 15, minlength=nSections)
+
+  stopNum = np.bincount(pairSection[validSpeeds], weights=speeds[validSpeeds] <= 0.75,
+                        minlength=nSections)
+
+  velocity1 = speeds[:-1][inSectionTriplet]
+  velocity2 = speeds[1:][inSectionTriplet]
+  bothValid = (validSpeeds[:-1] & validSpeeds[1:])[inSectionTriplet]
+  nonZeroVelocity = bothValid & (velocity1 != 0)
+  velocityChanges = np.zeros(len(velocity1))
+  velocityChanges[nonZeroVelocity] = np.abs(velocity2 - velocity1)[nonZeroVelocity] / velocity1[nonZeroVelocity]
+  Pv = np.bincount(tripletSection, weights=velocityChanges > 0.7, minlength=nSections)
+
+  hasDist = segmentDists != 0
+  def perDistance(values):
+    result = np.zeros(nSections)
+    result[hasDist] = values[hasDist] / segmentDists[hasDist]
+    return result
+
+  return {'speedMean': speedMean,
+          'speedStd': speedStd,
+          'speedMax': speedMax,
+          'accelMax': accelMax,
+          'HCR': perDistance(HCNum),
+          'SR': perDistance(stopNum),
+          'VCR': perDistance(Pv)}
+
+def calSectionDistancesForPoints(coords, counts):
+  """
+  Returns the distance of each section, as the sum of the distances between
+  its consecutive points. The points are flattened as in
+  calTrackPointFeaturesForPoints.
+  """
+  nSections = len(counts)
+  if len(coords) < 2:
+    return np.zeros(nSections)
+  pointSection = np.repeat(np.arange(nSections), counts)
+  inSection = pointSection[:-1] == pointSection[1:]
+  distances = calDistances(coords[:-1], coords[1:])
+  return np.bincount(pointSection[:-1][inSection], weights=distances[inSection], minlength=nSections)
+
 # def user_tran_mat(user):
 #     user_sections=[]
 #     # print(tran_mat)
@@ -246,79 +436,203 @@ def calSpeedDistParams(speeds):
 #     new_mat = tran_mat / row_sums[:, np.newaxis]
 #     return new_mat
 
-def mode_cluster(mode,eps,sam):
-    mode_change_pnts=[]
-    # print(tran_mat)
+# Vectorized version of utm.from_latlon, which returns the (easting, northing)
+# of each of the (lng, lat) points in its own UTM zone, like calling
+# utm.from_latlon on each point.
+UTM_K0 = 0.9996
+UTM_E = 0.00669438
+UTM_E_P2 = UTM_E / (1.0 - UTM_E)
+UTM_M1 = (1 - UTM_E / 4 - 3 * UTM_E ** 2 / 64 - 5 * UTM_E ** 3 / 256)
+UTM_M2 = (3 * UTM_E / 8 + 3 * UTM_E ** 2 / 32 + 45 * UTM_E ** 3 / 1024)
+UTM_M3 = (15 * UTM_E ** 2 / 256 + 45 * UTM_E ** 3 / 1024)
+UTM_M4 = (35 * UTM_E ** 3 / 3072)
+UTM_R = 6378137
+
+def projectToUTM(points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    lng = points[:,0]
+    lat = points[:,1]
+    if ((lat < -80) | (lat > 84) | (lng < -180) | (lng > 180)).any():
+        raise utm.error.OutOfRangeError('latitude or longitude out of range')
+
+    zoneNumber = np.floor((lng + 180) / 6).astype(int) + 1
+    # the exceptions for Norway and Svalbard
+    zoneNumber[(lat >= 56) & (lat <= 64) & (lng >= 3) & (lng <= 12)] = 32
+    svalbard = (lat >= 72) & (lat <= 84) & (lng >= 0)
+    for (maxLng, svalbardZone) in reversed([(9, 31), (21, 33), (33, 35), (42, 37)]):
+        zoneNumber[svalbard & (lng <= maxLng)] = svalbardZone
+    centralLngRad = np.radians((zoneNumber - 1) * 6 - 180 + 3)
+
+    latRad = np.radians(lat)
+    latSin = np.sin(latRad)
+    latCos = np.cos(latRad)
+    latTan2 = (latSin / latCos) ** 2
+    latTan4 = latTan2 ** 2
+
+    n = UTM_R / np.sqrt(1 - UTM_E * latSin ** 2)
+    c = UTM_E_P2 * latCos ** 2
+    a = latCos * (np.radians(lng) - centralLngRad)
+    m = UTM_R * (UTM_M1 * latRad - UTM_M2 * np.sin(2 * latRad) +
+                 UTM_M3 * np.sin(4 * latRad) - UTM_M4 * np.sin(6 * latRad))
+
+    easting = UTM_K0 * n * (a + a ** 3 / 6 * (1 - latTan2 + c) +
+                            a ** 5 / 120 * (5 - 18 * latTan2 + latTan4 + 72 * c - 58 * UTM_E_P2)) + 500000
+    northing = UTM_K0 * (m + n * (latSin / latCos) * (a ** 2 / 2 +
+                         a ** 4 / 24 * (5 - latTan2 + 9 * c + 4 * c ** 2) +
+                         a ** 6 / 720 * (61 - 58 * latTan2 + latTan4 + 600 * c - 330 * UTM_E_P2)))
+    northing[lat < 0] += 10000000
+    return np.column_stack((easting, northing))
+
+# mode_cluster is called with the same arguments every time the pipeline is
+# trained, and the set of sections with a confirmed mode changes slowly. So
+# we store, for each (mode, eps, sam), the start and end points of each
+# section that the centers were computed from and their projection, the
+# centers, and a watermark: the largest section _id and the fingerprint of
+# the training set (see model_store.get_training_set_fingerprint). They are
+# stored next to the model, and kept in _mode_cluster_cache, keyed by the
+# model directory and the arguments, between calls.
+#
+# If the fingerprint has not changed, we return the stored centers without
+# querying the sections. Otherwise, we read the sections after the largest
+# _id and check with counts that the other sections are unchanged. Only if
+# they are not (a section changed mode or was uploaded late) do we read all
+# the _ids. Then we project the new sections and rerun the clustering.
+_mode_cluster_cache = {}
+
+def mode_cluster(mode,eps,sam,fingerprint=None,model_dir=eaicm.MODEL_DIR):
+    cached = get_mode_cluster_entry(mode, eps, sam, model_dir)
+    if fingerprint is not None and 'centers' in cached and cached.get('fingerprint') == fingerprint:
+        logging.debug("Training set unchanged, reusing %s cluster centers for mode %s" %
+            (len(cached['centers']), mode))
+        return cached['centers']
+
     query = {"$and": [{'type': 'move'},\
                       {'confirmed_mode':mode}]}
-    # print(Sections.find(query).count())
-    logging.debug("Trying to find cluster locations for %s trips" % (Sections.find(query).count()))
-    for section in Sections.find(query).sort("section_start_datetime",1):
-        try:
-            mode_change_pnts.append(section['section_start_point']['coordinates'])
-            mode_change_pnts.append(section['section_end_point']['coordinates'])
-        except:
-            logging.warn("Found trip %s with missing start and/or end points" % (section['_id']))
-            pass
-    # print(user_change_pnts)
-    # print(len(mode_change_pnts))
-    if len(mode_change_pnts) == 0:
-      logging.debug("No points found in cluster input, nothing to fit..")
-      return np.zeros(0)
-
-    if len(mode_change_pnts)>=1:
-        # print(mode_change_pnts)
-        np_points=np.array(mode_change_pnts)
-        # print(np_points[:,0])
-        # fig, axes = plt.subplots(1, 1)
-        # axes.scatter(np_points[:,0], np_points[:,1])
-        # plt.show()
+    projection = {'section_start_datetime': True, 'section_start_point': True, 'section_end_point': True}
+    Sections = get_section_db()
+    entries = cached['entries']
+    newQuery = query
+    if cached.get('max_id') is not None:
+        newQuery = {"$and": [query, {'_id': {'$gt': cached['max_id']}}]}
+    newSections = list(Sections.find(newQuery, projection))
+    if not _are_stored_sections_current(Sections, query, entries, len(newSections)):
+        currentIds = set([section['_id'] for section in Sections.find(query, {'_id': True})])
+        entries = dict((_id, entry) for (_id, entry) in entries.iteritems() if _id in currentIds)
+        newIds = list(currentIds - set(entries.keys()))
+        newSections = list(Sections.find({'_id': {'$in': newIds}}, projection))
+    logging.debug("Reading %s new sections for mode %s, reusing %s" % (len(newSections), mode, len(entries)))
+
+    if 'centers' in cached and len(newSections) == 0 and len(entries) == len(cached['entries']):
+        cluster_center = cached['centers']
     else:
-        pass
-    utm_x = []
-    utm_y = []
-    for row in mode_change_pnts:
-        # GEOJSON order is lng, lat
-        utm_loc = utm.from_latlon(row[1],row[0])
-        utm_x = np.append(utm_x,utm_loc[0])
-        utm_y = np.append(utm_y,utm_loc[1])
-    utm_location = np.column_stack((utm_x,utm_y))
+        entries = dict(entries)
+        newPoints = []
+        for section in newSections:
+            sectionPoints = []
+            try:
+                sectionPoints.append(section['section_start_point']['coordinates'])
+                sectionPoints.append(section['section_end_point']['coordinates'])
+            except:
+                logging.warn("Found trip %s with missing start and/or end points" % (section['_id']))
+            newPoints.append(sectionPoints)
+        newProjected = projectToUTM([point for sectionPoints in newPoints for point in sectionPoints])
+        offset = 0
+        for (section, sectionPoints) in zip(newSections, newPoints):
+            entries[section['_id']] = (section.get('section_start_datetime'), sectionPoints,
+                                       newProjected[offset:offset + len(sectionPoints)])
+            offset += len(sectionPoints)
+        cluster_center = _cluster_entries(entries, eps, sam)
+
+    maxId = max(entries.keys()) if len(entries) > 0 else None
+    cached = {'fingerprint': fingerprint, 'max_id': maxId, 'entries': entries, 'centers': cluster_center}
+    _mode_cluster_cache[(model_dir, mode, eps, sam)] = cached
+    eaicm.save_mode_clusters(cached, mode, eps, sam, model_dir)
+    return cluster_center
+
+def get_mode_cluster_entry(mode, eps, sam, model_dir=eaicm.MODEL_DIR):
+    """
+    Returns the stored inputs and results of mode_cluster, loading them from
+    model_dir if they are not in memory yet
+    """
+    cacheKey = (model_dir, mode, eps, sam)
+    if cacheKey not in _mode_cluster_cache:
+        stored = eaicm.load_mode_clusters(mode, eps, sam, model_dir)
+        _mode_cluster_cache[cacheKey] = stored if stored is not None else {'entries': {}}
+    return _mode_cluster_cache[cacheKey]
+
+def _are_stored_sections_current(Sections, query, entries, nNewSections):
+    # The stored sections are current if they all still match the query, and
+    # the only other sections that match are the ones after the largest _id
+    if Sections.find(query).count() != len(entries) + nNewSections:
+        return False
+    if len(entries) == 0:
+        return True
+    storedQuery = {"$and": [query, {'_id': {'$in': entries.keys()}}]}
+    return Sections.find(storedQuery).count() == len(entries)
+
+def _cluster_entries(entries, eps, sam):
+    # Same order as the sections were read in before, sorted by start time
+    sortedEntries = sorted(entries.values(), key=lambda entry: entry[0])
+    mode_change_pnts = [point for entry in sortedEntries for point in entry[1]]
+    logging.debug("Trying to find cluster locations for %s trips" % len(entries))
+    if len(mode_change_pnts) == 0:
+        logging.debug("No points found in cluster input, nothing to fit..")
+        return np.zeros(0)
+
+    np_points = np.array(mode_change_pnts)
+    utm_location = np.concatenate([entry[2] for entry in sortedEntries])
     db = DBSCAN(eps=eps,min_samples=sam)
-    db_fit = db.fit(utm_location)
-    db_labels = db_fit.labels_
-    #print db_labels
+    db_labels = db.fit(utm_location).labels_
     new_db_labels = db_labels[db_labels!=-1]
     new_location = np_points[db_labels!=-1]
-    # print len(new_db_labels)
-    # print len(new_location)
-    # print new_information
-
-    label_unique = np.unique(new_db_labels)
-    cluster_center = np.zeros((len(label_unique),2))
-    for label in label_unique:
-        sub_location = new_location[new_db_labels==label]
-        temp_center = np.mean(sub_location,axis=0)
-        cluster_center[int(label)] = temp_center
-    # print cluster_center
+
+    # The center of each cluster is the mean of its points
+    nClusters = len(np.unique(new_db_labels))
+    counts = np.bincount(new_db_labels, minlength=nClusters)
+    cluster_center = np.zeros((nClusters,2))
+    if nClusters > 0:
+        cluster_center[:,0] = np.bincount(new_db_labels, weights=new_location[:,0], minlength=nClusters) / counts
+        cluster_center[:,1] = np.bincount(new_db_labels, weights=new_location[:,1], minlength=nClusters) / counts
     return cluster_center
 
 #
 # print(mode_cluster(6))
 
+def mode_cluster_grid(mode,eps,sam,fingerprint=None,model_dir=eaicm.MODEL_DIR):
+    """
+    Same as mode_cluster, but returns a SpatialGrid over the centers, so
+    that mode_start_end_coverage does not need to scan all the centers
+    """
+    centers = mode_cluster(mode, eps, sam, fingerprint, model_dir)
+    cached = _mode_cluster_cache[(model_dir, mode, eps, sam)]
+    # The grid is cheap to rebuild, so it is not stored with the centers
+    if 'grid' not in cached:
+        cached['grid'] = SpatialGrid(centers.reshape(-1, 2), eps)
+    return cached['grid']
+
 def mode_start_end_coverage(segment,cluster,eps):
-    mode_change_pnts=[]
-    # print(tran_mat)
-    num_sec=0
-    centers=cluster
-    # print(centers)
+    # cluster is a SpatialGrid over the cluster centers, or the centers
+    if not isinstance(cluster, SpatialGrid):
+        cluster = SpatialGrid(np.asarray(cluster, dtype=float).reshape(-1, 2), eps)
     try:
-        if Include_place_2(centers,segment['section_start_point']['coordinates'],eps) and \
-                    Include_place_2(centers,segment['section_end_point']['coordinates'],eps):
+        points = [segment['section_start_point']['coordinates'],
+                  segment['section_end_point']['coordinates']]
+        (nearest, distances) = cluster.nearest_within(points, eps)
+        if (nearest >= 0).all():
             return 1
         else:
             return 0
     except:
             return 0
+
+def mode_start_end_coverages(startPoints, endPoints, cluster, eps):
+    """
+    Batched version of mode_start_end_coverage, for the (lng, lat) start and
+    end points of a list of sections
+    """
+    (nearestStart, distances) = cluster.nearest_within(startPoints, eps)
+    (nearestEnd, distances) = cluster.nearest_within(endPoints, eps)
+    return ((nearestStart >= 0) & (nearestEnd >= 0)).astype(int)
 # print(mode_start_end_coverage(5,105,2))
 # print(mode_start_end_coverage(6,600,2))
 
@@ -376,8 +690,17 @@ def cluster_route_match_score(segment,step1=100000,step2=100000,method='lcs',rad
     medoid_ids=userRouteClusters.keys()
     if len(medoid_ids)!=0:
         choice=medoid_ids[0]
+        # read all the medoid routes in one query instead of one getRoute per medoid
+        medoid_routes={}
+        for section in get_section_db().find({'_id': {'$in': medoid_ids}}, {'track_points': True}):
+            medoid_routes[section['_id']]=[point['track_location']['coordinates'] for point in section['track_points']]
         for idx in userRouteClusters.keys():
-            route_idx=getRoute(idx)
+            route_idx=medoid_routes[idx]
+            # if no point is within radius1 of the other route, the lcs
+            # score is 1, so there is no point computing it
+            if method=='lcs' and len(route_seg)>0 and len(route_idx)>0 and \
+                    route_prefilter.reject(route_seg,route_idx,radius1) is not None:
+                continue
             try:
                 dis_new=fullMatchDistance(route_seg,route_idx,step1,step2,method,radius1)
             except RuntimeError:
@@ -397,24 +720,13 @@ def cluster_route_match_score(segment,step1=100000,step2=100000,method='lcs',rad
 
     return ModePerc
 
+# The transit routes are matched using the stop index in transit_index.py,
+# which is built once per process instead of reading and looping over every
+# transit route for every section
 def transit_route_match_score(segment,step1=100000,step2=100000,method='lcs',radius1=2500,threshold=0.5):
-    Transits=get_transit_db()
-    transitMatch={}
     route_seg=getRoute(segment['_id'])
-    for type in Transits.distinct('type'):
-        for entry in Transits.find({'type':type}):
-            transitMatch[type]=matchTransitRoutes(route_seg,entry['stops'],step1,step2,method,radius1,threshold)
-            if transitMatch[entry['type']]==1:
-                break
-    return transitMatch
+    return get_transit_index().route_match(route_seg,step1,step2,method,radius1,threshold)
 
 def transit_stop_match_score(segment,radius1=300):
-    Transits=get_transit_db()
-    transitMatch={}
     route_seg=getRoute(segment['_id'])
-    for type in Transits.distinct('type'):
-        for entry in Transits.find({'type':type}):
-            transitMatch[type]=matchTransitStops(route_seg,entry['stops'],radius1)
-            if transitMatch[entry['type']]==1:
-                break
-    return transitMatch
+    return get_transit_index().stop_match(route_seg,radius1)
@@ -3,10 +3,12 @@ from __future__ import division
 from random import randrange
 import logging
 import copy
+from collections import defaultdict
 from datetime import datetime, timedelta
 from dateutil import parser
 from pytz import timezone
 import math
+import numpy as np
 
 # Our imports
 from emission.core.get_database import get_mode_db, get_section_db, get_trip_db, get_test_db
@@ -65,11 +67,11 @@ def getTripCountForMode(user, modeId,start,end):
 def getModeShare(user,start,end):
   displayModeList = getDisplayModes()
   # logging.debug(displayModeList)
+  (modeAggregates, userIds) = getModeAggregates(user, start, end)
 
   modeCountMap = {}
   for mode in displayModeList:
-    tripCount = getTripCountForMode(user, mode["mode_id"],start,end)
-    modeCountMap[mode['mode_name']] = tripCount
+    modeCountMap[mode['mode_name']] = getModeAggregate(modeAggregates, mode['mode_id'])['count']
   return modeCountMap
 
 def getDistance(sectionList):
@@ -91,11 +93,10 @@ def getDistance(sectionList):
 
 def getModeShareDistance(user,start,end):
   displayModeList = getDisplayModes()
+  (modeAggregates, userIds) = getModeAggregates(user, start, end)
   modeDistanceMap = {}
   for mode in displayModeList:
-    spec = getQuerySpec(user, mode['mode_id'],start,end)
-    distanceForMode = getDistanceForMode(spec)
-    modeDistanceMap[mode['mode_name']] = distanceForMode
+    modeDistanceMap[mode['mode_name']] = getModeAggregate(modeAggregates, mode['mode_id'])['distance']
   return modeDistanceMap
 
 
@@ -114,6 +115,115 @@ def getDistanceForMode(spec):
   distanceForMode = totalDist
   return distanceForMode
 
+# The mode of a section, as an aggregation expression. This is the mode that
+# getConfirmationModeQuery matches: the corrected mode if there is one, the
+# confirmed mode otherwise, and the client confirmed modes otherwise. Note
+# that the aggregation framework cannot distinguish missing fields from null
+# ones, so a null corrected or confirmed mode is skipped like a missing one.
+def getConfirmationModeExpr():
+  import emission.clients.common
+  modeFields = ["corrected_mode", "confirmed_mode"] + emission.clients.common.getConfirmFields()
+  modeExpr = "$" + modeFields[-1]
+  for field in reversed(modeFields[:-1]):
+    modeExpr = {"$ifNull": ["$" + field, modeExpr]}
+  return modeExpr
+
+def getModeAggregates(user, start, end, distanceThresholds = []):
+  """
+  Computes the trip counts and distances for all the modes with one
+  aggregation over the sections that getQuerySpec(user, None, start, end)
+  matches, instead of one query per mode. Returns (modeAggregates, userIds),
+  where modeAggregates maps the mode id to a dict with:
+  - count: the number of sections
+  - distance: the sum of the distances of the sections
+  - duration: the sum of the durations of the sections, in secs
+  - lte and gte: maps from each threshold in distanceThresholds to the sum
+    of the distances of the sections that are <= (resp. >=) it
+  and userIds is the set of users who have sections in the range.
+  """
+  groupSpec = getModeAggregateGroupSpec("$mode", distanceThresholds)
+  groupSpec["user_ids"] = {"$addToSet": "$user_id"}
+  pipeline = [{"$match": getQuerySpec(user, None, start, end)},
+              {"$project": getModeAggregateProjection()},
+              {"$group": groupSpec}]
+  modeAggregates = {}
+  userIds = set()
+  for result in aggregateResults(get_section_db(), pipeline):
+    modeAggregates[result['_id']] = parseModeAggregate(result, distanceThresholds)
+    userIds.update(result['user_ids'])
+  logging.debug("Aggregated sections for user %s into %s modes" % (user, len(modeAggregates)))
+  return (modeAggregates, userIds)
+
+def getModeAggregatesByUser(userIds, start, end, distanceThresholds = []):
+  """
+  Same as getModeAggregates, for each of the users in userIds, with one
+  aggregation for all of them. Returns a map from the user id to the
+  modeAggregates, which only has the users who have sections in the range.
+  """
+  spec = addFilterToSpec(getQuerySpec(None, None, start, end), {"user_id": {"$in": list(userIds)}})
+  pipeline = [{"$match": spec},
+              {"$project": getModeAggregateProjection()},
+              {"$group": getModeAggregateGroupSpec({"user_id": "$user_id", "mode": "$mode"},
+                                                   distanceThresholds)}]
+  userModeAggregates = {}
+  for result in aggregateResults(get_section_db(), pipeline):
+    modeAggregates = userModeAggregates.setdefault(result['_id'].get('user_id'), {})
+    modeAggregates[result['_id'].get('mode')] = parseModeAggregate(result, distanceThresholds)
+  return userModeAggregates
+
+# The building blocks of getModeAggregates, so that the daily rollups can
+# group the sections the same way
+def getModeAggregateProjection():
+  return {"mode": getConfirmationModeExpr(),
+          "distance": True,
+          "duration": {"$subtract": ["$section_end_datetime", "$section_start_datetime"]},
+          "user_id": True}
+
+def getModeAggregateGroupSpec(groupId, distanceThresholds):
+  groupSpec = {"_id": groupId,
+               "count": {"$sum": 1},
+               "distance": {"$sum": "$distance"},
+               "duration": {"$sum": "$duration"}}
+  for (i, threshold) in enumerate(distanceThresholds):
+    groupSpec["lte_%d" % i] = {"$sum": {"$cond": [{"$lte": ["$distance", threshold]}, "$distance", 0]}}
+    groupSpec["gte_%d" % i] = {"$sum": {"$cond": [{"$gte": ["$distance", threshold]}, "$distance", 0]}}
+  return groupSpec
+
+def parseModeAggregate(result, distanceThresholds):
+  modeAggregate = {'count': result['count'],
+                   'distance': result['distance'],
+                   # subtracting dates returns millisecs
+                   'duration': float(result['duration']) / 1000,
+                   'lte': {}, 'gte': {}}
+  for (i, threshold) in enumerate(distanceThresholds):
+    modeAggregate['lte'][threshold] = result["lte_%d" % i]
+    modeAggregate['gte'][threshold] = result["gte_%d" % i]
+  return modeAggregate
+
+def getModeAggregate(modeAggregates, modeId):
+  # The aggregate for modes without sections, as if there was a group for them
+  emptyAggregate = {'count': 0, 'distance': 0, 'duration': 0,
+                    'lte': defaultdict(int), 'gte': defaultdict(int)}
+  return modeAggregates.get(modeId, emptyAggregate)
+
+def mergeModeAggregates(modeAggregates, otherModeAggregates):
+  # Adds the aggregates in otherModeAggregates to modeAggregates
+  for (modeId, other) in otherModeAggregates.items():
+    merged = modeAggregates.setdefault(modeId,
+      {'count': 0, 'distance': 0, 'duration': 0, 'lte': {}, 'gte': {}})
+    for field in ['count', 'distance', 'duration']:
+      merged[field] = merged[field] + other[field]
+    for field in ['lte', 'gte']:
+      for (threshold, distance) in other[field].items():
+        merged[field][threshold] = merged[field].get(threshold, 0) + distance
+
+def aggregateResults(collection, pipeline):
+  # Older versions of pymongo return the results in a dict instead of a cursor
+  results = collection.aggregate(pipeline)
+  if isinstance(results, dict):
+    return results['result']
+  return list(results)
+
 def generateRandomResult(category_list):
     result = {}
     maxPct = int(100.0/len(category_list))
@@ -322,11 +432,16 @@ def get_mode_share_by_distance(spec):
     displayModeList = getDisplayModes()
     # print(displayModeList)
     # logging.debug(displayModeList)
+    # One aggregation for all the modes instead of one query per mode
+    pipeline = [{"$match": spec},
+                {"$project": getModeAggregateProjection()},
+                {"$group": getModeAggregateGroupSpec("$mode", [])}]
+    modeAggregates = {}
+    for result in aggregateResults(get_section_db(), pipeline):
+        modeAggregates[result['_id']] = parseModeAggregate(result, [])
     modeDistanceMap = {}
     for mode in displayModeList:
-        modeDistanceMap[mode['mode_name']] = 0
-        modeSpec = addModeIdToSpec(spec, mode['mode_id'])
-        distanceForMode = getDistanceForMode(modeSpec)
+        distanceForMode = getModeAggregate(modeAggregates, mode['mode_id'])['distance']
         logging.debug("distanceForMode %s = %s" % (mode, distanceForMode))
         modeDistanceMap[mode['mode_name']] = distanceForMode
     return modeDistanceMap
@@ -389,6 +504,18 @@ def Inside_polygon(pnt,poly):
 
     return inside
 
+def get_box_query(box):
+    """
+    Returns the query for the GeoJSON locations in the box
+    [[min_lng, min_lat], [max_lng, max_lat]]
+    """
+    # $box only works with a 2d index, so we query with the polygon for the
+    # box instead, which can use the 2dsphere indexes on the GeoJSON locations
+    [[min_lng, min_lat], [max_lng, max_lat]] = box
+    return {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [[
+        [min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat],
+        [min_lng, max_lat], [min_lng, min_lat]]]}}}
+
 def getClassifiedRatio(uuid, start, end):
     from emission.analysis.result.userclient import getClientSpecificQueryFilter
 
@@ -507,3 +634,21 @@ def calDistance(point1, point2, coordinates=False):
 
     return d
 
+def calDistanceMatrix(points1, points2):
+    """
+    Vectorized version of calDistance for two lists of geojson (lng,lat) points.
+    Returns a len(points1) x len(points2) numpy array of distances in meters,
+    so that callers can compare whole routes without a python call per pair.
+    """
+    earthRadius = 6371000
+    p1 = np.radians(np.asarray(points1, dtype=float).reshape(-1, 2))
+    p2 = np.radians(np.asarray(points2, dtype=float).reshape(-1, 2))
+    lon1, lat1 = p1[:,0][:,np.newaxis], p1[:,1][:,np.newaxis]
+    lon2, lat2 = p2[:,0][np.newaxis,:], p2[:,1][np.newaxis,:]
+
+    a = (np.sin((lat1 - lat2)/2) ** 2) + \
+        ((np.sin((lon1 - lon2)/2) ** 2) * np.cos(lat1) * np.cos(lat2))
+    # guard against rounding pushing a just outside [0,1]
+    a = np.clip(a, 0, 1)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return earthRadius * c
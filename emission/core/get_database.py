@@ -2,7 +2,6 @@ from pymongo import MongoClient
 import pymongo
 import os
 import json
-from emission.net.int_service.giles import archiver
 
 def get_mode_db():
     current_db = MongoClient().Stage_database
@@ -29,34 +28,6 @@ def get_profile_db():
     Profiles=current_db.Stage_Profiles
     return Profiles
 
-"""
-def get_routeDistanceMatrix_db():
-    current_db=MongoClient().Stage_database
-    routeDistanceMatrix=current_db.Stage_routeDistanceMatrix
-    return routeDistanceMatrix
-"""
-
-def get_routeDistanceMatrix_db(user_id, method):
-    if not os.path.exists('routeDistanceMatrices'):
-        os.makedirs('routeDistanceMatrices')
-    
-    routeDistanceMatrix = {}
-    if not os.path.exists('routeDistanceMatrices/' + user_id + '_' + method + '_routeDistanceMatrix.json'):
-        data = {}
-        f = open('routeDistanceMatrices/' + user_id + '_' + method + '_routeDistanceMatrix.json', 'w+')
-        f.write(json.dumps({}))
-        f.close()
-    else:
-        f = open('routeDistanceMatrices/' + user_id + '_' + method + '_routeDistanceMatrix.json', 'r')
-        routeDistanceMatrix = json.loads(f.read())
-    return routeDistanceMatrix
-
-def update_routeDistanceMatrix_db(user_id, method, updatedMatrix):
-    f = open('routeDistanceMatrices/' + user_id + '_' + method + '_routeDistanceMatrix.json', 'w+')
-    f.write(json.dumps(updatedMatrix))
-    f.close()   
-
-
 def get_client_db():
     current_db=MongoClient().Stage_database
     Clients = current_db.Stage_clients
@@ -88,6 +59,7 @@ def get_uuid_db():
     return UUIDs
 
 def get_client_stats_db():
+    from emission.net.int_service.giles import archiver
     return archiver.StatArchiver('/client_stats')
 
 def get_client_stats_db_backup():
@@ -96,6 +68,7 @@ def get_client_stats_db_backup():
     return ClientStats
 
 def get_server_stats_db():
+    from emission.net.int_service.giles import archiver
     return archiver.StatArchiver('/server_stats')
 
 def get_server_stats_db_backup():
@@ -104,6 +77,7 @@ def get_server_stats_db_backup():
     return ServerStats
 
 def get_result_stats_db():
+    from emission.net.int_service.giles import archiver
     return archiver.StatArchiver('/result_stats')
 
 def get_result_stats_db_backup():
@@ -178,11 +152,18 @@ def get_pipeline_state_db():
 def get_place_db():
     current_db = MongoClient().Stage_database
     Places = current_db.Stage_place
+    # For the aggregate queries by local date and bounding box
+    Places.create_index([("enter_local_dt", pymongo.ASCENDING)], sparse=True)
+    Places.create_index([("location", pymongo.GEOSPHERE)], sparse=True)
     return Places
 
 def get_trip_new_db():
     current_db = MongoClient().Stage_database
     Trips = current_db.Stage_trip_new
+    # For the aggregate queries by local date and bounding box
+    Trips.create_index([("start_local_dt", pymongo.ASCENDING)], sparse=True)
+    Trips.create_index([("start_loc", pymongo.GEOSPHERE)], sparse=True)
+    Trips.create_index([("end_loc", pymongo.GEOSPHERE)], sparse=True)
     return Trips
 
 def get_common_place_db():
@@ -203,8 +184,35 @@ def get_stop_db():
 def get_section_new_db():
     current_db = MongoClient().Stage_database
     Sections = current_db.Stage_section_new
+    Sections.create_index([("start_local_dt", pymongo.ASCENDING)], sparse=True)
     return Sections
 
+def get_daily_rollup_db():
+    current_db = MongoClient().Stage_database
+    DailyRollups = current_db.Stage_daily_rollups
+    DailyRollups.create_index([("date", pymongo.ASCENDING),
+                               ("user_id", pymongo.ASCENDING)])
+    return DailyRollups
+
+def get_route_density_db():
+    current_db = MongoClient().Stage_database
+    RouteDensity = current_db.Stage_route_density
+    RouteDensity.create_index([("date", pymongo.ASCENDING),
+                               ("zoom", pymongo.ASCENDING)])
+    return RouteDensity
+
+def get_diary_cache_db():
+    current_db = MongoClient().Stage_database
+    DiaryCache = current_db.Stage_diary_cache
+    DiaryCache.create_index([("user_id", pymongo.ASCENDING),
+                             ("day", pymongo.ASCENDING)], unique=True)
+    return DiaryCache
+
+def get_aggregate_cache_db():
+    current_db = MongoClient().Stage_database
+    AggregateCache = current_db.Stage_aggregate_cache
+    return AggregateCache
+
 def get_fake_trips_db():
     current_db = MongoClient().Stage_database
     FakeTrips = current_db.Stage_fake_trips
@@ -3,8 +3,16 @@ from emission.core.wrapper.trip_old import Coordinate
 import json
 from pygeocoder import Geocoder as pyGeo  ## We fall back on this if we have to
 
-key_file = open("conf/net/ext_service/googlemaps.json")
-GOOGLE_MAPS_KEY = json.load(key_file)["api_key"]
+# Read on first use, so that importing this module does not need the conf file
+GOOGLE_MAPS_KEY = None
+
+def get_google_maps_key():
+    global GOOGLE_MAPS_KEY
+    if GOOGLE_MAPS_KEY is None:
+        key_file = open("conf/net/ext_service/googlemaps.json")
+        GOOGLE_MAPS_KEY = json.load(key_file)["api_key"]
+        key_file.close()
+    return GOOGLE_MAPS_KEY
 
 class Geocoder:
 
@@ -75,11 +83,11 @@ class Geocoder:
 
 ## Failsafe section
 def _do_google_geo(address):
-    geo = pyGeo(GOOGLE_MAPS_KEY)
+    geo = pyGeo(get_google_maps_key())
     results = geo.geocode(address)
     return Coordinate(results[0].coordinates[0], results[0].coordinates[1])
 
 def _do_google_reverse(lat, lng):
-    geo = pyGeo(GOOGLE_MAPS_KEY)
+    geo = pyGeo(get_google_maps_key())
     address = geo.reverse_geocode(lat, lng)
     return address[0]
@@ -0,0 +1,128 @@
+# Standard imports
+from __future__ import division
+import logging
+import numpy as np
+
+# Uniform grid hash over a fixed set of points (e.g. the bus and train stop
+# clusters), to answer "which of these points is closest to this location,
+# if it is within radius meters" without scanning all the points for every
+# query.
+#
+# The points are converted to earth centered (x, y, z) coordinates in meters
+# and hashed into cubes of cell_size meters. The straight line distance
+# between two points is never larger than their distance along the surface,
+# so all the points within radius of a location are in the cubes that are at
+# most ceil(radius / cell_size) cubes away from its cube, and we only compute
+# the haversine distance (same as calDistance) to the points in those cubes.
+# With a cell_size close to the query radius, a query is O(1) expected
+# instead of O(number of points), and the queries are batched with numpy.
+#
+# The grids can be pickled, e.g. the grids over the bus and train clusters
+# are built when the mode inference model is trained and stored with it.
+
+EARTH_RADIUS = 6371000
+
+class SpatialGrid(object):
+    def __init__(self, points, cell_size):
+        """
+        points is a list or array of geojson (lng, lat) coordinates
+        """
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        # The cells beyond +/- (max_cell - 1) are always empty, so the cells
+        # of the queries can be clipped to +/- max_cell, and encoded as one
+        # int64 key per cell
+        self.max_cell = int(EARTH_RADIUS // self.cell_size) + 1
+        self.base = 2 * self.max_cell + 1
+        if self.base ** 3 >= 2 ** 63:
+            raise ValueError("cell_size %s is too small for the grid keys" % cell_size)
+
+        keys = self._cell_keys(self._cells(self.points))
+        # The points sorted by cell, the points in cell_keys[k] are
+        # self.order[cell_starts[k]:cell_starts[k] + cell_counts[k]]
+        self.order = np.argsort(keys, kind='mergesort')
+        (self.cell_keys, self.cell_starts, self.cell_counts) = \
+            np.unique(keys[self.order], return_index=True, return_counts=True)
+        logging.debug("Built spatial grid with %d points in %d cells of %s meters" %
+                      (len(self.points), len(self.cell_keys), self.cell_size))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, points):
+        return np.floor(_to_xyz(points) / self.cell_size).astype(np.int64)
+
+    def _cell_keys(self, cells):
+        cells = np.clip(cells, -self.max_cell, self.max_cell) + self.max_cell
+        return (cells[:,0] * self.base + cells[:,1]) * self.base + cells[:,2]
+
+    def _candidates(self, points, radius):
+        """
+        Returns (query_idx, point_idx), the pairs of query points and grid
+        points that are in neighboring cells and may be within radius
+        """
+        cells = self._cells(points)
+        rings = int(np.ceil(radius / self.cell_size))
+        offsets = np.arange(-rings, rings + 1)
+        query_idx = [np.zeros(0, dtype=int)]
+        point_idx = [np.zeros(0, dtype=int)]
+        for dx in offsets:
+            for dy in offsets:
+                for dz in offsets:
+                    keys = self._cell_keys(cells + np.array([dx, dy, dz]))
+                    pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+                    found = np.flatnonzero(self.cell_keys[pos] == keys)
+                    counts = self.cell_counts[pos[found]]
+                    query_idx.append(np.repeat(found, counts))
+                    point_idx.append(_expand_ranges(self.cell_starts[pos[found]], counts))
+        return (np.concatenate(query_idx), self.order[np.concatenate(point_idx)])
+
+    def nearest_within(self, points, radius):
+        """
+        points is a list or array of geojson (lng, lat) coordinates.
+        Returns (indices, distances), where indices[i] is the index of the
+        grid point that is closest to points[i] if it is within radius
+        meters (inclusive, like Include_place_2), and -1 otherwise, and
+        distances[i] is the distance to it in meters, or inf.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        indices = np.empty(len(points), dtype=int)
+        indices.fill(-1)
+        distances = np.empty(len(points))
+        distances.fill(np.inf)
+        if len(points) == 0 or len(self.points) == 0:
+            return (indices, distances)
+
+        (query_idx, point_idx) = self._candidates(points, radius)
+        pair_distances = _haversine(points[query_idx], self.points[point_idx])
+        within = pair_distances <= radius
+        (query_idx, point_idx, pair_distances) = \
+            (query_idx[within], point_idx[within], pair_distances[within])
+        # closest first for each query, ties go to the lowest index
+        closest = np.lexsort((point_idx, pair_distances, query_idx))
+        first = closest[np.r_[True, query_idx[closest][1:] != query_idx[closest][:-1]]] \
+            if len(closest) > 0 else closest
+        indices[query_idx[first]] = point_idx[first]
+        distances[query_idx[first]] = pair_distances[first]
+        return (indices, distances)
+
+def _to_xyz(points):
+    radians = np.radians(points)
+    (lng, lat) = (radians[:,0], radians[:,1])
+    return EARTH_RADIUS * np.column_stack([np.cos(lat) * np.cos(lng),
+                                           np.cos(lat) * np.sin(lng),
+                                           np.sin(lat)])
+
+def _haversine(points1, points2):
+    # Same as calDistance, for two arrays of points of the same length
+    p1 = np.radians(points1)
+    p2 = np.radians(points2)
+    a = (np.sin((p1[:,1] - p2[:,1])/2) ** 2) + \
+        ((np.sin((p1[:,0] - p2[:,0])/2) ** 2) * np.cos(p1[:,1]) * np.cos(p2[:,1]))
+    a = np.clip(a, 0, 1)
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+def _expand_ranges(starts, counts):
+    # concatenation of arange(start, start + count) for each range
+    ends = np.cumsum(counts)
+    return np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1] if len(ends) > 0 else 0)
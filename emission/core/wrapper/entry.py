@@ -28,7 +28,8 @@ class Entry(ecwb.WrapperBase):
             "background/battery": "battery",
             "statemachine/transition": "transition",
             "config/sensor_config": "sensorconfig",
-            "analysis/smoothing": "smoothresults"}
+            "analysis/smoothing": "smoothresults",
+            "inference/prediction": "modeprediction"}
 
   @staticmethod
   def create_entry(user_id, key, data):
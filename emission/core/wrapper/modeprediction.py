@@ -0,0 +1,14 @@
+import logging
+import emission.core.wrapper.wrapperbase as ecwb
+
+class Modeprediction(ecwb.WrapperBase):
+  props = {"section": ecwb.WrapperBase.Access.WORM, # the section for which the mode was predicted
+           "predicted_mode_map": ecwb.WrapperBase.Access.WORM, # map from mode name to its probability
+           "model_created_ts": ecwb.WrapperBase.Access.WORM} # when the model used for the prediction was trained
+
+  enums = {}
+  geojson = []
+  nullable = []
+
+  def _populateDependencies(self):
+    pass
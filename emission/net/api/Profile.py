@@ -15,7 +15,6 @@ from emission.analysis.modelling.tour_model.K_medoid import kmedoids, user_route
 import emission.analysis.modelling.tour_model.cluster_pipeline as cp
 
 logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.DEBUG)
-Profiles=get_profile_db()
 TOLERANCE = 200 #How much movement we allow before updating zip codes again. Should be pretty large.. this is conservative
 
 def update_profiles(dummy_users=False):
@@ -28,6 +27,7 @@ def update_profiles(dummy_users=False):
         generate_route_clusters(user)
 
 def generate_user_home_work(user):
+    Profiles=get_profile_db()
     user_home=detect_home(user)
     # print user_home
     zip_is_valid = _check_zip_validity(user_home, user)
@@ -28,7 +28,7 @@ import bson.json_util
 
 # Our imports
 import modeshare, zipcode, distance, tripManager, \
-                 Berkeley, visualize, stats, usercache, timeline
+                 Berkeley, visualize, stats, usercache, timeline, compressed_json
 import emission.net.ext_service.moves.register as auth
 import emission.analysis.result.carbon as carbon
 import emission.analysis.classification.inference.commute as commute
@@ -191,8 +191,9 @@ def getCalPopRoute():
   fromTs = request.query.from_ts
   toTs = request.query.to_ts
   logging.debug("Filtering values for range %s -> %s" % (fromTs, toTs))
+  zoom = int(request.query.zoom or visualize.earrd.DEFAULT_ZOOM)
   retVal = visualize.Berkeley_pop_route(
-    datetime.fromtimestamp(float(fromTs)/1000), datetime.fromtimestamp(float(toTs)/1000))
+    datetime.fromtimestamp(float(fromTs)/1000), datetime.fromtimestamp(float(toTs)/1000), zoom)
   # retVal = common.generateRandomResult(['00-04', '04-08', '08-10'])
   # logging.debug("In getCalPopRoute, retVal is %s" % retVal)
   return retVal
@@ -204,8 +205,9 @@ def getCommutePopRoute(selMode):
   toTs = request.query.to_ts
   mode = map_mode[selMode]
   logging.debug("Filtering values for range %s -> %s" % (fromTs, toTs))
+  zoom = int(request.query.zoom or visualize.earrd.DEFAULT_ZOOM)
   retVal = visualize.Commute_pop_route(mode,
-    datetime.fromtimestamp(float(fromTs)/1000), datetime.fromtimestamp(float(toTs)/1000))
+    datetime.fromtimestamp(float(fromTs)/1000), datetime.fromtimestamp(float(toTs)/1000), zoom)
   # retVal = common.generateRandomResult(['00-04', '04-08', '08-10'])
   # logging.debug("In getCalPopRoute, retVal is %s" % retVal)
   return retVal
@@ -247,8 +249,17 @@ def getFromCache():
   logging.debug("Called userCache.get")
   user_uuid=getUUID(request)
   logging.debug("user_uuid %s" % user_uuid)
-  to_phone = usercache.sync_server_to_phone(user_uuid)
-  return {'server_to_phone': to_phone}
+  # Phones that send the versions of the documents that they have only get
+  # the changed documents, and the keys of all the documents. Older phones
+  # get all the documents, as before.
+  known_versions = request.json.get('known_versions')
+  # Similarly, only the phones that support it get the compact geojson
+  compact_geojson = request.json.get('compact_geojson', False)
+  to_phone = usercache.sync_server_to_phone(user_uuid, known_versions, compact_geojson)
+  if known_versions is None:
+    return {'server_to_phone': to_phone}
+  return {'server_to_phone': to_phone,
+          'document_keys': usercache.get_document_keys(user_uuid)}
 
 @post('/usercache/put')
 def putIntoCache():
@@ -262,9 +273,11 @@ def putIntoCache():
 def getTrips(day):
   logging.debug("Called timeline.getTrips/%s" % day)
   user_uuid=getUUID(request)
-  force_refresh = request.query.get('refresh', False)
+  # The query parameters are strings, and "false" is not False
+  force_refresh = request.query.get('refresh', 'false').lower() in ['true', '1']
   logging.debug("user_uuid %s" % user_uuid)
-  ret_geojson = timeline.get_trips_for_day(user_uuid, day, force_refresh)
+  compact_geojson = request.json.get('compact_geojson', False)
+  ret_geojson = timeline.get_trips_for_day(user_uuid, day, force_refresh, compact_geojson)
   logging.debug("type(ret_geojson) = %s" % type(ret_geojson))
   ret_dict = {"timeline": ret_geojson}
   logging.debug("type(ret_dict) = %s" % type(ret_dict))
@@ -531,6 +544,10 @@ for plugin in app.plugins:
 print("Changing bt.json_loads from %s to %s" % (bt.json_loads, bson.json_util.loads))
 bt.json_loads = bson.json_util.loads
 
+# Serializes the dict results with bson as well, streaming the large lists in
+# them and compressing them for the clients that accept it
+bt.install(compressed_json.CompressedJSONPlugin())
+
 # The selection of SSL versus non-SSL should really be done through a config
 # option and not through editing source code, so let's make this keyed off the
 # port number
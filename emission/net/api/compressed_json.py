@@ -0,0 +1,150 @@
+# Standard imports
+import zlib
+from bottle import request, response, HTTPResponse
+import bson.json_util
+
+# A bottle plugin that serializes the dict results of the routes to json
+# (with bson.json_util, like the JSON plugin that it replaces for those
+# routes), and compresses the response if the client accepts it.
+#
+# The large results (the usercache documents, the diary, the heatmaps) are
+# dicts of lists, so the lists are serialized one element at a time, and the
+# response is sent in chunks as it is serialized. This means that we never
+# hold the full serialized body in memory, and that the client starts
+# receiving the response before it has been fully serialized.
+#
+# The responses that are smaller than MIN_COMPRESS_SIZE are sent as a single
+# uncompressed string, since the compression does not save much for them.
+# The output is the same as bson.json_util.dumps of the result.
+
+MIN_COMPRESS_SIZE = 1024
+CHUNK_SIZE = 64 * 1024
+# Preferred first
+SUPPORTED_ENCODINGS = ["gzip", "deflate"]
+
+class CompressedJSONPlugin(object):
+    name = 'compressed_json'
+    api = 2
+
+    def __init__(self, min_compress_size = MIN_COMPRESS_SIZE):
+        self.min_compress_size = min_compress_size
+
+    def apply(self, callback, route):
+        def wrapper(*a, **ka):
+            rv = callback(*a, **ka)
+            if isinstance(rv, dict):
+                return self.get_body(rv)
+            elif isinstance(rv, HTTPResponse) and isinstance(rv.body, dict):
+                rv.body = self.get_body(rv.body, rv)
+            return rv
+        return wrapper
+
+    def get_body(self, result, curr_response = None):
+        """
+        Returns the body for the result, and sets the content type and
+        encoding of the response
+        """
+        if curr_response is None:
+            curr_response = response
+        curr_response.content_type = 'application/json'
+        chunks = iter_json_chunks(result)
+
+        # Read up to the threshold to see whether it is worth compressing
+        prefix = []
+        prefix_size = 0
+        for chunk in chunks:
+            prefix.append(chunk)
+            prefix_size = prefix_size + len(chunk)
+            if prefix_size >= self.min_compress_size:
+                break
+        if prefix_size < self.min_compress_size:
+            return "".join(prefix)
+
+        curr_response.set_header('Vary', 'Accept-Encoding')
+        encoding = get_accepted_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return _chain(prefix, chunks)
+        curr_response.set_header('Content-Encoding', encoding)
+        return compress_chunks(_chain(prefix, chunks), encoding)
+
+def get_accepted_encoding(accept_encoding):
+    """
+    Returns the first of SUPPORTED_ENCODINGS that the Accept-Encoding header
+    accepts, or None
+    """
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        params = [param.strip() for param in coding.split(";")]
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(params[0].lower())
+    for encoding in SUPPORTED_ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+def compress_chunks(chunks, encoding):
+    # gzip has a gzip header, and deflate, in http, has a zlib header
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.flush()
+
+def iter_json_chunks(result):
+    """
+    Yields the json for the result in chunks of about CHUNK_SIZE, serializing
+    the lists in the top level dict one element at a time
+    """
+    buf = []
+    buf_size = 0
+    for part in _iter_json_parts(result):
+        buf.append(part)
+        buf_size = buf_size + len(part)
+        if buf_size >= CHUNK_SIZE:
+            yield "".join(buf)
+            buf = []
+            buf_size = 0
+    if len(buf) > 0:
+        yield "".join(buf)
+
+def _iter_json_parts(result):
+    # The same separators as json.dumps, so that the output is the same.
+    # json.dumps converts the keys that are not strings, so we leave those
+    # dicts to it.
+    if not isinstance(result, dict) or \
+            not all([isinstance(key, basestring) for key in result.iterkeys()]):
+        yield bson.json_util.dumps(result)
+        return
+    yield "{"
+    for (i, (key, value)) in enumerate(result.iteritems()):
+        if i > 0:
+            yield ", "
+        yield bson.json_util.dumps(key)
+        yield ": "
+        if isinstance(value, list):
+            yield "["
+            for (j, element) in enumerate(value):
+                if j > 0:
+                    yield ", "
+                yield bson.json_util.dumps(element)
+            yield "]"
+        else:
+            yield bson.json_util.dumps(value)
+    yield "}"
+
+def _chain(prefix, chunks):
+    for chunk in prefix:
+        yield chunk
+    for chunk in chunks:
+        yield chunk
@@ -7,6 +7,7 @@ import math
 from emission.core.common import getDistance, calDistance
 # from commute import get_morning_commute_sections
 from emission.core.get_database import get_section_db,get_worktime_db
+import emission.analysis.result.daily_rollup as eard
 
 # dis_list = [[0,1],[1,2],[2,3], [3,5], [5,10], [10,20], [20,30], [30,50], [50,100],[100,200],[200,500]]
 dis_list = [[0,1],[1,2],[2,3], [3,5], [5,10], [10,20], [20,30], [30,50], [50,99]]
@@ -21,21 +22,9 @@ dis_list = [[0,1],[1,2],[2,3], [3,5], [5,10], [10,20], [20,30], [30,50], [50,99]
 def get_morning_commute_distance(user,start,end):
     # day should be from 1 to 5
     # get a list of work starttime for Mon, or ...
-    Sections=get_section_db()
     Worktimes=get_worktime_db()
-    totalDist = 0
-    projection = {'distance': True, '_id': False}
-    for section in Sections.find({"$and":[{'user_id':user},{'commute':'to'},{"section_start_datetime": {"$gte": start, "$lt": end}}]}, projection):
-#     logging.debug("found section with %s %s %s %s %s" %
-#       (section['trip_id'], section['section_id'], section['confirmed_mode'],
-#           section['user_id'], section['type']))
-        if section['distance']!=None:
-            totalDist = totalDist + section['distance']
-        else:
-            logging.warning("distance key not found in projection, returning zero...")
-      # returning zero for the distance
-            pass
-  # logging.debug("for sectionList %s, distanceList = %s" % (len(sectionList), distanceList))
+    # summed from the daily rollups when possible
+    totalDist = eard.get_commute_distances(user,start,end)['to']
     num_commute=Worktimes.find({"$and":[{'user_id':user},{'arr_hour':{ "$exists": True}},{"date": {"$gte": start, "$lt": end}}]}).count()
     if num_commute==0:
         return 'N/A'
@@ -46,21 +35,9 @@ def get_morning_commute_distance(user,start,end):
 def get_evening_commute_distance(user,start,end):
     # day should be from 1 to 5
     # get a list of work starttime for Mon, or ...
-    Sections=get_section_db()
     Worktimes=get_worktime_db()
-    totalDist = 0
-    projection = {'distance': True, '_id': False}
-    for section in Sections.find({"$and":[{'user_id':user},{'commute':'from'},{"section_start_datetime": {"$gte": start, "$lt": end}}]}, projection):
-#     logging.debug("found section with %s %s %s %s %s" %
-#       (section['trip_id'], section['section_id'], section['confirmed_mode'],
-#           section['user_id'], section['type']))
-        if section['distance']!=None:
-            totalDist = totalDist + section['distance']
-        else:
-            logging.warning("distance key not found in projection, returning zero...")
-      # returning zero for the distance
-            pass
-  # logging.debug("for sectionList %s, distanceList = %s" % (len(sectionList), distanceList))
+    # summed from the daily rollups when possible
+    totalDist = eard.get_commute_distances(user,start,end)['from']
     num_commute=Worktimes.find({"$and":[{'user_id':user},{'dep_hour':{ "$exists": True}},{"date": {"$gte": start, "$lt": end}}]}).count()
     if num_commute==0:
         return 'N/A'
@@ -17,10 +17,14 @@ def get_Alluser_mode_share_by_distance(flag,start,end):
 
 
 def get_user_mode_share_by_distance(user,flag,start,end):
+    return get_users_mode_share_by_distance([user],flag,start,end)
+
+# Mode share of all the users in the list together, with one aggregation
+def get_users_mode_share_by_distance(users,flag,start,end):
     # start = datetime(2014, 3, 20)
     # end = datetime(2014, 3, 21)
     if flag=='all':
-        spec={"$and":[{'user_id':user},{"section_start_datetime": {"$gte": start, "$lt": end}},{"$or":[{'commute': 'to'},{'commute': 'from'}]}]}
+        spec={"$and":[{'user_id':{'$in':users}},{"section_start_datetime": {"$gte": start, "$lt": end}},{"$or":[{'commute': 'to'},{'commute': 'from'}]}]}
     elif flag=='commute':
-        spec={"$and":[{'user_id':user},{"section_start_datetime": {"$gte": start, "$lt": end}},{"$or":[{'commute': 'to'},{'commute': 'from'}]}]}
+        spec={"$and":[{'user_id':{'$in':users}},{"section_start_datetime": {"$gte": start, "$lt": end}},{"$or":[{'commute': 'to'},{'commute': 'from'}]}]}
     return get_mode_share_by_distance(spec)
@@ -9,17 +9,44 @@ import pymongo
 # Our imports
 from emission.core.get_database import get_usercache_db
 import emission.core.common as ecc
+import emission.analysis.plotting.geojson.compact_geojson as gcg
 
-def sync_server_to_phone(uuid):
+def sync_server_to_phone(uuid, known_versions = None, compact_geojson = False):
     """
         Gets the blob to sync to send to the phone and sends it over
         Return None if there is no data
+
+        known_versions is an optional map from the keys of the documents on
+        the phone to their metadata.version. If it is specified, only the
+        documents that are not on the phone or whose version has changed are
+        returned.
+
+        If compact_geojson is set, the diary documents are sent in the
+        compact format (see compact_geojson), which newer phones support.
     """
     retrievedData = list(get_usercache_db().find({"user_id": uuid, "metadata.type": "document"}, # query
                                             {'_id': False, 'user_id': False}).sort("metadata.write_ts", pymongo.ASCENDING)) # projection, sort
     
     # logging.debug("retrievedData = %s" % retrievedData)
-    return retrievedData
+    if compact_geojson:
+        for data in retrievedData:
+            if data["metadata"]["key"].startswith("diary/trips-"):
+                data["data"] = gcg.compact_trip_list(data["data"])
+    if known_versions is None:
+        return retrievedData
+    changedData = [data for data in retrievedData
+                   if data["metadata"]["key"] not in known_versions or
+                      known_versions[data["metadata"]["key"]] != data["metadata"].get("version")]
+    logging.debug("For %s, %d of %d documents have changed since the last sync" %
+                  (uuid, len(changedData), len(retrievedData)))
+    return changedData
+
+def get_document_keys(uuid):
+    """
+        Returns the keys of all the documents for the phone, so that a phone
+        that only got the changed documents can remove the obsolete ones
+    """
+    return get_usercache_db().find({"user_id": uuid, "metadata.type": "document"}).distinct("metadata.key")
 
 def sync_phone_to_server(uuid, data_from_phone):
     """
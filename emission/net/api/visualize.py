@@ -3,7 +3,7 @@ __author__ = 'Yin'
 import logging
 
 # Our imports
-from emission.analysis.result.carbon import getModeCarbonFootprint, carbonFootprintForMode
+from emission.analysis.result.carbon import getModeCarbonFootprintByUser, carbonFootprintForMode
 from emission.core.common import Inside_polygon,berkeley_area,getConfirmationModeQuery
 from emission.core.get_database import get_section_db,get_profile_db
 import geojson as gj
@@ -12,64 +12,53 @@ import emission.core.wrapper.motionactivity as ecwm
 import emission.storage.decorations.timeline as esdt
 import emission.core.wrapper.trip as ecwt
 import emission.core.wrapper.section as ecws
+import emission.analysis.result.aggregate_cache as eaac
+import emission.analysis.result.route_density as earrd
 
 # Note that all the points here are returned in (lng, lat) format, which is the
 # GeoJSON format.
 
 def carbon_by_zip(start,end):
+    # The heatmap is the same for everybody, so it is cached for the date range
+    return eaac.get_or_compute("carbon_by_zip", start, end, _compute_carbon_by_zip)
+
+def _compute_carbon_by_zip(start,end):
+    # One scan of the profiles to find the users in each zipcode, and one
+    # aggregation over the sections of all of them, grouped by user and mode,
+    # instead of queries for each zipcode, user and mode
     Profiles=get_profile_db()
+    zip_profiles={}
+    for profile in Profiles.find({'zip': {'$ne': 'N/A'}},
+                                 {'zip': True, 'zip_centroid': True, 'user_id': True}):
+        if 'zip' in profile:
+            zip_profiles.setdefault(profile['zip'], []).append(profile)
+    user_ids=set([profile['user_id'] for profiles in zip_profiles.values() for profile in profiles])
+    user_carbon_map=getModeCarbonFootprintByUser(list(user_ids),carbonFootprintForMode,start,end)
+
     carbon_list=[]
-    for zip in Profiles.distinct('zip'):
-        # print(zip)
-        if zip!='N/A':
-            tempdict={}
-            tempdict['weight']=Profiles.find({'zip':zip}).count()
-            # print(Profiles.find({'zip':zip}).count())
-            tempdict['carbon']=0
-            for profile in Profiles.find({'zip':zip}):
-                tempdict['loc']=profile['zip_centroid']
-                user=profile['user_id']
-                user_carbon=getModeCarbonFootprint(user,carbonFootprintForMode,start,end)
-                tempdict['carbon']+=sum(list(user_carbon.values()))
-            tempdict['carbon']=tempdict['carbon']/tempdict['weight']
-            carbon_list.append(tempdict)
+    for (zip, profiles) in zip_profiles.items():
+        tempdict={}
+        tempdict['weight']=len(profiles)
+        tempdict['carbon']=0
+        for profile in profiles:
+            tempdict['loc']=profile['zip_centroid']
+            tempdict['carbon']+=sum(list(user_carbon_map[profile['user_id']].values()))
+        tempdict['carbon']=tempdict['carbon']/tempdict['weight']
+        carbon_list.append(tempdict)
     return {"weightedLoc": carbon_list}
 
-def Berkeley_pop_route(start_dt, end_dt):
-    box = [ [-122.267443, 37.864693], [-122.250985, 37.880687] ]
-    tl = esdt.get_aggregate_timeline_from_dt(start_dt, end_dt, box)
-    gj_list = gfc.get_geojson_for_timeline(None, tl, viz=True)
-    list_of_points=[]
-    for gj in gj_list:
-        for feature in gj:
-            if feature['type'] == 'FeatureCollection':
-                for feat in feature['features']:
-                    if "properties" not in feat:
-                        continue
-                if feat['properties']['feature_type'] == "section":
-                    points = feat.geometry.coordinates
-                    list_of_points.extend(points)
-    return {"latlng": list_of_points}
-
-def Commute_pop_route(mode, start_dt, end_dt):
-    tl = esdt.get_aggregate_timeline_from_dt(start_dt, end_dt)
-    gj_list = gfc.get_geojson_for_timeline(None, tl, viz=True)
- 
-    logging.debug("len gl list is %d" % len(gj_list))
-    list_of_point=[]
- 
-    for gj in gj_list:
-        for feature in gj:
-            if feature['type'] == 'FeatureCollection':
-                for feat in feature['features']:
-                    if "properties" not in feat:
-                        continue
-                    if feat['properties']['feature_type'] == "section":
-                        if mode == 'all' or feat.properties["sensed_mode"] == mode:
-                            points = feat.geometry.coordinates
-                            list_of_point.extend(points)
-    logging.debug("Returning list of size %s" % len(list_of_point))
-    return {"latlng": list_of_point}
-
+# The popular routes are returned as the centers of the cells of a density
+# grid, weighted by the number of points in the cell, instead of all the points
+# (see route_density).
 
+def Berkeley_pop_route(start_dt, end_dt, zoom=earrd.DEFAULT_ZOOM):
+    box = [ [-122.267443, 37.864693], [-122.250985, 37.880687] ]
+    weighted_points = earrd.get_density(start_dt, end_dt, box=box, zoom=zoom)
+    return {"weightedLatlng": weighted_points}
 
+def Commute_pop_route(mode, start_dt, end_dt, zoom=earrd.DEFAULT_ZOOM):
+    # mode is 'all' or the name of a sensed mode, e.g. "MotionTypes.BICYCLING"
+    sensed_mode = None if mode == 'all' else ecwm.MotionTypes[mode.split('.')[-1]]
+    weighted_points = earrd.get_density(start_dt, end_dt, sensed_mode=sensed_mode, zoom=zoom)
+    logging.debug("Returning list of size %s" % len(weighted_points))
+    return {"weightedLatlng": weighted_points}
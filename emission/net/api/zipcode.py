@@ -7,7 +7,8 @@ from pygeocoder import Geocoder
 from emission.analysis.modelling.home import detect_home,detect_home_from_db
 from emission.core.common import getModeShare
 from emission.core.get_database import get_section_db,get_profile_db
-from modeshare import get_user_mode_share_by_distance
+from modeshare import get_users_mode_share_by_distance
+import emission.analysis.result.aggregate_cache as eaac
 
 # zipcode_list = ["other", "94720", "94709", "94705", "94706", "94703", "94704"]
 
@@ -60,22 +61,18 @@ def getZipcode():
 
 
 def get_mode_share_by_Zipcode(zip,flag,start,end):
-    Profiles=get_profile_db()
-    user_list=[]
-    Modeshare={}
     logging.debug("Called get_mode_share_by_Zipcode(%s)" % zip)
-    for profile in Profiles.find({'zip':zip}):
-        user_list.append(profile['user_id'])
+    # The result is the same for everybody who looks at the zipcode, so it is
+    # cached for the date range
+    return eaac.get_or_compute("zip_mode_share:%s:%s" % (zip, flag), start, end,
+        lambda start, end: _compute_mode_share_by_Zipcode(zip, flag, start, end))
+
+def _compute_mode_share_by_Zipcode(zip,flag,start,end):
+    Profiles=get_profile_db()
+    user_list=[profile['user_id'] for profile in Profiles.find({'zip':zip}, {'user_id': True})]
     if len(user_list)!=0:
-        # print(user_list)
-        for user in user_list:
-            user_share=get_user_mode_share_by_distance(user,flag,start,end)
-            # print(user_share)
-            for mode in user_share.keys():
-                if mode not in Modeshare:
-                    Modeshare[mode]=user_share[mode]
-                else:
-                    Modeshare[mode]+=user_share[mode]
-        return Modeshare
+        # One aggregation over the sections of all the users in the zipcode,
+        # instead of one query per user and mode
+        return get_users_mode_share_by_distance(user_list,flag,start,end)
     else:
         return 'N/A'
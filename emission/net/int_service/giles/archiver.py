@@ -21,12 +21,22 @@ def get_giles_api_key():
     return api_key
 
 class StatArchiver:
-    GILES_BASE_URL = get_giles_base_url()
-    GILES_API_KEY = get_giles_api_key()
+    # Read from the conf file when the first archiver is created, so that
+    # importing this module does not need the conf file
+    GILES_BASE_URL = None
+    GILES_API_KEY = None
     #QUERY_URL = "http://localhost:8079/api/query"
     #ARCHIVER_URL = "http://localhost:8079/add/apikey"
 
+    @classmethod
+    def load_conf(cls):
+        if cls.GILES_BASE_URL is None:
+            conf = get_conf_file()
+            cls.GILES_BASE_URL = conf['giles_base_url']
+            cls.GILES_API_KEY = conf['giles_api_key']
+
     def __init__(self, collection):
+        self.load_conf()
         self.query_url = os.path.join(self.GILES_BASE_URL, 'api', 'query')
         self.archiver_url = os.path.join(self.GILES_BASE_URL, 'add', self.GILES_API_KEY)
         self.collection = collection
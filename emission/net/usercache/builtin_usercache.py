@@ -1,7 +1,9 @@
 # Standard imports
 import logging
 import time
+import hashlib
 import pymongo
+from bson import json_util
 
 # Our imports
 import emission.net.usercache.abstract_usercache as ucauc # ucauc = usercache.abstract_usercache
@@ -74,35 +76,52 @@ class BuiltinUserCache(ucauc.UserCache):
         """
             server -> phone
             Note that this assumes that we have a single cache document per user.
+
+            The documents are regenerated on every run of the pipeline, but
+            most of them do not change. So we store a hash of the value, and
+            skip the write if it has not changed. Otherwise, we increment the
+            version of the document, so that the phones can ask only for the
+            documents that have changed since they last synced (see
+            usercache.sync_server_to_phone).
         """
-        metadataDoc = {
-                        'write_ts': time.time(),
-                        'type': 'document',
-                        'key': key,
-                      }
+        queryDoc = {'user_id': self.user_id,
+                    'metadata.type': 'document',
+                    'metadata.key': key}
+        value_hash = BuiltinUserCache.get_document_hash(value)
+        existing = self.db.find_one(queryDoc, {'metadata.hash': True})
+        if existing is not None and existing['metadata'].get('hash') == value_hash:
+            logging.debug("document %s has not changed, skipping" % key)
+            return
+
         # If the field does not exist, $set will add a new field with the
         # specified value, provided that the new field does not violate a type
-        # constraint.
+        # constraint. On an upsert, the type and key are copied from the query.
         #
         # TODO: Should we store the user_id in the metadata doc, or outside?
         # If inside, we need to 
         document = {
                       '$set': {
                           'user_id': self.user_id,
-                          'metadata': metadataDoc,
+                          'metadata.write_ts': time.time(),
+                          'metadata.hash': value_hash,
                           'data': value
+                      },
+                      '$inc': {
+                          'metadata.version': 1
                       }
                    }
 
-        queryDoc = {'user_id': self.user_id,
-                    'metadata.type': 'document',
-                    'metadata.key': key}
         # logging.debug("Updating %s spec to %s" % (self.user_id, document))
         result = self.db.update(queryDoc,
                                 document,
                                 upsert=True)
         logging.debug("Result = %s after updating document %s" % (result, key))
 
+    @staticmethod
+    def get_document_hash(value):
+        # The keys are sorted so that equal values have the same hash
+        return hashlib.sha1(json_util.dumps(value, sort_keys=True)).hexdigest()
+
     def _get_msg_query(self, key_list = None, time_query = None):
         ret_query = {"user_id": self.user_id}
         ret_query.update({"$or": [self.type_query("message"),
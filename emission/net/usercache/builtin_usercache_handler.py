@@ -9,11 +9,13 @@ import emission.net.usercache.abstract_usercache as enua
 import emission.storage.timeseries.abstract_timeseries as etsa
 
 import emission.analysis.plotting.geojson.geojson_feature_converter as gfc
+import emission.analysis.plotting.geojson.diary_cache as gdc
 import emission.analysis.configs.config as eacc
 
 import emission.net.usercache.formatters.formatter as enuf
 import emission.storage.pipeline_queries as esp
 import emission.storage.decorations.tour_model_queries as esdtmpq
+import emission.storage.decorations.trip_queries as esdt
 
 import emission.core.wrapper.trip as ecwt
 import emission.core.wrapper.entry as ecwe
@@ -99,10 +101,9 @@ class BuiltinUserCacheHandler(enuah.UserCacheHandler):
         Store trips for the last week to the cache. Any entries older than 3 days
         should be purged. Note that this currently repeats information - the data that
         was from day before yesterday, for example, would have been sent at that point
-        as well.  As an optimization, we could use something like CouchDB to only send
-        the diffs back and forth. Or use a simple syncing mechanism in which the
-        write_ts of the "document" reflects time that the documents were generated, and
-        only sync new documents? In general, the write_ts of the generated document
+        as well. To avoid that, the usercache skips the documents that have not
+        changed, and versions the rest, so that phones can only sync the documents
+        that have changed (see BuiltinUserCache.putDocument). In general, the write_ts of the generated document
         should be within a few hours of the intake document.
 
         Second question: How do we send back the travel diary data? As the
@@ -154,8 +155,11 @@ class BuiltinUserCacheHandler(enuah.UserCacheHandler):
         start_ts = esp.get_complete_ts(self.user_id)
         logging.debug("start ts from pipeline = %s, %s" % 
            (start_ts, pydt.datetime.utcfromtimestamp(start_ts).isoformat()))
-        trip_gj_list = self.get_trip_list_for_seven_days(start_ts)
-        if len(trip_gj_list) == 0:
+        # The geojson for each day is read from the materialized views of the
+        # diary, so only the days that the pipeline has processed since the
+        # last push are regenerated
+        day_list = self.get_trip_days_for_seven_days(start_ts)
+        if len(day_list) == 0:
             ts = etsa.TimeSeries.get_time_series(self.user_id)
             max_loc_ts = ts.get_max_value_for_field("background/filtered_location", "data.ts")
             if max_loc_ts == -1:
@@ -167,8 +171,11 @@ class BuiltinUserCacheHandler(enuah.UserCacheHandler):
                 logging.warning("No analysis has been done on recent points! max_loc_ts %s > start_ts %s, early return" %
                                 (max_loc_ts, start_ts))
                 return
-            trip_gj_list = self.get_trip_list_for_seven_days(max_loc_ts)
-        day_list_bins = self.bin_into_days_by_local_time(trip_gj_list)
+            day_list = self.get_trip_days_for_seven_days(max_loc_ts)
+        # Like the binned trips, skip the days that only have trips without sections
+        day_list_bins = dict((day, day_gj_list) for (day, day_gj_list) in
+                             gdc.get_diary_for_days(self.user_id, day_list).iteritems()
+                             if len(day_gj_list) > 0)
         uc = enua.UserCache.getUserCache(self.user_id)
 
         for day, day_gj_list in day_list_bins.iteritems():
@@ -245,6 +252,20 @@ class BuiltinUserCacheHandler(enuah.UserCacheHandler):
         logging.debug("Found %s trips in seven days starting from %s (%s)" % (len(trip_gj_list), start_ts, pydt.datetime.utcfromtimestamp(start_ts).isoformat()))
         return trip_gj_list
 
+    def get_trip_days_for_seven_days(self, start_ts):
+        """
+        Returns the local days (see get_local_day_from_fmt_time) of the trips
+        in the seven days before start_ts, without generating their geojson
+        """
+        seven_days_ago_ts = self.get_oldest_valid_ts(start_ts)
+        trip_list = esdt.get_trips(self.user_id,
+            enua.UserCache.TimeQuery("start_ts", seven_days_ago_ts, start_ts))
+        day_list = sorted(set([BuiltinUserCacheHandler.get_local_day_from_fmt_time(trip)
+                               for trip in trip_list]))
+        logging.debug("Found %s trips on %s days in seven days starting from %s (%s)" %
+                      (len(trip_list), len(day_list), start_ts, pydt.datetime.utcfromtimestamp(start_ts).isoformat()))
+        return day_list
+
     @staticmethod
     def get_local_day_from_fmt_time(trip):
         """
@@ -2,6 +2,7 @@ import logging
 import pymongo
 
 import emission.core.get_database as edb
+import emission.core.common as ecc
 import emission.core.wrapper.place as ecwp
 
 def get_last_place(user_id):
@@ -33,6 +34,10 @@ def _get_ts_query(tq):
 def get_place(place_id):
     return ecwp.Place(edb.get_place_db().find_one({"_id": place_id}))
 
+def get_places_by_ids(place_ids):
+    # One query for all the places, in no particular order
+    return [ecwp.Place(doc) for doc in edb.get_place_db().find({"_id": {"$in": list(place_ids)}})]
+
 def get_places(user_id, time_query):
     curr_query = _get_ts_query(time_query)
     curr_query.update({"user_id": user_id})
@@ -42,9 +47,15 @@ def get_places(user_id, time_query):
     return [ecwp.Place(doc) for doc in place_doc_cursor]
 
 def get_aggregate_places(time_query, box=None):
+    """
+    Returns the places of all the users in the time query, and in the box
+    [[min_lng, min_lat], [max_lng, max_lat]] if it is specified. The time
+    query can also be on the local dates, e.g.
+    TimeQuery("enter_local_dt", start_dt, end_dt).
+    """
     curr_query = _get_ts_query(time_query)
     if box:
-        curr_query.update({"location": {"$geoWithin" : {"$box" :box}}})
+        curr_query.update({"location": ecc.get_box_query(box)})
     place_doc_cursor = edb.get_place_db().find(curr_query).sort(time_query.timeType, pymongo.ASCENDING)
     return [ecwp.Place(doc) for doc in place_doc_cursor]
 
@@ -1,5 +1,6 @@
 import logging
 import pymongo
+import numpy as np
 
 import emission.core.get_database as edb
 import emission.core.wrapper.section as ecws
@@ -24,7 +25,9 @@ def get_section(section_id):
     return ecws.Section(edb.get_section_new_db().find_one({"_id": section_id}))
 
 def get_time_query_for_section(section_id):
-    section = get_section(section_id)
+    return get_time_query_for_section_object(get_section(section_id))
+
+def get_time_query_for_section_object(section):
     return enua.UserCache.TimeQuery("write_ts", section.start_ts, section.end_ts + 20)
 
 def get_sections(user_id, time_query):
@@ -45,3 +48,37 @@ def _get_sections_for_query(section_query, sort_field):
     section_doc_cursor = edb.get_section_new_db().find(section_query).sort(sort_field, pymongo.ASCENDING)
     # TODO: Fix "TripIterator" and return it instead of this list
     return [ecws.Section(doc) for doc in section_doc_cursor]
+
+def get_smoothed_points(user_id, sections):
+    """
+    Returns (coords, times, counts) for the smoothed locations of the
+    sections, i.e. the filtered locations between the start and the end of
+    each section, without the points that the smoothing stage deleted. The
+    locations and the smoothing results for all the sections are read with
+    one query each.
+    """
+    section_ids = [section.get_id() for section in sections]
+    deleted_points = set()
+    for smoothing_doc in edb.get_timeseries_db().find({"user_id": user_id,
+                                                       "metadata.key": "analysis/smoothing",
+                                                       "data.section": {"$in": section_ids}}):
+        deleted_points.update(smoothing_doc["data"]["deleted_points"])
+
+    location_query = {"user_id": user_id,
+                      "metadata.key": "background/filtered_location",
+                      "data.ts": {"$gte": min([section.start_ts for section in sections]),
+                                  "$lte": max([section.end_ts for section in sections])}}
+    location_docs = [doc for doc in edb.get_timeseries_db().find(location_query,
+                         {"data.ts": True, "data.loc": True}).sort("data.ts", pymongo.ASCENDING)
+                     if doc["_id"] not in deleted_points]
+    all_times = np.array([doc["data"]["ts"] for doc in location_docs], dtype=float)
+    all_coords = np.array([doc["data"]["loc"]["coordinates"] for doc in location_docs],
+                          dtype=float).reshape(-1, 2)
+
+    # The sections are sorted, but they can share their start and end points,
+    # so we find the range of each one separately instead of splitting once
+    starts = np.searchsorted(all_times, [section.start_ts for section in sections], side='left')
+    ends = np.searchsorted(all_times, [section.end_ts for section in sections], side='right')
+    indices = np.concatenate([np.arange(start, end) for (start, end) in zip(starts, ends)] +
+                             [np.zeros(0, dtype=int)])
+    return (all_coords[indices], all_times[indices], ends - starts)
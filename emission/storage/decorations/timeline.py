@@ -1,4 +1,5 @@
 import logging
+import bisect
 import emission.net.usercache.abstract_usercache as enua
 
 def get_timeline_from_dt(user_id, start_dt, end_dt):
@@ -52,8 +53,6 @@ def get_timeline(user_id, start_ts, end_ts):
 
 
 def get_aggregate_timeline_from_dt(start_dt, end_dt, box=None):
-    import emission.core.get_database as edb
-    import emission.core.wrapper.entry as ecwe
     import emission.storage.decorations.place_queries as esdp
     import emission.storage.decorations.trip_queries as esdt
 
@@ -61,19 +60,11 @@ def get_aggregate_timeline_from_dt(start_dt, end_dt, box=None):
         logging.info("About to query for %s -> %s" % (start_dt, end_dt))
     else:
         logging.info("About to query for %s -> %s in %s" % (start_dt, end_dt, box))
-    result_cursor = edb.get_timeseries_db().find({"data.local_dt": {"$gte": start_dt, "$lte": end_dt}}).sort("metadata.write_ts")
-    logging.debug("about to query result_cursor.count()")
-    result_cursor_count = result_cursor.count()
-    logging.debug("result cursor has %d entries" % result_cursor_count)
-    if result_cursor_count == 0:
-        return Timeline([], [])
-    logging.debug("About to query for time data in result cursor")
-    start_ts = ecwe.Entry(result_cursor[0]).metadata.write_ts
-    end_ts = ecwe.Entry(result_cursor[result_cursor_count - 1]).metadata.write_ts
-    logging.debug("Converted datetime range %s -> %s to timestamp range %s -> %s" %
-        (start_dt, end_dt, start_ts, end_ts))
-    places = esdp.get_aggregate_places(enua.UserCache.TimeQuery("enter_ts", start_ts, end_ts), box=box)
-    trips = esdt.get_aggregate_trips(enua.UserCache.TimeQuery("start_ts", start_ts, end_ts), box=box)
+    # The places and trips store their local datetimes, and they are indexed,
+    # so we query them directly instead of converting the range to
+    # timestamps through the timeseries
+    places = esdp.get_aggregate_places(enua.UserCache.TimeQuery("enter_local_dt", start_dt, end_dt), box=box)
+    trips = esdt.get_aggregate_trips(enua.UserCache.TimeQuery("start_local_dt", start_dt, end_dt), box=box)
     return Timeline(places, trips)
 
 class Timeline(object):
@@ -94,6 +85,8 @@ class Timeline(object):
         self.trips = trips_or_sections
         self.id_map = dict((p.get_id(), p) for p in self.places)
         self.id_map.update(dict((t.get_id(), t) for t in self.trips))
+        # The sorted arrays for the time queries, built on the first query
+        self._index = None
 
         if (len(self.places) == 0) and (len(self.trips) == 0):
             self.state = Timeline.State("none", None)
@@ -121,10 +114,88 @@ class Timeline(object):
             logging.debug("len(trips) = %s, adding start_place %s and end_place %s" % (len(self.trips),
                                                                                        self.trips[0].start_place,
                                                                                        self.trips[-1].end_place))
-            start_place = self._addIfNotExists(self.trips[0].start_place)
-            end_place = self._addIfNotExists(self.trips[-1].end_place)
+            self._addAllIfNotExist([self.trips[0].start_place, self.trips[-1].end_place])
+            start_place = self.id_map[self.trips[0].start_place]
             self.state = Timeline.State("place", start_place)  # Since this has been called before the iteration start
 
+    def fill_missing_places(self):
+        """
+        Adds the start and end places of all the trips that are not in the
+        timeline, e.g. for the aggregate timeline, where the places and trips
+        are queried separately, with one query for all of them.
+        """
+        place_ids = []
+        for trip in self.trips:
+            place_ids.append(trip.start_place)
+            place_ids.append(trip.end_place)
+        self._addAllIfNotExist(place_ids)
+
+    def get_trips_starting_in(self, start_ts, end_ts):
+        """
+        Returns the trips that start in [start_ts, end_ts), sorted by start_ts
+        """
+        index = self._get_index()
+        return index.trips[bisect.bisect_left(index.trip_starts, start_ts):
+                           bisect.bisect_left(index.trip_starts, end_ts)]
+
+    def get_trips_overlapping(self, start_ts, end_ts):
+        """
+        Returns the trips that overlap (start_ts, end_ts), sorted by start_ts
+        """
+        index = self._get_index()
+        return _get_overlapping(index.trips, index.trip_starts, index.trip_max_ends,
+                                index.trip_ends, start_ts, end_ts)
+
+    def get_places_overlapping(self, start_ts, end_ts):
+        """
+        Returns the places that overlap (start_ts, end_ts), sorted by
+        enter_ts. The first place has no enter_ts and the last place has no
+        exit_ts, so they extend to the start and the end of time.
+        """
+        index = self._get_index()
+        return _get_overlapping(index.places, index.place_enters, index.place_max_exits,
+                                index.place_exits, start_ts, end_ts)
+
+    def get_place_before(self, ts):
+        """
+        Returns the last place entered at or before ts, or None
+        """
+        index = self._get_index()
+        i = bisect.bisect_right(index.place_enters, ts)
+        return index.places[i-1] if i > 0 else None
+
+    def get_place_after(self, ts):
+        """
+        Returns the first place entered at or after ts, or None
+        """
+        index = self._get_index()
+        i = bisect.bisect_left(index.place_enters, ts)
+        return index.places[i] if i < len(index.places) else None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = Timeline.Index(self.places, self.trips)
+        return self._index
+
+    class Index(object):
+        """
+        The places and trips sorted by their start, with their starts and
+        ends in parallel arrays, so that the time queries can bisect them.
+        In the timeline of a single user, the ends are sorted as well. The
+        aggregate timelines have overlapping trips from many users, so we
+        also keep the running maximum of the ends, which is always sorted.
+        """
+        def __init__(self, places, trips):
+            self.trips = sorted(trips, key=lambda t: t.start_ts)
+            self.trip_starts = [t.start_ts for t in self.trips]
+            self.trip_ends = [t.end_ts for t in self.trips]
+            self.trip_max_ends = _running_max(self.trip_ends)
+
+            self.places = sorted(places, key=_get_enter_ts)
+            self.place_enters = [_get_enter_ts(p) for p in self.places]
+            self.place_exits = [_get_exit_ts(p) for p in self.places]
+            self.place_max_exits = _running_max(self.place_exits)
+
     def get_object(self, element_id):
         """
         Return the object corresponding to the id from the in-memory map. This should be more efficient than
@@ -134,23 +205,30 @@ class Timeline(object):
         """
         return self.id_map[element_id]
 
+    def _addAllIfNotExist(self, place_ids):
+        """
+        Adds the places specified by the given place_ids that are not already
+        in the place list and the place map, with one database query
+        """
+        import emission.storage.decorations.place_queries as esdp
+
+        missing_ids = set([place_id for place_id in place_ids if place_id not in self.id_map])
+        if len(missing_ids) == 0:
+            return
+        logging.debug("%d place ids are not in the map, searching in database" % len(missing_ids))
+        for place in esdp.get_places_by_ids(missing_ids):
+            self.places.append(place)
+            self.id_map[place.get_id()] = place
+        self._index = None
+
     def _addIfNotExists(self, place_id):
         """
         Adds the place specified by the given place_id to the place list and the place map and returns it
         :param place_id:
         :return:
         """
-        import emission.storage.decorations.place_queries as esdp
-
-        if place_id not in self.id_map:
-            logging.debug("place id %s is not in the map, searching in database" % place_id)
-            place = esdp.get_place(place_id)
-            self.places.append(place)
-            self.id_map[place_id] = place
-            logging.debug("retrieved object %s and added to id_map" % place)
-            return place
-        else:
-            return self.id_map[place_id]
+        self._addAllIfNotExist([place_id])
+        return self.id_map[place_id]
 
 
     def __iter__(self):
@@ -191,3 +269,28 @@ class Timeline(object):
             self.state = Timeline.State("unknown", None)
         else:
             self.state = Timeline.State(new_type, self.id_map[new_id])
+
+def _get_enter_ts(place):
+    # The first place of the user has not been entered
+    enter_ts = place.get("enter_ts")
+    return float("-inf") if enter_ts is None else enter_ts
+
+def _get_exit_ts(place):
+    # The last place of the user has not been exited yet
+    exit_ts = place.get("exit_ts")
+    return float("inf") if exit_ts is None else exit_ts
+
+def _running_max(values):
+    ret_val = []
+    curr_max = float("-inf")
+    for value in values:
+        curr_max = max(curr_max, value)
+        ret_val.append(curr_max)
+    return ret_val
+
+def _get_overlapping(elements, starts, max_ends, ends, start_ts, end_ts):
+    # The elements before first end before start_ts, since even the
+    # maximum of their ends does, and the elements from last start after end_ts
+    first = bisect.bisect_right(max_ends, start_ts)
+    last = bisect.bisect_left(starts, end_ts)
+    return [elements[i] for i in range(first, last) if ends[i] > start_ts]
@@ -4,6 +4,7 @@ import pymongo
 import emission.net.usercache.abstract_usercache as enua
 
 import emission.core.get_database as edb
+import emission.core.common as ecc
 import emission.core.wrapper.trip as ecwt
 import emission.core.wrapper.section as ecws
 import emission.core.wrapper.stop as ecwst
@@ -35,10 +36,16 @@ def get_trips(user_id, time_query):
     return [ecwt.Trip(doc) for doc in trip_doc_cursor]
 
 def get_aggregate_trips(time_query, box=None):
+    """
+    Returns the trips of all the users in the time query that start and end
+    in the box [[min_lng, min_lat], [max_lng, max_lat]] if it is specified.
+    The time query can also be on the local dates, e.g.
+    TimeQuery("start_local_dt", start_dt, end_dt).
+    """
     curr_query = _get_ts_query(time_query)
     if box:
-        curr_query.update({"start_loc" : {"$geoWithin" : {"$box": box}}})
-        curr_query.update({"end_loc" : {"$geoWithin" : {"$box": box}}})
+        curr_query.update({"start_loc" : ecc.get_box_query(box)})
+        curr_query.update({"end_loc" : ecc.get_box_query(box)})
     trip_doc_cursor = edb.get_trip_new_db().find(curr_query).sort(time_query.timeType, pymongo.ASCENDING)
     return [ecwt.Trip(doc) for doc in trip_doc_cursor]
 
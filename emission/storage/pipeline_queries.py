@@ -79,6 +79,63 @@ def mark_smoothing_done(user_id, last_section_done):
 def mark_smoothing_failed(user_id):
     mark_stage_failed(user_id, ps.PipelineStages.JUMP_SMOOTHING)
 
+def get_time_range_for_mode_inference(user_id):
+    # Like smoothing, this is a query against the section database, so we
+    # query against the section's end_ts
+    tq = get_time_range_for_stage(user_id, ps.PipelineStages.MODE_INFERENCE)
+    tq.timeType = "end_ts"
+    return tq
+
+def mark_mode_inference_done(user_id, last_section_done):
+    if last_section_done is None:
+        mark_stage_done(user_id, ps.PipelineStages.MODE_INFERENCE, None)
+    else:
+        mark_stage_done(user_id, ps.PipelineStages.MODE_INFERENCE, last_section_done.end_ts + END_FUZZ_AVOID_LTE)
+
+def mark_mode_inference_failed(user_id):
+    mark_stage_failed(user_id, ps.PipelineStages.MODE_INFERENCE)
+
+# The daily rollups are computed for all the users at once, so there is a
+# single pipeline state for them, with no user_id. The last_processed_ts is
+# the start of the first day that has not been rolled up yet, so we don't
+# add END_FUZZ_AVOID_LTE to it.
+def get_time_range_for_daily_rollup():
+    return get_time_range_for_stage(None, ps.PipelineStages.DAILY_ROLLUP)
+
+def mark_daily_rollup_done(first_day_not_done_ts):
+    mark_stage_done(None, ps.PipelineStages.DAILY_ROLLUP, first_day_not_done_ts)
+
+def mark_daily_rollup_failed():
+    mark_stage_failed(None, ps.PipelineStages.DAILY_ROLLUP)
+
+def get_daily_rollup_watermark():
+    curr_state = get_current_state(None, ps.PipelineStages.DAILY_ROLLUP)
+    if curr_state is None:
+        return None
+    return curr_state.last_processed_ts
+
+# Same as the daily rollups, for the route density grids
+def get_time_range_for_route_density():
+    return get_time_range_for_stage(None, ps.PipelineStages.ROUTE_DENSITY)
+
+def mark_route_density_done(first_day_not_done_ts):
+    mark_stage_done(None, ps.PipelineStages.ROUTE_DENSITY, first_day_not_done_ts)
+
+def mark_route_density_failed():
+    mark_stage_failed(None, ps.PipelineStages.ROUTE_DENSITY)
+
+def get_route_density_watermark():
+    curr_state = get_current_state(None, ps.PipelineStages.ROUTE_DENSITY)
+    if curr_state is None:
+        return None
+    return curr_state.last_processed_ts
+
+def get_last_processed_ts(user_id, stage):
+    curr_state = get_current_state(user_id, stage)
+    if curr_state is None:
+        return None
+    return curr_state.last_processed_ts
+
 def get_complete_ts(user_id):
     return get_current_state(user_id, ps.PipelineStages.JUMP_SMOOTHING).last_ts_run
 
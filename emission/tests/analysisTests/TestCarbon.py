@@ -153,6 +153,15 @@ class TestCarbon(unittest.TestCase):
     # We duplicate the bus trips to get air trips, so the distance should be the same
     self.assertEqual(myModeDistance['air_short'], (self.airCarbon * self.busExpect/1000))
 
+  def testCarbonFootprintByUser(self):
+    userFootprintMap = carbon.getModeCarbonFootprintByUser(self.testUsers + ["nobody@example.com"],
+        carbon.carbonFootprintForMode, self.weekago, self.now)
+    self.assertEqual(len(userFootprintMap), len(self.testUsers) + 1)
+    for testUser in self.testUsers:
+      self.assertEqual(userFootprintMap[testUser], carbon.getModeCarbonFootprint(testUser,
+        carbon.carbonFootprintForMode, self.weekago, self.now))
+    self.assertEqual(sum(userFootprintMap["nobody@example.com"].values()), 0)
+
   def testTotalCarbonFootprint(self):
     totalModeDistance = carbon.getModeCarbonFootprint(None, carbon.carbonFootprintForMode, self.weekago, self.now)
     self.assertEqual(totalModeDistance['walking'], 0)
@@ -162,6 +171,86 @@ class TestCarbon(unittest.TestCase):
     self.assertEqual(totalModeDistance['air_short'], (self.airCarbon * len(self.testUsers) * self.busExpect)/1000)
     self.assertEqual(totalModeDistance['train_short'], 0)
 
+  def testModeShareMaps(self):
+    # The single aggregation should return the same values as the per mode queries
+    for user in ['fest@example.com', None]:
+      (modeShareCount, modeShareDistance, shortLongModeShareDistance, nUsers) = \
+        carbon.getModeShareMaps(user, self.weekago, self.now)
+      for mode in carbon.getDisplayModes():
+        modeName = mode['mode_name']
+        spec = self.getMyQuerySpec(user, mode['mode_id'])
+        self.assertEqual(modeShareCount[modeName],
+          carbon.getTripCountForMode(user, mode['mode_id'], self.weekago, self.now))
+        self.assertAlmostEqual(modeShareDistance[modeName], carbon.getDistanceForMode(spec), places = 4)
+        if modeName in carbon.motorizedModeList:
+          self.assertAlmostEqual(shortLongModeShareDistance[modeName + "_short"],
+            carbon.getDistanceForMode(carbon.appendDistanceFilter(spec, {"$lte": 5000})), places = 4)
+          self.assertAlmostEqual(shortLongModeShareDistance[modeName + "_long"],
+            carbon.getDistanceForMode(carbon.appendDistanceFilter(spec, {"$gte": 5000})), places = 4)
+      self.assertEqual(nUsers, 1 if user is not None else len(self.testUsers))
+
+  def testRolledUpModeShareMaps(self):
+    import emission.analysis.result.daily_rollup as eard
+    expected = [carbon.getModeShareMaps(user, self.weekago, self.now)
+                  for user in ['fest@example.com', None]]
+    # Roll up everything before today, which includes the sections from yesterday
+    eard.rollup_current_days()
+    self.assertIsNotNone(eard.get_rolled_up_range(self.weekago, self.now)[0])
+    for (user, (count, distance, shortLongDistance, nUsers)) in \
+        zip(['fest@example.com', None], expected):
+      (rolledUpCount, rolledUpDistance, rolledUpShortLongDistance, rolledUpNUsers) = \
+        carbon.getModeShareMaps(user, self.weekago, self.now)
+      self.assertEqual(rolledUpCount, count)
+      self.assertEqual(rolledUpNUsers, nUsers)
+      for modeName in distance:
+        self.assertAlmostEqual(rolledUpDistance[modeName], distance[modeName], places = 4)
+      for modeName in shortLongDistance:
+        self.assertAlmostEqual(rolledUpShortLongDistance[modeName], shortLongDistance[modeName], places = 4)
+
+  def testRollupMonthEnds(self):
+    import emission.analysis.result.daily_rollup as eard
+    self.assertEqual(eard.get_month_ends(datetime(2015, 11, 20), datetime(2016, 2, 3)),
+                     [datetime(2015, 12, 1), datetime(2016, 1, 1), datetime(2016, 2, 1),
+                      datetime(2016, 2, 3)])
+    self.assertEqual(eard.get_month_ends(datetime(2016, 1, 1), datetime(2016, 2, 1)),
+                     [datetime(2016, 2, 1)])
+    self.assertEqual(eard.get_month_ends(None, datetime(2016, 2, 1)), [datetime(2016, 2, 1)])
+
+  def testPopulationModeShareMapsCached(self):
+    (count, distance, shortLongDistance, nUsers) = carbon.getPopulationModeShareMaps(self.weekago, self.now)
+    self.assertEqual(count['walking'], 5)
+    self.assertEqual(nUsers, len(self.testUsers))
+    # Changes to the sections are not visible until the entry expires or is refreshed
+    self.SectionsColl.remove({'user_id': 'fest@example.com'})
+    self.assertEqual(carbon.getPopulationModeShareMaps(self.weekago, self.now)[0]['walking'], 5)
+    (count, distance, shortLongDistance, nUsers) = carbon.getPopulationModeShareMaps(self.weekago,
+        self.now, forceRefresh = True)
+    self.assertEqual(count['walking'], 4)
+    self.assertEqual(nUsers, len(self.testUsers) - 1)
+
+  def testRecentPopulationModeShareMaps(self):
+    ((count, distance, shortLongDistance, nUsers), start, end) = \
+        carbon.getRecentPopulationModeShareMaps(timedelta(days = 7))
+    self.assertEqual(count['walking'], 5)
+    self.assertEqual(end - start, timedelta(days = 7))
+    # The later requests share the entry, and its window
+    self.SectionsColl.remove({'user_id': 'fest@example.com'})
+    (maps, cachedStart, cachedEnd) = carbon.getRecentPopulationModeShareMaps(timedelta(days = 7))
+    self.assertEqual(maps[0]['walking'], 5)
+    self.assertEqual(abs((cachedEnd - end).total_seconds()) < 1, True)
+
+  def testAggregateCacheReleasesLease(self):
+    import emission.analysis.result.aggregate_cache as eaac
+
+    def failingCompute(start, end):
+      raise RuntimeError("Failed to compute")
+    self.assertRaises(RuntimeError, eaac.get_or_compute, "failing", self.weekago, self.now,
+                      failingCompute)
+    # The next caller computes the value instead of waiting for the lease
+    self.assertEqual(eaac.get_or_compute("failing", self.weekago, self.now,
+                                         lambda start, end: [start, end]),
+                     list(eaac.get_cache_window(self.weekago, self.now)))
+
   def testMySummary(self):
       (myModeShareCount, avgModeShareCount,
        myModeShareDistance, avgModeShareDistance,
@@ -0,0 +1,187 @@
+import unittest
+import random
+import shutil
+import tempfile
+import numpy as np
+
+import emission.core.common as ec
+import emission.analysis.modelling.tour_model.trajectory_matching.LCS as eatl
+import emission.analysis.modelling.tour_model.trajectory_matching.Frechet as eatf
+import emission.analysis.modelling.tour_model.trajectory_matching.route_distance_matrix as eatr
+import emission.analysis.modelling.tour_model.trajectory_matching.pairwise_distance as eatp
+import emission.analysis.modelling.tour_model.trajectory_matching.prefilter as eatpf
+import emission.analysis.modelling.tour_model.trajectory_matching.route_matching as eatrm
+import emission.analysis.modelling.tour_model.trajectory_matching.transit_index as eatti
+
+class TestTrajectoryMatching(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.routes = []
+        for i in range(10):
+            self.routes.append([[-122.26 + random.random() * 0.02, 37.87 + random.random() * 0.02]
+                                for j in range(random.randint(1, 25))])
+
+    def naiveDiscreteFrechet(self, route1, route2):
+        d = ec.calDistanceMatrix(route1, route2)
+        ca = np.zeros(d.shape)
+        for i in range(d.shape[0]):
+            for j in range(d.shape[1]):
+                if i == 0 and j == 0:
+                    prev = 0
+                elif i == 0:
+                    prev = ca[i, j-1]
+                elif j == 0:
+                    prev = ca[i-1, j]
+                else:
+                    prev = min(ca[i-1, j], ca[i-1, j-1], ca[i, j-1])
+                ca[i, j] = max(prev, d[i, j])
+        return ca[-1, -1]
+
+    def testCalDistanceMatrix(self):
+        route1, route2 = self.routes[0], self.routes[1]
+        matrix = ec.calDistanceMatrix(route1, route2)
+        self.assertEqual(matrix.shape, (len(route1), len(route2)))
+        for i in range(len(route1)):
+            for j in range(len(route2)):
+                self.assertAlmostEqual(matrix[i, j], ec.calDistance(route1[i], route2[j]), places=6)
+
+    def testBandedLcs(self):
+        for route1 in self.routes:
+            for route2 in self.routes:
+                for radius in [200, 1000]:
+                    self.assertEqual(eatl.lcs(route1, route2, radius),
+                                     eatl.bandedLcs(route1, route2, radius))
+                    self.assertAlmostEqual(eatl.lcsScore(route1, route2, radius),
+                                           eatl.bandedLcsScore(route1, route2, radius))
+
+    def testBandedLcsScoreThreshold(self):
+        for route1 in self.routes:
+            for route2 in self.routes:
+                exact = eatl.lcsScore(route1, route2, 500)
+                early = eatl.bandedLcsScore(route1, route2, 500, 0.3)
+                if exact <= 0.3:
+                    self.assertAlmostEqual(exact, early)
+                else:
+                    self.assertGreater(early, 0.3)
+                    self.assertLessEqual(early, exact)
+
+    def testDiscreteFrechet(self):
+        for route1 in self.routes:
+            for route2 in self.routes:
+                self.assertAlmostEqual(self.naiveDiscreteFrechet(route1, route2),
+                                       eatf.discreteFrechet(route1, route2))
+        self.assertEqual(eatf.discreteFrechet(self.routes[0], self.routes[0]), 0)
+
+    def testDiscreteFrechetThreshold(self):
+        for route1 in self.routes:
+            for route2 in self.routes:
+                exact = self.naiveDiscreteFrechet(route1, route2)
+                bounded = eatf.discreteFrechet(route1, route2, 1500)
+                if exact <= 1500:
+                    self.assertAlmostEqual(exact, bounded)
+                else:
+                    self.assertEqual(bounded, float('inf'))
+
+    def testRouteDistanceMatrix(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            routes = dict(("section_%d" % i, route) for (i, route) in enumerate(self.routes) if len(route) > 0)
+            ids = sorted(routes.keys())
+            first = dict((_id, routes[_id]) for _id in ids[:5])
+
+            matrix = eatr.RouteDistanceMatrix("test_user", "lcs", tmpdir)
+            self.assertEqual(matrix.append_routes(first, eatl.bandedLcsScore, (500,)), 5)
+            self.assertEqual(matrix.append_routes(first, eatl.bandedLcsScore, (500,)), 0)
+            # The new routes need the distances to all the stored routes
+            partial = dict((_id, routes[_id]) for _id in ids[1:6])
+            self.assertRaises(ValueError, matrix.append_routes, partial, eatl.bandedLcsScore, (500,))
+            self.assertEqual(len(matrix), 5)
+            # The second batch is computed in parallel, and only has the new routes
+            matrix = eatr.RouteDistanceMatrix("test_user", "lcs", tmpdir)
+            self.assertEqual(matrix.append_routes(routes, eatl.bandedLcsScore, (500,), n_workers=2),
+                             len(routes) - 5)
+
+            reloaded = eatr.RouteDistanceMatrix("test_user", "lcs", tmpdir)
+            self.assertEqual(len(reloaded), len(routes))
+            square = reloaded.to_square(ids)
+            for (i, id1) in enumerate(ids):
+                for (j, id2) in enumerate(ids):
+                    expected = 0 if id1 == id2 else eatl.bandedLcsScore(routes[id1], routes[id2], 500)
+                    self.assertAlmostEqual(reloaded[id1][id2], expected, places=5)
+                    self.assertAlmostEqual(square[i, j], expected, places=5)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testCondensedToPair(self):
+        for n in range(2, 60):
+            expected = [(i, j) for i in range(n) for j in range(i+1, n)]
+            (rows, cols) = eatp._condensed_to_pair(n, np.arange(len(expected)))
+            self.assertEqual(zip(rows, cols), expected)
+
+    def testPairwiseDistances(self):
+        routes = dict(("section_%d" % i, route) for (i, route) in enumerate(self.routes) if len(route) > 0)
+        for metric in ['LCS', 'discreteFrechet']:
+            serial = eatp.PairwiseDistances(*eatp.pairwise_distances(routes, metric, n_workers=1))
+            parallel = eatp.PairwiseDistances(*eatp.pairwise_distances(routes, metric,
+                                                  n_workers=2, chunk_size=7))
+            metric_func = eatp.METRICS[metric]
+            for id1 in routes:
+                for id2 in routes:
+                    if id1 == id2:
+                        continue
+                    expected = metric_func(routes[id1], routes[id2])
+                    self.assertAlmostEqual(serial[id1][id2], expected)
+                    self.assertAlmostEqual(parallel[id2][id1], expected)
+
+    def testPrefilterBoundingBox(self):
+        prefilter = eatpf.RoutePrefilter()
+        berkeley = [[-122.26, 37.87], [-122.25, 37.88]]
+        sf = [[-122.42, 37.77], [-122.41, 37.78]]
+        self.assertEqual(prefilter.reject(berkeley, sf, 2000), 'bbox')
+        self.assertEqual(prefilter.reject(berkeley, berkeley, 2000, endpoints=True, min_coverage=1), None)
+        self.assertEqual(prefilter.counts['bbox'], 1)
+        self.assertEqual(prefilter.counts['passed'], 1)
+
+    def testPrefilterEndpoints(self):
+        prefilter = eatpf.RoutePrefilter()
+        # the second route starts on the first one, but ends 1km away
+        route1 = [[-122.26, 37.87 + i * 0.001] for i in range(10)]
+        route2 = [[-122.26, 37.872], [-122.25, 37.872]]
+        self.assertEqual(prefilter.reject(route1, route2, 100, endpoints=True), 'endpoints')
+        self.assertEqual(prefilter.reject(route1, route2, 100), None)
+
+    def testFindNear(self):
+        route = self.routes[0]
+        for point in self.routes[1]:
+            expected = [i for i in range(len(route)) if ec.calDistance(route[i], point) < 1000]
+            self.assertEqual(eatrm.find_near(route, point, 1000), expected)
+
+    def testMatchTwoRoutesPrefilter(self):
+        routes = [route for route in self.routes if len(route) >= 2]
+        far_route = [[lng + 1, lat] for (lng, lat) in routes[0]]
+        for route in routes:
+            self.assertEqual(eatrm.matchTwoRoutes(route, route), 1)
+            self.assertEqual(eatrm.matchTwoRoutes(route, far_route), 0)
+            self.assertEqual(eatrm.matchTwoRoutes(route, far_route, prefilter=False), 0)
+
+    def testTransitIndex(self):
+        entries = []
+        for (i, route) in enumerate(self.routes):
+            entries.append({'type': ['BART', 'CalTrain', 'MUNI'][i % 3], 'route': str(i), 'stops': route})
+        index = eatti.TransitIndex(entries)
+        for route_seg in self.routes:
+            if len(route_seg) < 2:
+                continue
+            expected_stops = {}
+            expected_routes = {}
+            for entry in entries:
+                if expected_stops.get(entry['type']) != 1:
+                    expected_stops[entry['type']] = eatrm.matchTransitStops(route_seg, entry['stops'], 300)
+                if expected_routes.get(entry['type']) != 1:
+                    expected_routes[entry['type']] = eatrm.matchTransitRoutes(route_seg, entry['stops'],
+                        100000, 100000, 'lcs', 500, 0.5)
+            self.assertEqual(index.stop_match(route_seg, 300), expected_stops)
+            self.assertEqual(index.route_match(route_seg, 100000, 100000, 'lcs', 500, 0.5), expected_routes)
+
+if __name__ == '__main__':
+    unittest.main()
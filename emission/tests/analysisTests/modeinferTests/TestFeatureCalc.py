@@ -1,4 +1,6 @@
 import unittest
+import random
+import numpy as np
 import emission.analysis.section_features as fc
 
 class TestFeatureCalc(unittest.TestCase):
@@ -35,5 +37,56 @@ class TestFeatureCalc(unittest.TestCase):
     testSeg = {"track_points": [trackpoint1]}
     self.assertEqual(len(fc.calSpeeds(testSeg)), 0)
 
+  def testParseTrackPointTime(self):
+    from dateutil import parser
+    for timeStr in ["20150127T203305-0800", "20150127T203305+0530", "2015-01-27T20:33:05.5-08:00"]:
+      parsed = parser.parse(timeStr)
+      self.assertEqual(fc.parseTrackPointTime("20150127T203306-0800") -
+                       fc.parseTrackPointTime("20150127T203305-0800"), 1)
+      self.assertAlmostEqual(fc.parseTrackPointTime(timeStr) - fc.parseTrackPointTime("20150127T203305-0800"),
+                             (parsed - parser.parse("20150127T203305-0800")).total_seconds())
+
+  def testCalTrackPointFeatures(self):
+    random.seed(42)
+    sections = []
+    for i in range(30):
+      trackpoints = []
+      time = 0
+      for j in range(random.randint(0, 15)):
+        # repeat some times and points to get zero time and distance deltas
+        time += random.choice([0, 1, 30, 60])
+        trackpoints.append({"track_location": {"coordinates": [-122.08 + random.random() * 0.01,
+                                                               37.39 + random.random() * 0.01]},
+                            "time": "20150127T20%02d%02d-0800" % (time // 60, time % 60)})
+      sections.append({"track_points": trackpoints, "distance": random.choice([0, None, 500, 1200])})
+    sections.append({"distance": 100})
+
+    features = fc.calTrackPointFeatures(sections)
+    self.assertEqual(features['errors'].keys(), [len(sections) - 1])
+    for (i, section) in enumerate(sections[:-1]):
+      speeds = fc.calSpeeds(section)
+      accels = fc.calAccels(section)
+      hasSpeeds = speeds is not None and len(speeds) > 0
+      hasAccels = accels is not None and len(accels) > 0
+      self.assertAlmostEqual(features['speedMean'][i], np.mean(speeds) if hasSpeeds else 0)
+      self.assertAlmostEqual(features['speedStd'][i], np.std(speeds) if hasSpeeds else 0)
+      self.assertAlmostEqual(features['speedMax'][i], np.max(speeds) if hasSpeeds else 0)
+      self.assertAlmostEqual(features['accelMax'][i], np.max(accels) if hasAccels else 0)
+      self.assertAlmostEqual(features['HCR'][i], fc.calHCR(section))
+      self.assertAlmostEqual(features['SR'][i], fc.calSR(section))
+      self.assertAlmostEqual(features['VCR'][i], fc.calVCR(section))
+
+  def testProjectToUTM(self):
+    import utm
+    random.seed(42)
+    # include points in the Norway and Svalbard zone exceptions
+    points = [[random.uniform(-180, 180), random.uniform(-80, 84)] for i in range(500)] + \
+             [[random.uniform(0, 45), random.uniform(55, 84)] for i in range(500)]
+    projected = fc.projectToUTM(points)
+    for (point, utmPoint) in zip(points, projected):
+      (easting, northing, zoneNumber, zoneLetter) = utm.from_latlon(point[1], point[0])
+      self.assertAlmostEqual(utmPoint[0], easting, places=3)
+      self.assertAlmostEqual(utmPoint[1], northing, places=3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -78,6 +78,31 @@ class TestPipeline(unittest.TestCase):
     self.assertEquals(len(self.pipeline.train_cluster), 0)
     self.assertEquals(len(self.pipeline.bus_cluster), 2)
 
+  def testGenerateBusAndTrainStopsFromStoredClusters(self):
+    import tempfile
+    import shutil
+    import emission.analysis.section_features as easf
+
+    self.pipeline.modelDir = tempfile.mkdtemp()
+    try:
+      (bus_cluster, train_cluster) = self.pipeline.generateBusAndTrainStopStep("test_fingerprint")
+      self.assertEquals(len(bus_cluster), 2)
+
+      # The clusters are stored with the fingerprint, so they are loaded
+      # without reading the sections again
+      easf._mode_cluster_cache.clear()
+      self.SectionsColl.update({'confirmed_mode': 5}, {'$set': {'confirmed_mode': 1}}, multi=True)
+      (bus_cluster, train_cluster) = self.pipeline.generateBusAndTrainStopStep("test_fingerprint")
+      self.assertEquals(len(bus_cluster), 2)
+
+      # A different fingerprint picks up the changed sections
+      (bus_cluster, train_cluster) = self.pipeline.generateBusAndTrainStopStep("new_fingerprint")
+      self.assertEquals(len(bus_cluster), 0)
+      self.assertEquals(len(train_cluster), 0)
+    finally:
+      easf._mode_cluster_cache.clear()
+      shutil.rmtree(self.pipeline.modelDir)
+
   def testFeatureGenWithOnePoint(self):
     trackpoint1 = {"track_location": {"coordinates": [-122.0861645, 37.3910201]},
                    "time" : "20150127T203305-0800"}
@@ -153,6 +178,35 @@ class TestPipeline(unittest.TestCase):
     scores = cross_validation.cross_val_score(self.pipeline.model, self.pipeline.cleanedFeatureMatrix, self.pipeline.cleanedResultVector, cv=3)
     self.assertGreater(scores.mean(), 0.90)
 
+  def testSaveAndLoadModel(self):
+    import tempfile
+    import shutil
+    import emission.analysis.classification.inference.model_store as eaicm
+
+    self.testBuildModelStep()
+    self.pipeline.modelDir = tempfile.mkdtemp()
+    try:
+      allConfirmedTripsQuery = pipeline.ModeInferencePipeline.getSectionQueryWithGroundTruth({'$ne': ''})
+      fingerprint = eaicm.get_training_set_fingerprint(self.SectionsColl, allConfirmedTripsQuery)
+      self.pipeline.saveModelStep(fingerprint)
+
+      newPipeline = pipeline.ModeInferencePipeline()
+      newPipeline.modelDir = self.pipeline.modelDir
+      self.assertFalse(newPipeline.loadModelStep("different_fingerprint"))
+      self.assertTrue(newPipeline.loadModelStep(fingerprint))
+      self.assertEqual(newPipeline.selFeatureIndices, self.pipeline.selFeatureIndices)
+      self.assertEqual(newPipeline.uniqueModes, [1,5])
+      self.assertEqual(len(newPipeline.bus_cluster), 2)
+      np.testing.assert_array_equal(newPipeline.model.predict(self.pipeline.selFeatureMatrix),
+                                    self.pipeline.model.predict(self.pipeline.selFeatureMatrix))
+
+      # The fingerprint changes when the ground truth changes
+      self.SectionsColl.update({'confirmed_mode': 5}, {'$set': {'confirmed_mode': 1}})
+      self.assertNotEqual(eaicm.get_training_set_fingerprint(self.SectionsColl, allConfirmedTripsQuery),
+                          fingerprint)
+    finally:
+      shutil.rmtree(self.pipeline.modelDir)
+
   def setupTestTrips(self):
     # Generate some test data by taking existing training data and stripping out the labels
     test_id_1 = self.SectionsColl.find_one({'confirmed_mode':1})
@@ -228,6 +282,20 @@ class TestPipeline(unittest.TestCase):
     self.assertIsNotNone(test_id_1_sec['distance'])
     self.assertIsNotNone(test_id_2_sec['trip_id'])
 
+  def testPredictAndSaveInChunksStep(self):
+    self.setupTestTrips()
+    self.testBuildModelStep()
+    toPredictTripsQuery = {"$and": [{'type': 'move'}, {'confirmed_mode': ''},
+      {'predicted_mode': None}]}
+    # one section per chunk, to check that we write every chunk
+    self.pipeline.predictAndSaveInChunksStep(toPredictTripsQuery, chunkSize = 1)
+
+    test_id_1_sec = self.SectionsColl.find_one({'_id': 'test_id_1'})
+    self.assertEquals(test_id_1_sec['predicted_mode'], {'walking': 1})
+    test_id_2_sec = self.SectionsColl.find_one({'_id': 'test_id_2'})
+    self.assertEquals(test_id_2_sec['predicted_mode'], {'bus': 1})
+    self.assertIsNotNone(test_id_2_sec['trip_id'])
+
   def testSavePredictionsStepWithClient(self):
     from emission.core.wrapper.user import User
 
@@ -0,0 +1,142 @@
+# Standard imports
+import unittest
+import logging
+import time
+import numpy as np
+import dateutil.parser as dup
+import pymongo
+
+# Our imports
+import emission.core.get_database as edb
+import emission.core.common as ec
+import emission.core.spatial_grid as esg
+import emission.core.wrapper.pipelinestate as ecwp
+import emission.storage.pipeline_queries as epq
+import emission.net.usercache.abstract_usercache as enua
+import emission.storage.timeseries.abstract_timeseries as esta
+import emission.storage.decorations.trip_queries as esdt
+import emission.storage.decorations.section_queries as esds
+import emission.storage.timeseries.format_hacks.move_filter_field as estfm
+import emission.analysis.intake.cleaning.filter_accuracy as eaicf
+import emission.analysis.intake.segmentation.trip_segmentation as eaist
+import emission.analysis.intake.segmentation.section_segmentation as eaiss
+import emission.analysis.intake.cleaning.location_smoothing as eaicl
+import emission.analysis.classification.inference.mode as eacim
+import emission.analysis.classification.inference.section_mode_inference as eacsmi
+
+# Test imports
+import emission.tests.common as etc
+
+class TestSectionModeInference(unittest.TestCase):
+  def setUp(self):
+    self.clearRelatedDb()
+    etc.loadTable('localhost', "Stage_Modes", "emission/tests/data/modes.json")
+    etc.setupRealExample(self, "emission/tests/data/real_examples/shankari_2015-aug-27")
+    eaicf.filter_accuracy(self.testUUID)
+    estfm.move_all_filters_to_data()
+    eaist.segment_current_trips(self.testUUID)
+    eaiss.segment_current_sections(self.testUUID)
+    eaicl.filter_current_sections(self.testUUID)
+
+    # Not through the stage time range, which would leave a run of the stage open
+    self.sections = esds.get_sections(self.testUUID, enua.UserCache.TimeQuery("end_ts", None, time.time()))
+    self.assertGreater(len(self.sections), 0)
+    self.pipeline = self.getTestPipeline()
+
+  def tearDown(self):
+    self.clearRelatedDb()
+
+  def clearRelatedDb(self):
+    edb.get_timeseries_db().remove()
+    edb.get_place_db().remove()
+    edb.get_stop_db().remove()
+    edb.get_trip_new_db().remove()
+    edb.get_section_new_db().remove()
+    edb.get_pipeline_state_db().remove()
+    edb.get_mode_db().remove()
+
+  def getTestPipeline(self):
+    # A model trained on random features, since we only check what the stage
+    # does with the predictions, not how good they are
+    from sklearn import ensemble
+    pipeline = eacim.ModeInferencePipeline()
+    pipeline.selFeatureIndices = pipeline.selectFeatureIndicesStep()
+    np.random.seed(61)
+    pipeline.model = ensemble.RandomForestClassifier().fit(
+        np.random.rand(10, len(pipeline.selFeatureIndices)), [1, 5] * 5)
+    pipeline.uniqueModes = [1, 5]
+    pipeline.modeList = list(edb.get_mode_db().find().sort("mode_id", pymongo.ASCENDING))
+    pipeline.modelCreatedTs = time.time()
+    # So that the first section starts and ends at "bus stops"
+    pipeline.bus_cluster = esg.SpatialGrid([self.sections[0].start_loc.coordinates,
+                                            self.sections[0].end_loc.coordinates], 105)
+    pipeline.train_cluster = esg.SpatialGrid([], 600)
+    return pipeline
+
+  def getLegacySection(self, section, sectionOrdinal):
+    # The section in the format of the legacy sections, with the smoothed
+    # locations as the track points, read one section at a time
+    ts = esta.TimeSeries.get_time_series(self.testUUID)
+    smoothing_doc = ts.get_entry_at_ts("analysis/smoothing", "data.section", section.get_id())
+    deleted_points = [] if smoothing_doc is None else smoothing_doc["data"]["deleted_points"]
+    location_docs = edb.get_timeseries_db().find({"user_id": self.testUUID,
+                                                  "metadata.key": "background/filtered_location",
+                                                  "data.ts": {"$gte": section.start_ts,
+                                                              "$lte": section.end_ts}}).sort("data.ts", pymongo.ASCENDING)
+    track_points = [{"track_location": doc["data"]["loc"], "time": doc["data"]["fmt_time"]}
+                    for doc in location_docs if doc["_id"] not in deleted_points]
+    # The new sections don't store their distance, so the stage computes it
+    # from the smoothed points
+    distance = sum([ec.calDistance(p1["track_location"]["coordinates"], p2["track_location"]["coordinates"])
+                    for (p1, p2) in zip(track_points, track_points[1:])])
+    return {"track_points": track_points,
+            "distance": distance,
+            "section_start_datetime": dup.parse(section.start_fmt_time).replace(tzinfo=None),
+            "section_end_datetime": dup.parse(section.end_fmt_time).replace(tzinfo=None),
+            "mode": eacsmi.FIRST_FILTER_MODES.get(section.sensed_mode, 0),
+            "section_id": sectionOrdinal,
+            "section_start_point": section.start_loc,
+            "section_end_point": section.end_loc}
+
+  def testFeatureMatrix(self):
+    legacySections = []
+    for section in self.sections:
+      tripSectionIds = [s.get_id() for s in esdt.get_sections_for_trip(self.testUUID, section.trip_id)]
+      legacySections.append(self.getLegacySection(section, tripSectionIds.index(section.get_id())))
+    expectedMatrix = np.zeros([len(self.sections), len(self.pipeline.featureLabels)])
+    errors = self.pipeline.updateFeatureMatrixRowsWithSections(expectedMatrix, 0, legacySections)
+    self.assertEqual(errors, {})
+
+    featureMatrix = eacsmi.get_feature_matrix(self.testUUID, self.sections, self.pipeline)
+    self.assertEqual(featureMatrix.shape, expectedMatrix.shape)
+    self.assertEqual(featureMatrix[0, 19], 1)
+    # The legacy track point times are parsed from the formatted times
+    np.testing.assert_allclose(featureMatrix, expectedMatrix, rtol=1e-6, atol=1e-6)
+
+  def testPredictModeForCurrentSections(self):
+    eacsmi.predict_mode_for_current_sections(self.testUUID, self.pipeline)
+
+    self.assertEqual(epq.get_last_processed_ts(self.testUUID, ecwp.PipelineStages.MODE_INFERENCE),
+                     self.sections[-1].end_ts + epq.END_FUZZ_AVOID_LTE)
+    ts = esta.TimeSeries.get_time_series(self.testUUID)
+    predictions = list(ts.find_entries(["inference/prediction"]))
+    self.assertEqual(len(predictions), len(self.sections))
+    self.assertEqual(sorted([prediction["data"]["section"] for prediction in predictions]),
+                     sorted([section.get_id() for section in self.sections]))
+    for prediction in predictions:
+      self.assertEqual(prediction["data"]["model_created_ts"], self.pipeline.modelCreatedTs)
+      self.assertAlmostEqual(sum(prediction["data"]["predicted_mode_map"].values()), 1)
+      self.assertTrue(set(prediction["data"]["predicted_mode_map"].keys()) <= set(["walking", "bus"]))
+
+    # There are no new sections, so nothing is predicted again and the
+    # watermark does not move
+    self.assertEqual(len(esds.get_sections(self.testUUID, enua.UserCache.TimeQuery("end_ts",
+        epq.get_last_processed_ts(self.testUUID, ecwp.PipelineStages.MODE_INFERENCE), time.time()))), 0)
+    eacsmi.predict_mode_for_current_sections(self.testUUID, self.pipeline)
+    self.assertEqual(epq.get_last_processed_ts(self.testUUID, ecwp.PipelineStages.MODE_INFERENCE),
+                     self.sections[-1].end_ts + epq.END_FUZZ_AVOID_LTE)
+    self.assertEqual(len(list(ts.find_entries(["inference/prediction"]))), len(self.sections))
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
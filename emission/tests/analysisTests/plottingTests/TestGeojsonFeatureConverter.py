@@ -4,6 +4,7 @@ import datetime as pydt
 import logging
 import json
 import geojson as gj
+import bson.json_util as bju
 
 # Our imports
 import emission.core.get_database as edb
@@ -13,7 +14,12 @@ import emission.storage.pipeline_queries as epq
 import emission.core.wrapper.motionactivity as ecwm
 
 import emission.analysis.plotting.geojson.geojson_feature_converter as gjfc
+import emission.analysis.plotting.geojson.diary_cache as gjdc
+import emission.analysis.plotting.geojson.compact_geojson as gjcg
 import emission.analysis.intake.segmentation.section_segmentation as eaiss
+import emission.analysis.intake.cleaning.location_smoothing as eaicl
+import emission.analysis.intake.cleaning.filter_accuracy as eaicf
+import emission.storage.timeseries.format_hacks.move_filter_field as estfm
 
 import emission.analysis.intake.segmentation.trip_segmentation as eaist
 
@@ -25,10 +31,35 @@ import emission.storage.decorations.timeline as esdtl
 # Test imports
 import emission.tests.common as etc
 
+class PerSectionQueries(object):
+    """
+    The per trip and per section queries that the geojson conversion made
+    before TimelineMaterializer, so that we can check that the batched
+    queries read the same data
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.ts = esta.TimeSeries.get_time_series(user_id)
+
+    def get_timeline_for_trip(self, trip_id):
+        return esdt.get_timeline_for_trip(self.user_id, trip_id)
+
+    def get_location_entries(self, section):
+        return self.ts.find_entries(["background/filtered_location"],
+                                    esds.get_time_query_for_section(section.get_id()))
+
+    def get_smoothing_entry(self, section):
+        return self.ts.get_entry_at_ts("analysis/smoothing", "data.section", section.get_id())
+
+    def get_end_location_entry(self, section):
+        return self.ts.get_entry_at_ts("background/filtered_location", "data.ts", section.end_ts)
+
 class TestGeojsonFeatureConverter(unittest.TestCase):
     def setUp(self):
         self.clearRelatedDb()
         etc.setupRealExample(self, "emission/tests/data/real_examples/shankari_2015-aug-27")
+        eaicf.filter_accuracy(self.testUUID)
+        estfm.move_all_filters_to_data()
 
     def tearDown(self):
         self.clearRelatedDb()
@@ -40,6 +71,7 @@ class TestGeojsonFeatureConverter(unittest.TestCase):
 
         edb.get_trip_new_db().remove()
         edb.get_section_new_db().remove()
+        edb.get_diary_cache_db().remove()
 
     def testTripGeojson(self):
         eaist.segment_current_trips(self.testUUID)
@@ -52,8 +84,119 @@ class TestGeojsonFeatureConverter(unittest.TestCase):
         self.assertEquals(len(created_trips), 8)
 
         trip_geojson = gjfc.trip_to_geojson(created_trips[0], tl)
-        logging.debug("trip_geojson = %s" % gj.dumps(trip_geojson, indent=4))
+        logging.debug("trip_geojson = %s" % bju.dumps(trip_geojson, indent=4))
+
+    def testTimelineGeojson(self):
+        eaist.segment_current_trips(self.testUUID)
+        eaiss.segment_current_sections(self.testUUID)
+        eaicl.filter_current_sections(self.testUUID)
+        self.assertTrue(edb.get_timeseries_db().find({"user_id": self.testUUID,
+                                                      "metadata.key": "analysis/smoothing"}).count() > 0)
+
+        tl = esdtl.get_timeline(self.testUUID, 1440658800, 1440745200)
+        tl.fill_start_end_places()
+
+        # The data for all the trips is read at once, but the geojson is the
+        # same as when we query the data for each trip and section separately
+        geojson_list = gjfc.get_geojson_for_timeline(self.testUUID, tl)
+        self.assertTrue(len(geojson_list) > 0)
+        per_section_queries = PerSectionQueries(self.testUUID)
+        separate_geojson_list = [gjfc.trip_to_geojson(trip, tl, per_section_queries) for trip in tl.trips]
+        separate_geojson_list = [trip_geojson for trip_geojson in separate_geojson_list
+                                 if len(trip_geojson.features) != 2]
+        # The properties have datetimes and ObjectIds, which only bson can dump
+        self.assertEqual([bju.dumps(trip_geojson, sort_keys=True) for trip_geojson in geojson_list],
+                         [bju.dumps(trip_geojson, sort_keys=True) for trip_geojson in separate_geojson_list])
+
+    def testCompactGeojson(self):
+        eaist.segment_current_trips(self.testUUID)
+        eaiss.segment_current_sections(self.testUUID)
+
+        tl = esdtl.get_timeline(self.testUUID, 1440658800, 1440745200)
+        tl.fill_start_end_places()
+        geojson_list = gjfc.get_geojson_for_timeline(self.testUUID, tl)
+        compact_list = gjcg.compact_trip_list(geojson_list)
+        self.assertEqual(len(compact_list), len(geojson_list))
+        # The size of what CompressedJSONPlugin sends
+        self.assertLess(len(bju.dumps(compact_list)), len(bju.dumps(geojson_list)) / 5)
+
+        for (trip_gj, compact_trip_gj) in zip(geojson_list, compact_list):
+            self.assertEqual(len(compact_trip_gj["features"]), len(trip_gj.features))
+            for (feature, compact_feature) in zip(trip_gj.features, compact_trip_gj["features"]):
+                if feature.type == "Feature":
+                    self.assertEqual(compact_feature, feature)
+                    continue
+                (points, line) = feature.features
+                coords = gjcg.decode_polyline(compact_feature["properties"]["encoded_polyline"])
+                self.assertEqual(len(coords), len(line.geometry.coordinates))
+                # Each coordinate is rounded to POLYLINE_PRECISION digits, so
+                # it is off by up to half a unit in the last digit
+                max_error = 0.5 * 10 ** -gjcg.POLYLINE_PRECISION + 1e-9
+                for (coord, line_coord) in zip(coords, line.geometry.coordinates):
+                    self.assertAlmostEqual(coord[0], line_coord[0], delta=max_error)
+                    self.assertAlmostEqual(coord[1], line_coord[1], delta=max_error)
+                ts = compact_feature["properties"]["ts"]
+                self.assertEqual(len(ts), len(points.features))
+                if len(ts) > 0:
+                    self.assertAlmostEqual(sum(ts), points.features[-1].properties["ts"], delta=1)
+
+    def testEncodePolyline(self):
+        # The example from the google documentation
+        coords = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+        encoded = gjcg.encode_polyline(coords)
+        self.assertEqual(encoded, "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(gjcg.decode_polyline(encoded), coords)
+
+    def testDiaryCache(self):
+        eaist.segment_current_trips(self.testUUID)
+        eaiss.segment_current_sections(self.testUUID)
+
+        day_geojson = gjdc.get_diary_for_day(self.testUUID, "2015-08-27")
+        self.assertTrue(len(day_geojson) > 0)
+        self.assertEqual(edb.get_diary_cache_db().find({"user_id": self.testUUID}).count(), 1)
+
+        # The stored entry is returned until a watermark moves across the day
+        edb.get_diary_cache_db().update({"user_id": self.testUUID, "day": "2015-08-27"},
+                                        {"$set": {"geojson": []}})
+        self.assertEqual(gjdc.get_diary_for_day(self.testUUID, "2015-08-27"), [])
+
+        # force_refresh recomputes it, and stores the new geojson
+        refreshed_geojson = gjdc.get_diary_for_day(self.testUUID, "2015-08-27", force_refresh=True)
+        self.assertEqual(bju.dumps(refreshed_geojson, sort_keys=True), bju.dumps(day_geojson, sort_keys=True))
+        self.assertEqual(len(gjdc.get_diary_for_day(self.testUUID, "2015-08-27")), len(day_geojson))
+        self.assertEqual(edb.get_diary_cache_db().find({"user_id": self.testUUID}).count(), 1)
+
+        # Smoothing the sections moves its watermark across the day, so the
+        # entry is stale and is recomputed
+        eaicl.filter_current_sections(self.testUUID)
+        edb.get_diary_cache_db().update({"user_id": self.testUUID, "day": "2015-08-27"},
+                                        {"$set": {"geojson": []}})
+        self.assertEqual(len(gjdc.get_diary_for_day(self.testUUID, "2015-08-27")), len(day_geojson))
 
+    def testDiaryCacheIsStale(self):
+        # 2015-08-27 00:00 UTC
+        day_start_ts = 1440633600
+        entry = {"day": "2015-08-27",
+                 "watermarks": {"SECTION_SEGMENTATION": day_start_ts - 3 * gjdc.DAY_SLACK,
+                                "JUMP_SMOOTHING": None}}
+        curr = dict(entry["watermarks"])
+        self.assertFalse(gjdc.is_stale(entry, curr))
+        # Moved, but not up to the day yet
+        curr["SECTION_SEGMENTATION"] = day_start_ts - 2 * gjdc.DAY_SLACK
+        self.assertFalse(gjdc.is_stale(entry, curr))
+        # Moved into the day
+        curr["SECTION_SEGMENTATION"] = day_start_ts + 60 * 60
+        self.assertTrue(gjdc.is_stale(entry, curr))
+        # The day was complete when the entry was computed
+        entry["watermarks"]["SECTION_SEGMENTATION"] = day_start_ts + 3 * gjdc.DAY_SLACK
+        curr["SECTION_SEGMENTATION"] = day_start_ts + 4 * gjdc.DAY_SLACK
+        self.assertFalse(gjdc.is_stale(entry, curr))
+        # The first smoothing run, and a reset of the pipeline
+        curr["JUMP_SMOOTHING"] = day_start_ts + 4 * gjdc.DAY_SLACK
+        self.assertTrue(gjdc.is_stale(entry, curr))
+        curr["JUMP_SMOOTHING"] = None
+        curr["SECTION_SEGMENTATION"] = None
+        self.assertTrue(gjdc.is_stale(entry, curr))
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -74,7 +74,9 @@ class TestPrecomputeResults(unittest.TestCase):
         user = User.fromEmail(fakeEmail)
         self.assertEqual(user.getFirstStudy(), 'testclient')
 
-        self.pr.precomputeResults()
+        stats = self.pr.precomputeResults()
+        self.assertEqual(stats['users'], len(self.testUsers))
+        self.assertEqual(stats['failed'], [])
 
         self.assertEqual(user.getProfile()['testfield1'], 'value1')
         self.assertEqual(user.getProfile()['testfield2'], 'value2')
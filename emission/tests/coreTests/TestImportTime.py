@@ -0,0 +1,108 @@
+# Standard imports
+import unittest
+import logging
+import json
+import os
+import subprocess
+import sys
+
+logging.basicConfig(level=logging.DEBUG)
+
+# Importing a module should not connect to the database or read the conf
+# files, since that makes the CLI tools and the tests slow to start, and
+# makes it impossible to import the code without a running database. We
+# import each module in a fresh interpreter, in which MongoClient and open
+# just record how they were called, and time each import, like
+# python -X importtime does in python 3.
+
+PROFILE_SCRIPT = """
+import __builtin__
+import json
+import sys
+import time
+import traceback
+import pymongo
+import pymongo.mongo_client
+
+report = {'mongo_clients': [], 'conf_files': [], 'imports': []}
+
+def caller():
+    return ["%s:%s" % (frame[0], frame[1]) for frame in traceback.extract_stack()[-5:-2]]
+
+class RecordingMongoClient(object):
+    def __init__(self, *args, **kwargs):
+        report['mongo_clients'].append(caller())
+    def __getattr__(self, name):
+        return self
+    def __getitem__(self, name):
+        return self
+    def __call__(self, *args, **kwargs):
+        return self
+pymongo.MongoClient = RecordingMongoClient
+pymongo.mongo_client.MongoClient = RecordingMongoClient
+
+realOpen = __builtin__.open
+def recordingOpen(name, *args, **kwargs):
+    if str(name).startswith('conf/'):
+        report['conf_files'].append([name, caller()])
+    return realOpen(name, *args, **kwargs)
+__builtin__.open = recordingOpen
+
+realImport = __builtin__.__import__
+depth = [0]
+def timedImport(name, *args, **kwargs):
+    isNew = name not in sys.modules
+    start = time.time()
+    depth[0] += 1
+    try:
+        return realImport(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        if isNew and name in sys.modules:
+            report['imports'].append([depth[0], name, time.time() - start])
+__builtin__.__import__ = timedImport
+
+__import__(sys.argv[1])
+print json.dumps(report)
+"""
+
+# The modules that the intake pipeline, the mode inference pipeline and the
+# CLI tools in bin/ import
+MODULES = [
+    "emission.core.get_database",
+    "emission.core.wrapper.pipelinestate",
+    "emission.core.wrapper.user",
+    "emission.net.usercache.abstract_usercache_handler",
+    "emission.storage.timeseries.abstract_timeseries",
+    "emission.storage.decorations.tour_model_queries",
+    "emission.analysis.intake.cleaning.filter_accuracy",
+    "emission.analysis.intake.segmentation.trip_segmentation",
+    "emission.analysis.intake.segmentation.section_segmentation",
+    "emission.analysis.intake.cleaning.location_smoothing",
+    "emission.analysis.section_features",
+    "emission.analysis.classification.inference.mode",
+    "emission.analysis.classification.inference.section_mode_inference",
+    "emission.analysis.modelling.tour_model.K_medoid",
+    "emission.net.api.Profile",
+]
+
+class TestImportTime(unittest.TestCase):
+  def profileImport(self, module):
+    repoRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+    output = subprocess.check_output([sys.executable, "-c", PROFILE_SCRIPT, module], cwd=repoRoot)
+    return json.loads(output.strip().split("\n")[-1])
+
+  def testNoDatabaseOrConfAtImport(self):
+    for module in MODULES:
+      report = self.profileImport(module)
+      total = sum([elapsed for (depth, name, elapsed) in report['imports'] if depth == 0])
+      logging.debug("importing %s took %.3f secs, slowest imports:" % (module, total))
+      for (depth, name, elapsed) in sorted(report['imports'], key=lambda entry: -entry[2])[:10]:
+        logging.debug("%8.3f %s%s" % (elapsed, "  " * depth, name))
+      self.assertEqual(report['mongo_clients'], [],
+        "importing %s created MongoClients at %s" % (module, report['mongo_clients']))
+      self.assertEqual(report['conf_files'], [],
+        "importing %s read conf files %s" % (module, report['conf_files']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Standard imports
+import unittest
+import logging
+import cPickle as pickle
+import numpy as np
+
+# Our imports
+import emission.core.common as ec
+import emission.core.spatial_grid as esg
+
+logging.basicConfig(level=logging.DEBUG)
+
+class TestSpatialGrid(unittest.TestCase):
+  def setUp(self):
+    np.random.seed(42)
+
+  def randomPoints(self, n, lat):
+    return np.column_stack([np.random.uniform(-122.05, -121.95, n),
+                            np.random.uniform(lat - 0.05, lat + 0.05, n)])
+
+  def checkNearestWithin(self, grid, centers, points, radius):
+    (nearest, distances) = grid.nearest_within(points, radius)
+    for (point, i, distance) in zip(points, nearest, distances):
+      expectedDistances = [ec.calDistance(center, point) for center in centers]
+      if ec.Include_place_2(centers, point, radius):
+        self.assertEqual(i, np.argmin(expectedDistances))
+        self.assertAlmostEqual(distance, min(expectedDistances), places=3)
+      else:
+        self.assertEqual(i, -1)
+        self.assertEqual(distance, np.inf)
+
+  def testNearestWithin(self):
+    # include a high latitude, where a grid in degrees would be distorted
+    for lat in [37.8, 78.0]:
+      centers = self.randomPoints(500, lat)
+      points = self.randomPoints(200, lat)
+      self.checkNearestWithin(esg.SpatialGrid(centers, 105), centers, points, 105)
+      # radius larger than the cells
+      self.checkNearestWithin(esg.SpatialGrid(centers, 100), centers, points, 350)
+
+  def testEmpty(self):
+    (nearest, distances) = esg.SpatialGrid([], 100).nearest_within([[-122, 37]], 100)
+    self.assertEqual(list(nearest), [-1])
+    (nearest, distances) = esg.SpatialGrid([[-122, 37]], 100).nearest_within([], 100)
+    self.assertEqual(len(nearest), 0)
+
+  def testPickle(self):
+    # The grids are stored with the mode inference model
+    centers = self.randomPoints(100, 37.8)
+    grid = pickle.loads(pickle.dumps(esg.SpatialGrid(centers, 105), pickle.HIGHEST_PROTOCOL))
+    self.checkNearestWithin(grid, centers, self.randomPoints(50, 37.8), 105)
+
+if __name__ == '__main__':
+    unittest.main()
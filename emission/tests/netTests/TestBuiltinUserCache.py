@@ -60,6 +60,31 @@ class TestBuiltinUserCache(unittest.TestCase):
         if data["metadata"]["key"] == "data/game":
             self.assertEqual(data["data"]["my_score"], 30)
 
+  def testPutUnchangedDataForPhone(self):
+    uc = ucauc.UserCache.getUserCache(self.testUserUUID)
+    footprintData = {"mine": 30, "avg": 40, "optimal": 50, "alldrive": 60}
+    uc.putDocument("data/footprint", footprintData)
+    gameData = {"my_score": 30, "other_scores": {'josh': 40, 'jillie': 20, 'naomi': 50}}
+    uc.putDocument("data/game", gameData)
+    firstData = mauc.sync_server_to_phone(self.testUserUUID)
+    self.assertEqual([data["metadata"]["version"] for data in firstData], [1, 1])
+
+    # Unchanged documents are not rewritten
+    uc.putDocument("data/footprint", dict(footprintData))
+    footprintData["mine"] = 20
+    uc.putDocument("data/game", gameData)
+    retrievedData = mauc.sync_server_to_phone(self.testUserUUID)
+    self.assertEqual(retrievedData, firstData)
+
+    uc.putDocument("data/footprint", footprintData)
+    known_versions = dict((data["metadata"]["key"], data["metadata"]["version"]) for data in firstData)
+    retrievedData = mauc.sync_server_to_phone(self.testUserUUID, known_versions)
+    self.assertEqual(len(retrievedData), 1)
+    self.assertEqual(retrievedData[0]["metadata"]["key"], "data/footprint")
+    self.assertEqual(retrievedData[0]["metadata"]["version"], 2)
+    self.assertEqual(retrievedData[0]["data"]["mine"], 20)
+    self.assertEqual(sorted(mauc.get_document_keys(self.testUserUUID)), ["data/footprint", "data/game"])
+
   def testClearObsoleteDocument(self):
     self.testPutTwoSetsOfUserDataForPhone()
 
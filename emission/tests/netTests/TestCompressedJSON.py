@@ -0,0 +1,68 @@
+# Standard imports
+import unittest
+import logging
+import zlib
+import gzip
+import datetime as pydt
+import StringIO
+import bson.json_util
+
+# Our imports
+import emission.net.api.bottle as bt
+import emission.net.api.compressed_json as enac
+
+class TestCompressedJSON(unittest.TestCase):
+    def setUp(self):
+        self.large_result = {"server_to_phone": [{"idx": i, "write_ts": pydt.datetime(2016, 1, 1),
+                                                  "data": "x" * 50} for i in range(1000)],
+                             "empty": [], "count": 1000}
+        self.small_result = {"timeline": [1, 2]}
+        self.app = bt.Bottle()
+        self.app.install(enac.CompressedJSONPlugin())
+        self.app.route("/large", callback=lambda: self.large_result)
+        self.app.route("/small", callback=lambda: self.small_result)
+
+    def call(self, path, accept_encoding = None):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "SERVER_NAME": "localhost",
+                   "SERVER_PORT": "80", "wsgi.url_scheme": "http",
+                   "wsgi.input": StringIO.StringIO("")}
+        if accept_encoding is not None:
+            environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+        status_headers = {}
+        def start_response(status, headers, exc_info = None):
+            status_headers["status"] = status
+            status_headers["headers"] = dict(headers)
+        body = "".join(self.app(environ, start_response))
+        self.assertEqual(status_headers["status"], "200 OK")
+        self.assertEqual(status_headers["headers"]["Content-Type"], "application/json")
+        return (status_headers["headers"].get("Content-Encoding"), body)
+
+    def testUncompressed(self):
+        (encoding, body) = self.call("/large")
+        self.assertIsNone(encoding)
+        self.assertEqual(body, bson.json_util.dumps(self.large_result))
+
+    def testCompressed(self):
+        (encoding, body) = self.call("/large", "gzip, deflate")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(body)).read(),
+                         bson.json_util.dumps(self.large_result))
+
+        (encoding, body) = self.call("/large", "gzip;q=0, deflate")
+        self.assertEqual(encoding, "deflate")
+        self.assertEqual(zlib.decompress(body), bson.json_util.dumps(self.large_result))
+
+    def testSmallNotCompressed(self):
+        (encoding, body) = self.call("/small", "gzip")
+        self.assertIsNone(encoding)
+        self.assertEqual(body, bson.json_util.dumps(self.small_result))
+
+    def testAcceptedEncoding(self):
+        self.assertEqual(enac.get_accepted_encoding(""), None)
+        self.assertEqual(enac.get_accepted_encoding("deflate, gzip"), "gzip")
+        self.assertEqual(enac.get_accepted_encoding("br, deflate;q=0.5"), "deflate")
+        self.assertEqual(enac.get_accepted_encoding("identity, gzip;q=0"), None)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -13,6 +13,8 @@ import emission.analysis.intake.segmentation.trip_segmentation as eaist
 import emission.analysis.intake.segmentation.section_segmentation as eaiss
 import emission.analysis.intake.cleaning.filter_accuracy as eaicf
 import emission.storage.timeseries.format_hacks.move_filter_field as estfm
+import emission.storage.pipeline_queries as epq
+import emission.analysis.result.route_density as earrd
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -38,6 +40,8 @@ class TestVisualize(unittest.TestCase):
 
     edb.get_trip_new_db().remove()
     edb.get_section_new_db().remove()
+    edb.get_route_density_db().remove()
+    edb.get_pipeline_state_db().remove()
 
 
   def testCommutePopRoute(self):
@@ -48,5 +52,16 @@ class TestVisualize(unittest.TestCase):
     points = visualize.Berkeley_pop_route(self.day_start_dt, self.day_end_dt)
     self.assertTrue(len(['latlng']) > 0)
 
+  def testRouteDensity(self):
+    eaist.segment_current_trips(self.testUUID)
+    eaiss.segment_current_sections(self.testUUID)
+    # The same grid when it is computed on the fly and when it is precomputed
+    onTheFly = earrd.get_density(self.day_start_dt, self.day_end_dt)
+    self.assertTrue(len(onTheFly) > 0)
+    self.assertTrue(all([weight > 0 for (lng, lat, weight) in onTheFly]))
+    earrd.compute_current_days()
+    self.assertIsNotNone(epq.get_route_density_watermark())
+    self.assertEqual(sorted(earrd.get_density(self.day_start_dt, self.day_end_dt)), sorted(onTheFly))
+
 if __name__ == '__main__':
     unittest.main()
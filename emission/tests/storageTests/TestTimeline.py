@@ -75,11 +75,69 @@ class TestTimeline(unittest.TestCase):
         tl = esdt.get_timeline_from_dt(self.testUUID, self.day_start_dt, self.day_end_dt)
         self.checkPlaceTripConsistency(tl)
 
+    def testAggregateTimeline(self):
+        eaist.segment_current_trips(self.testUUID)
+        # The local datetimes of the fixture are stored as UTC datetimes, so
+        # the PDT day is from 07:00 to 07:00 in local datetimes
+        day_start_dt = pydt.datetime.utcfromtimestamp(self.day_start_ts)
+        day_end_dt = pydt.datetime.utcfromtimestamp(self.day_end_ts)
+        tl = esdt.get_aggregate_timeline_from_dt(day_start_dt, day_end_dt)
+        user_tl = esdt.get_timeline(self.testUUID, self.day_start_ts, self.day_end_ts)
+        self.assertEqual(len(user_tl.trips), 8)
+        self.assertEqual([t.get_id() for t in tl.trips], [t.get_id() for t in user_tl.trips])
+        self.checkPlaceTripConsistency(tl)
+
+        # All the trips on that day were in the bay area, and one of them
+        # started and ended in Berkeley
+        bay_area_box = [ [-123.0, 37.0], [-121.5, 38.5] ]
+        box_tl = esdt.get_aggregate_timeline_from_dt(day_start_dt, day_end_dt, bay_area_box)
+        self.assertEqual([t.get_id() for t in box_tl.trips], self.get_trip_ids_in_box(tl, bay_area_box))
+        self.assertEqual(len(box_tl.trips), len(tl.trips))
+
+        berkeley_box = [ [-122.267443, 37.864693], [-122.250985, 37.880687] ]
+        box_tl = esdt.get_aggregate_timeline_from_dt(day_start_dt, day_end_dt, berkeley_box)
+        self.assertEqual([t.get_id() for t in box_tl.trips], self.get_trip_ids_in_box(tl, berkeley_box))
+        self.assertEqual(len(box_tl.trips), 1)
+
+    @staticmethod
+    def get_trip_ids_in_box(tl, box):
+        [[min_lng, min_lat], [max_lng, max_lat]] = box
+        def in_box(loc):
+            [lng, lat] = loc.coordinates
+            return min_lng <= lng <= max_lng and min_lat <= lat <= max_lat
+        return [t.get_id() for t in tl.trips if in_box(t.start_loc) and in_box(t.end_loc)]
+
     def testPlaceTripTimeline(self):
         eaist.segment_current_trips(self.testUUID)
         tl = esdt.get_timeline(self.testUUID, self.day_start_ts, self.day_end_ts)
         self.checkPlaceTripConsistency(tl)
 
+    def testTimelineTimeQueries(self):
+        eaist.segment_current_trips(self.testUUID)
+        tl = esdt.get_timeline(self.testUUID, self.day_start_ts, self.day_end_ts)
+        tl.fill_start_end_places()
+        self.assertEqual(len(tl.get_trips_starting_in(self.day_start_ts, self.day_end_ts)), len(tl.trips))
+
+        for trip in tl.trips:
+            # The trip itself, and the places before and after it
+            mid_ts = (trip.start_ts + trip.end_ts) / 2
+            self.assertEqual(tl.get_trips_overlapping(mid_ts, mid_ts + 1), [trip])
+            self.assertEqual(tl.get_place_before(trip.start_ts).get_id(), trip.start_place)
+            self.assertEqual(tl.get_place_after(trip.start_ts).get_id(), trip.end_place)
+            overlapping_places = [place.get_id() for place in
+                                  tl.get_places_overlapping(trip.start_ts - 1, trip.end_ts + 1)]
+            self.assertEqual(overlapping_places, [trip.start_place, trip.end_place])
+
+    def testFillMissingPlaces(self):
+        eaist.segment_current_trips(self.testUUID)
+        tl = esdt.get_aggregate_timeline_from_dt(self.day_start_dt, self.day_end_dt)
+        tl.places = []
+        tl.id_map = dict((t.get_id(), t) for t in tl.trips)
+        tl.fill_missing_places()
+        for trip in tl.trips:
+            self.assertEqual(tl.get_object(trip.start_place).starting_trip, trip.get_id())
+            self.assertEqual(tl.get_object(trip.end_place).ending_trip, trip.get_id())
+
     def testStopSectionTimeline(self):
         eaist.segment_current_trips(self.testUUID)
         eaiss.segment_current_sections(self.testUUID)
@@ -37,6 +37,10 @@ cfc.display.convertAndDisplayHeatMap = function(data, weightLabel) {
     convertedData = cfc.display.convertHeatMapPoints(data['latlng']);
     cfc.display.displayHeatMap(convertedData);
   }
+  if ('weightedLatlng' in data) {
+    convertedData = cfc.display.convertWeightedHeatMapPoints(data['weightedLatlng']);
+    cfc.display.displayHeatMap(convertedData);
+  }
 }
 
 cfc.display.convertWeightedHeatMap = function(data, label) {
@@ -65,6 +69,17 @@ cfc.display.convertHeatMapPoints = function(data) {
   return retArray;
 }
 
+cfc.display.convertWeightedHeatMapPoints = function(data) {
+  retArray = [];
+  for (var i = 0; i < data.length; i++) {
+    entry = data[i];
+    // Points are in GeoJSON format, i.e. (lng, lat), followed by the weight
+    latlng = new google.maps.LatLng(entry[1], entry[0]);
+    retArray.push({location: latlng, weight: entry[2]});
+  }
+  return retArray;
+}
+
 cfc.display.sortLabels = function(a,b) {
   if (b['key'] == a['key']) {
     return 0;